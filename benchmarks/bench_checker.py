@@ -0,0 +1,45 @@
+"""Micro-benchmark of scaling of the sanity checker.
+
+Print seconds per instruction of checking kernels of growing size and the
+exponent of the growth, which is 1 for linear scaling.
+
+    $ python benchmarks/bench_checker.py
+"""
+
+from __future__ import print_function
+from math import log
+
+from videocore.assembler import Assembler
+from videocore.checker import check_main
+
+from harness import result, best_time
+from bench_emit import add_ops
+
+def measure(n, repeat=5):
+    'Return Timing per instruction of checking a kernel of ``4 * n``.'
+    asm = Assembler(sanity_check=True)
+    add_ops(asm, n)
+    insns = asm._instructions
+    t = best_time(lambda: check_main(insns, asm._labels), repeat)
+    return t._replace(best=t.best / len(insns))
+
+def run(quick=False):
+    sizes = [50, 100] if quick else [250, 500, 1000]
+    times = [measure(n) for n in sizes]
+    results = [result('checker.{}'.format(4 * n), t.best, 's/insn', 'lower',
+                      spread=t.spread)
+               for n, t in zip(sizes, times)]
+    # Exponent of time as a power of size between the smallest and largest.
+    ratio = log(sizes[-1] / sizes[0])
+    exponent = 1 + log(times[-1].best / times[0].best) / ratio
+    spread = (times[0].spread + times[-1].spread) / ratio
+    results.append(result('checker.exponent', exponent, '', 'lower',
+                          spread=spread))
+    return results
+
+def main():
+    for r in run():
+        print('{:<24} {:>12.3g} {}'.format(r['name'], r['value'], r['unit']))
+
+if __name__ == '__main__':
+    main()
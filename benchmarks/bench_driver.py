@@ -0,0 +1,117 @@
+"""Micro-benchmark of host-side overhead of the driver.
+
+Print throughput of allocation, copying arrays, loading programs, staging
+uniforms and launching through :py:meth:`Driver.execute` with and without
+tracing.  The driver runs
+over host memory and a mailbox which returns at once, so that only the
+overhead of Python code is measured and no Raspberry Pi is needed.
+
+    $ python benchmarks/bench_driver.py
+"""
+
+from __future__ import print_function
+import mmap
+from contextlib import contextmanager
+
+import numpy as np
+
+import videocore.driver
+from videocore.assembler import qpu
+from videocore.driver import Driver
+from videocore.trace import Tracer
+
+from harness import Unavailable, result, best_time
+
+class HostVCSM(object):
+    'Stand-in of VCSM allocating host memory.'
+
+    def __init__(self):
+        self.busaddr = 0xc0000000
+
+    def malloc_cache(self, size, cache_mode, name):
+        busaddr = self.busaddr
+        self.busaddr += (size + 4095) // 4096 * 4096
+        return (1, busaddr, 0, mmap.mmap(-1, size))
+
+    def free(self, handle, buffer):
+        pass
+
+class NullMailBox(object):
+    'Stand-in of MailBox whose launches return at once.'
+
+    def enable_qpu(self, enable):
+        return 0
+
+    def execute_qpu(self, n_threads, message, noflush, timeout):
+        return 0
+
+    def close(self):
+        pass
+
+@contextmanager
+def host_driver(**kwargs):
+    'Driver over HostVCSM and NullMailBox.'
+    vcsm_module = getattr(videocore.driver.rpi_vcsm, 'VCSM', None)
+    if vcsm_module is None:
+        raise Unavailable('rpi_vcsm.VCSM is not available')
+    saved = (videocore.driver.MailBox, getattr(vcsm_module, 'VCSM', None))
+    videocore.driver.MailBox = NullMailBox
+    vcsm_module.VCSM = HostVCSM
+    try:
+        with Driver(**kwargs) as drv:
+            yield drv
+    finally:
+        (videocore.driver.MailBox, vcsm_module.VCSM) = saved
+
+@qpu
+def finish(asm):
+    exit()
+
+def run(quick=False):
+    n = 1000 if quick else 20000
+    results = []
+    with host_driver(data_area_size=64 * 1024 * 1024) as drv:
+        # Memory is never freed, so allocating benchmarks are not repeated
+        # until they last long enough.
+        t = best_time(lambda: [drv.alloc(16, 'float32') for _ in range(n)],
+                      min_time=0)
+        results.append(result('driver.alloc', n / t.best, 'arrays/s',
+                              spread=t.spread))
+
+        x = np.arange(1024, dtype='float32')
+        t = best_time(lambda: [drv.array(x) for _ in range(n // 10)],
+                      min_time=0)
+        results.append(result('driver.array_4k', n // 10 / t.best,
+                              'arrays/s', spread=t.spread))
+
+        program = drv.program(finish)
+        t = best_time(lambda: [drv.program(finish)
+                               for _ in range(n // 100)], min_time=0)
+        results.append(result('driver.program', n // 100 / t.best,
+                              'programs/s', spread=t.spread))
+
+        uniforms = np.arange(12 * 16, dtype='u4').reshape(12, 16)
+        t = best_time(lambda: [drv._stage_uniforms(uniforms)
+                               for _ in range(n)])
+        results.append(result('driver.stage_uniforms', n / t.best,
+                              'calls/s', spread=t.spread))
+
+        uniforms = uniforms.tolist()
+        t = best_time(lambda: [drv.execute(12, program, uniforms)
+                               for _ in range(n // 10)])
+        results.append(result('driver.execute', n // 10 / t.best,
+                              'launches/s', spread=t.spread))
+
+        drv.tracer = Tracer(max_events=1000)
+        t = best_time(lambda: [drv.execute(12, program, uniforms)
+                               for _ in range(n // 10)])
+        results.append(result('driver.execute_traced', n // 10 / t.best,
+                              'launches/s', spread=t.spread))
+    return results
+
+def main():
+    for r in run():
+        print('{:<24} {:>12.0f} {}'.format(r['name'], r['value'], r['unit']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Micro-benchmark of instruction emission of the assembler.
+
+Print throughput of assembling large unrolled kernels in instructions per
+second.
+
+    $ python benchmarks/bench_emit.py
+"""
+
+from __future__ import print_function
+
+from videocore.assembler import qpu, assemble, read_operands_cache_info
+
+from harness import result, best_time
+
+@qpu
+def add_ops(asm, n):
+    for i in range(n):
+        iadd(r0, r0, 1)
+        fadd(ra1, r0, rb1)
+        mov(r1, uniform)
+        nop()
+
+@qpu
+def dual_issue(asm, n):
+    for i in range(n):
+        fadd(ra1, r0, rb1).fmul(rb2, r2, r3)
+        iadd(r0, r0, 1).mov(r1, r2)
+        fmul(r3, r1, r2)
+        rotate(r1, r0, 3)
+
+@qpu
+def load_imm(asm, n):
+    for i in range(n):
+        ldi(r2, 0x1234)
+        ldi(ra0, 1.5)
+        setup_vpm_write()
+        setup_dma_load(nrows=2)
+
+BENCHMARKS = [
+    ('add_ops', add_ops),
+    ('dual_issue', dual_issue),
+    ('load_imm', load_imm),
+    ]
+
+def measure(kernel, n=25000, repeat=5):
+    'Return instructions per second of assembling ``kernel`` and its spread.'
+    code = assemble(kernel, n)
+    t = best_time(lambda: assemble(kernel, n), repeat)
+    return (len(code) // 8 / t.best, t.spread)
+
+def run(quick=False):
+    n = 1000 if quick else 25000
+    results = []
+    for name, kernel in BENCHMARKS:
+        value, spread = measure(kernel, n)
+        results.append(result('emit.' + name, value, 'insn/s',
+                              spread=spread))
+    return results
+
+def main():
+    for name, kernel in BENCHMARKS:
+        print('{:<12} {:>12.0f} insn/s'.format(name, measure(kernel)[0]))
+    info = read_operands_cache_info()
+    print('read operand cache: {} hits, {} misses'.format(info.hits,
+                                                          info.misses))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Micro-benchmark of the instruction encoder.
+
+Print throughput of encoding instruction structures to 64-bit words and of
+decoding them back.
+
+    $ python benchmarks/bench_encode.py
+"""
+
+from __future__ import print_function
+
+from videocore.assembler import _assemble
+from videocore.encoding import InsnArray
+
+from harness import result, best_time
+from bench_emit import BENCHMARKS
+
+def _encode(insns):
+    arr = InsnArray()
+    for insn in insns:
+        arr.append(insn)
+    return arr
+
+def run(quick=False):
+    n = 1000 if quick else 10000
+    results = []
+    for name, kernel in BENCHMARKS:
+        code = _assemble(kernel, n)._instructions
+        insns = list(code)
+        t = best_time(lambda: _encode(insns))
+        results.append(result('encode.' + name, len(insns) / t.best,
+                              'insn/s', spread=t.spread))
+        t = best_time(lambda: list(code))
+        results.append(result('decode.' + name, len(insns) / t.best,
+                              'insn/s', spread=t.spread))
+    return results
+
+def main():
+    for r in run():
+        print('{:<24} {:>12.0f} {}'.format(r['name'], r['value'], r['unit']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Static cost of library kernels.
+
+There is no QPU simulator, so kernels are compared by their static code:
+the number of instructions, of nops filling delay slots and hazards, of
+load immediates and of semaphore instructions.  A change of these figures
+between runs shows a change of generated code.
+
+    $ python benchmarks/bench_kernels.py
+"""
+
+from __future__ import print_function
+
+from videocore.assembler import assemble
+from videocore.disassembler import disassemble
+from videocore.elementwise import Expression, elementwise_kernel
+from videocore.reduce import reduce_kernel
+from videocore.gemm import gemm_kernel
+from videocore.fft import fft_kernel, passes
+from videocore.image import yuv420_kernel, downscale2x_kernel, filter_kernel
+
+from harness import result
+
+KERNELS = [
+    ('elementwise.axpy', elementwise_kernel,
+     (Expression('a * x + y'), ['x', 'y'], ['a'])),
+    ('reduce.sum', reduce_kernel, ('sum', 'float32', 12)),
+    ('reduce.argmax', reduce_kernel, ('argmax', 'float32', 12)),
+    ('gemm.sgemm', gemm_kernel, ()),
+    ('gemm.hgemm', gemm_kernel, (4, 'float16')),
+    ('gemm.qgemm', gemm_kernel, (4, 'uint8')),
+    ('fft.1024', fft_kernel, (1024,) + passes(1024)[-1] + (False,)),
+    ('image.yuv420', yuv420_kernel, ()),
+    ('image.downscale2x', downscale2x_kernel, ()),
+    ('image.gaussian', filter_kernel, (11, 'conv', False)),
+    ]
+
+def static_cost(code):
+    'Dict of counts of instructions of QPU program ``code``.'
+    lines = [line.strip() for line in disassemble(code).splitlines()]
+    lines = [line for line in lines if line and not line.startswith('L.')]
+    return {
+        'insns': len(code) // 8,
+        'nops': sum(line == 'nop()' for line in lines),
+        'ldis': sum(line.startswith('ldi(') for line in lines),
+        'semas': sum(line.startswith('sema_') for line in lines),
+        }
+
+def run(quick=False):
+    results = []
+    for name, kernel, args in KERNELS:
+        cost = static_cost(assemble(kernel, *args))
+        for key in sorted(cost):
+            results.append(result('kernel.{}.{}'.format(name, key),
+                                  cost[key], 'insn', 'lower', exact=True))
+    return results
+
+def main():
+    for r in run():
+        print('{:<36} {:>8.0f} {}'.format(r['name'], r['value'], r['unit']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Helpers shared by benchmarks.
+
+Each benchmark module has a ``run(quick=False)`` function returning a list of
+results made by :py:func:`result`.  ``quick`` runs smaller problems for smoke
+tests.
+"""
+
+import gc
+from collections import namedtuple
+from timeit import default_timer
+
+Timing = namedtuple('Timing', [
+    'best',     # shortest seconds per call
+    'spread',   # (median - best) / best of samples
+    ])
+
+class Unavailable(Exception):
+    'Raised by benchmark modules which can not run on this machine.'
+
+def result(name, value, unit, better='higher', exact=False, spread=0.0):
+    """Result of a benchmark.
+
+    :param better: 'higher' if higher values are better, e.g. throughput, or
+        'lower', e.g. time and instruction counts.
+    :param exact: True if the value does not vary between runs, so that any
+        change for the worse is a regression.
+    :param spread: relative noise of the value, e.g. ``Timing.spread``.
+        Changes within the spreads of both runs are not regressions.
+    """
+    return {'name': name, 'value': float(value), 'unit': unit,
+            'better': better, 'exact': exact, 'spread': float(spread)}
+
+def best_time(f, repeat=5, min_time=0.1):
+    """Time calls of ``f`` and return :py:class:`Timing`.
+
+    Like ``timeit`` autorange, ``f`` is called enough times for each of
+    ``repeat`` samples to last at least ``min_time`` seconds, so that short
+    calls are not dominated by timer resolution and scheduling.  The garbage
+    collector is disabled while timing as ``timeit`` does.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _best_time(f, repeat, min_time)
+    finally:
+        if enabled:
+            gc.enable()
+
+def _best_time(f, repeat, min_time):
+    number = 1
+    while True:
+        start = default_timer()
+        for _ in range(number):
+            f()
+        elapsed = default_timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = default_timer()
+        for _ in range(number):
+            f()
+        samples.append((default_timer() - start) / number)
+    samples.sort()
+    best, median = samples[0], samples[len(samples) // 2]
+    return Timing(best, (median - best) / best if best > 0 else 0.0)
@@ -0,0 +1,136 @@
+"""Run benchmarks, save results and compare them with a previous run.
+
+    $ python benchmarks/suite.py -o results.json
+    $ python benchmarks/suite.py -c results.json
+
+Results are saved as JSON with the platform they were taken on.  With
+``--compare`` each result is compared with the same one of the baseline and
+the exit status is 1 if any of them is worse by more than ``--threshold``
+and the spreads of both runs.  Instruction counts of kernels are exact, so any
+increase of them is a regression.  Timings of quick runs are too noisy to be
+compared, so only exact results are compared if either run is quick.
+Modules which can not run, e.g. bench_driver without rpi_vcsm, are reported
+as skipped, and results of skipped modules are not compared.  Other errors of
+modules are failures, which also make the exit status 1, and results missing
+from a failed module are regressions.
+"""
+
+from __future__ import print_function
+import argparse
+import importlib
+import json
+import platform
+import sys
+import time
+import traceback
+
+from harness import Unavailable
+
+MODULES = ['bench_emit', 'bench_encode', 'bench_checker', 'bench_driver',
+           'bench_kernels']
+
+def run(modules=MODULES, quick=False):
+    'Run benchmark modules and return the report.'
+    results = []
+    skipped = {}
+    failed = {}
+    for name in modules:
+        try:
+            module = importlib.import_module(name)
+            for r in module.run(quick):
+                r['module'] = name
+                results.append(r)
+        except (ImportError, Unavailable):
+            skipped[name] = traceback.format_exc().splitlines()[-1]
+        except Exception:
+            # Crashes may be caused by regressions, so they are not skipped.
+            failed[name] = traceback.format_exc()
+    return {
+        'version': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+        'skipped': skipped,
+        'failed': failed,
+        }
+
+def compare(report, baseline, threshold=0.1):
+    """Compare results of ``report`` with ``baseline``.
+
+    Return a list of (name, baseline value, value, relative change,
+    regression) where positive changes are improvements.  Results of the
+    baseline missing from ``report`` are regressions with value and change
+    of None unless their modules are skipped.
+    """
+    base = dict((r['name'], r) for r in baseline['results'])
+    quick = report.get('quick') or baseline.get('quick')
+    names = set(r['name'] for r in report['results'])
+    rows = [(r['name'], r['value'], None, None, True)
+            for r in baseline['results']
+            if r['name'] not in names and
+            r.get('module') not in report.get('skipped', {})]
+    for r in report['results']:
+        if r['name'] not in base or (quick and not r.get('exact')):
+            continue
+        old, new = base[r['name']]['value'], r['value']
+        change = (new - old) / old if old else 0.0
+        if r['better'] == 'lower':
+            change = 0.0 - change
+        if r.get('exact'):
+            regression = change < 0
+        else:
+            noise = (base[r['name']].get('spread', 0.0) +
+                     r.get('spread', 0.0))
+            regression = change < -max(threshold, noise)
+        rows.append((r['name'], old, new, change, regression))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='save results to JSON file')
+    parser.add_argument('-c', '--compare', help='baseline JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='relative slowdown regarded as a regression')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='run small problems')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='benchmark modules to run')
+    args = parser.parse_args(argv)
+
+    report = run(args.modules, args.quick)
+    for r in report['results']:
+        print('{:<40} {:>14.6g} {:<12} {}'.format(
+            r['name'], r['value'], r['unit'],
+            '+-{:.1%}'.format(r['spread']) if r.get('spread') else ''))
+    for name, reason in sorted(report['skipped'].items()):
+        print('skipped {}: {}'.format(name, reason))
+    for name, trace in sorted(report['failed'].items()):
+        print('failed {}:\n{}'.format(name, trace))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.threshold)
+        print()
+        print(' comparison with {} '.format(args.compare).center(80, '='))
+        if report['quick'] or baseline.get('quick'):
+            print('timings of quick runs are not compared')
+        for name, old, new, change, regression in rows:
+            if new is None:
+                print('{:<40} {:>12} {:>8}  REGRESSION'.format(
+                    name, 'missing', ''))
+                continue
+            print('{:<40} {:>12.6g} {:>+8.1%}{}'.format(
+                name, new, change, '  REGRESSION' if regression else ''))
+        if any(row[4] for row in rows):
+            return 1
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
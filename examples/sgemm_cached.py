@@ -531,20 +531,19 @@ def main():
         uniforms[:, 12] = np.arange(n_threads)
         uniforms[:, 13] = n_threads
 
-        # Allocate GPU program.
-        code = drv.program(sgemm_gpu_code)
+        # Allocate GPU program.  Addresses of A, B and C are uniforms 4, 5
+        # and 6, so that only they are cleaned before execution.
+        code = drv.program(sgemm_gpu_code, input_uniforms=[4, 5, 6],
+                           output_uniforms=[6])
 
         # GPU
         start = time.time()
-        A.clean()
-        B.clean()
-        C.clean()
         drv.execute(
                 n_threads=n_threads,
                 program=code,
                 uniforms=uniforms
                 )
-        C.invalidate()
+        C.sync_host()
         elapsed_gpu = time.time() - start
 
         def Gflops(sec):
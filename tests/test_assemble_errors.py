@@ -1,11 +1,12 @@
 'Test of QPU assembler'
 
 from nose.tools import raises, assert_raises
-from struct import pack
+from struct import pack, unpack
 from copy import deepcopy
 
 import videocore.encoding as enc
-from videocore.assembler import REGISTERS, AssembleError, assemble, qpu
+from videocore.assembler import REGISTERS, AssembleError, assemble, qpu, \
+    read_operands_cache_info, clear_read_operands_cache
 
 
 
@@ -57,6 +58,27 @@ def test_bytes_conversion():
         insn = enc.Insn.from_bytes(sample_insn.to_bytes())
         assert insn == sample_insn
 
+def test_insn_array():
+    samples = [SAMPLE_ALU_INSN, SAMPLE_BRANCH_INSN, SAMPLE_LOAD_INSN,
+               SAMPLE_SEMA_INSN]
+    insns = enc.InsnArray()
+    for sample_insn in samples:
+        insns.append(sample_insn)
+    assert len(insns) == 4
+    assert list(insns) == samples
+    assert insns[-1] == SAMPLE_SEMA_INSN
+    assert insns.tobytes() == b''.join(i.to_bytes() for i in samples)
+    assert list(insns.kinds) == [0, 1, 2, 3]
+    assert insns.column('waddr_add')[0] == 53
+    assert insns.column('immediate', enc.BranchInsn)[1] == 0x12345678
+
+    insns.set_field(1, 'immediate', -8)
+    assert insns[1].immediate == 0xfffffff8
+    assert insns[1].cond_br == 13
+    insns[0] = SAMPLE_LOAD_INSN
+    assert insns[0] == SAMPLE_LOAD_INSN
+    assert insns.word(0) == unpack('<Q', SAMPLE_LOAD_INSN.to_bytes())[0]
+
 def test_insn_repr():
     assert repr(SAMPLE_ALU_INSN) == (
             'AluInsn(sig=0x0, unpack=0x1, pm=0x1, pack=0x2, '
@@ -139,6 +161,36 @@ def test_signal_conflict():
     assert_raises(AssembleError, assemble, signal_imm_conflict_3)
     assert_raises(AssembleError, assemble, signal_signal_conflict)
 
+@qpu
+def stale_dual_issue_1(asm):
+    add = iadd(r0, r0, r1)
+    nop()
+    add.fmul(r2, r2, r3)
+
+@qpu
+def stale_dual_issue_2(asm):
+    first = iadd(r0, r0, r1)
+    iadd(r1, r1, r1)
+    first.fmul(r2, r2, r3)
+
+@qpu
+def stale_dual_issue_3(asm):
+    add = iadd(r0, r0, r1)
+    add.fmul(r2, r2, r3)
+    add.fmul(r3, r2, r3)
+
+@qpu
+def dual_issue_after_typo(asm):
+    add = iadd(r0, r0, r1)
+    assert not hasattr(add, 'fmull')
+    add.fmul(r2, r2, r3)
+
+def test_stale_dual_issue():
+    assemble(dual_issue_after_typo)     # no throw
+    assert_raises(AssembleError, assemble, stale_dual_issue_1)
+    assert_raises(AssembleError, assemble, stale_dual_issue_2)
+    assert_raises(AssembleError, assemble, stale_dual_issue_3)
+
 @qpu
 def pack_conflict_1(asm):
     iadd(ra0.pack('16a'), r0, r1).fmul(ra1.pack('16a'), r2, r3)
@@ -282,3 +334,24 @@ def test_missing_args2():
 
 def test_missing_args3():
     assert (assemble (missing_args3))
+
+@qpu
+def repeated_operands(asm):
+    for i in range(10):
+        iadd(r0, ra0, 1)
+        fadd(r0, ra0.unpack('16a'), rb0)
+
+def test_read_operands_cache():
+    clear_read_operands_cache()
+    code = assemble(repeated_operands)
+    info = read_operands_cache_info()
+    assert info.misses == 2
+    assert info.hits == 18
+    assert info.currsize == 2
+    assert assemble(repeated_operands) == code
+    assert read_operands_cache_info().hits == 38
+
+    # Failures are not cached.
+    assert_raises(AssembleError, assemble, too_many_imm)
+    assert_raises(AssembleError, assemble, too_many_imm)
+    assert read_operands_cache_info().currsize == 2
@@ -0,0 +1,68 @@
+'Test of binary diff of QPU programs'
+
+import io
+
+from videocore.assembler import qpu, assemble, get_label_positions
+from videocore.bindiff import diff, print_diff, cost, DecodedProgram
+
+@qpu
+def kernel_v1(asm):
+    mov(ra0, uniform)
+    ldi(r1, 10)
+    L.loop
+    setup_vpm_read(nrows=1)
+    mov(r0, vpm)
+    fadd(r0, r0, r0)
+    nop()
+    isub(r1, r1, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+    exit()
+
+@qpu
+def kernel_v2(asm):
+    mov(ra0, uniform)
+    ldi(r1, 10)
+    L.loop
+    setup_vpm_read(nrows=1)
+    mov(r0, vpm)
+    fadd(r0, r0, r0).fmul(r2, r0, r0)
+    isub(r1, r1, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+    exit()
+
+def test_basic_blocks():
+    program = DecodedProgram(assemble(kernel_v1),
+                             get_label_positions(kernel_v1))
+    assert [b.name for b in program.blocks] == ['entry+0', 'loop', 'loop+1']
+    assert [len(b) for b in program.blocks] == [2, 9, 4]
+
+def test_cost():
+    c = cost(DecodedProgram(assemble(kernel_v1)).insns)
+    assert c['instructions'] == 15
+    assert c['branch'] == 1
+    assert c['load_imm'] == 2
+    assert c['memory'] == 2     # setup_vpm_read and read from vpm
+
+def test_no_difference():
+    assert not diff(kernel_v1, kernel_v1).changed()
+
+def test_diff():
+    d = diff(kernel_v1, kernel_v2)
+    assert d.changed()
+    changed = [block for block in d.blocks if block.changed()]
+    assert [block.name for block in changed] == ['loop']
+    delta = changed[0].cost_delta()
+    assert delta['instructions'] == -1
+    assert delta['nop'] == -1
+    assert delta['dual_issue'] == 1
+    assert d.summary()['instructions'] == (15, 14, -1)
+
+def test_print_diff():
+    f = io.StringIO()
+    print_diff(kernel_v1, kernel_v2, file=f)
+    lines = f.getvalue().splitlines()
+    assert '-    4: fadd(r0, r0, r0)' in lines
+    assert '+    4: fadd(r0, r0, r0).fmul(r2, r0, r0)' in lines
+    assert '     7: jzc(L.loop)' in lines
@@ -0,0 +1,145 @@
+'Test of tracking stale ranges of cached memory'
+
+import mmap
+
+import numpy as np
+import rpi_vcsm
+
+from videocore.assembler import qpu
+from videocore.driver import (Driver, Array, CacheTracker, CACHE_LINE_SIZE,
+                              asarray)
+
+class RecordingVCSM(object):
+    'Stand-in of VCSM recording cache operations.'
+
+    def __init__(self):
+        self.calls = []
+
+    def clean(self, usraddr, size):
+        self.calls.append(('clean', usraddr, size))
+
+    def invalidate(self, usraddr, size):
+        self.calls.append(('invalidate', usraddr, size))
+
+def tracked_array(size=4096):
+    vcsm = RecordingVCSM()
+    buf = mmap.mmap(-1, size)
+    cache = CacheTracker(vcsm, 0x1000, buf, size)
+    arr = Array(size // 4, 'u4', vcsm=vcsm, address=0x40001000,
+                usraddr=0x1000, buffer=buf, offset=0, cache=cache)
+    return (arr, cache, vcsm)
+
+def test_host_writes_are_coalesced():
+    arr, cache, vcsm = tracked_array()
+    arr[0:16] = 1
+    arr[16:32] = 2
+    arr[100] = 3
+    cache.clean()
+    assert vcsm.calls == [('clean', 0x1000, 128), ('clean', 0x1000 + 400, 4)]
+    del vcsm.calls[:]
+    cache.clean()
+    assert vcsm.calls == []
+
+def test_element_write():
+    arr, cache, vcsm = tracked_array()
+    view = arr[64:128]
+    view[0] = 1
+    view[2:4] = 1
+    assert cache.host_dirty.ranges == [(256, 260), (264, 272)]
+
+def test_invalidate_only_stale_ranges():
+    arr, cache, vcsm = tracked_array()
+    cache.mark_device(0, 4096)
+    arr[200:216].sum()
+    assert vcsm.calls == [('invalidate', 0x1000 + 768, 128)]
+    assert cache.device_dirty.ranges == [(0, 768), (896, 4096)]
+    del vcsm.calls[:]
+    arr[200:216].sum()
+    assert vcsm.calls == []
+
+def test_invalidate_cleans_shared_lines():
+    arr, cache, vcsm = tracked_array()
+    arr[0] = 1
+    cache.mark_device(4, 8)
+    arr[1:2].sum()
+    assert vcsm.calls == [('clean', 0x1000, 4),
+                          ('invalidate', 0x1000, CACHE_LINE_SIZE)]
+    assert arr[0] == 1
+
+def test_clean_ranges_coalesced():
+    arr, cache, vcsm = tracked_array(16384)
+    arr[0] = 1
+    arr[100] = 1
+    arr[3000] = 1
+    arr[3500] = 1
+    cache.clean_ranges([(0, 8), (400, 404), (12000, 14100)])
+    assert vcsm.calls == [('clean', 0x1000, 404),
+                          ('clean', 0x1000 + 12000, 2004)]
+    assert cache.host_dirty.ranges == []
+
+def test_empty_slice():
+    arr, cache, vcsm = tracked_array()
+    cache.mark_device(0, 4096)
+    arr[:0].sum()
+    arr[16:16] = 1
+    assert vcsm.calls == []
+    assert cache.host_dirty.ranges == []
+    assert cache.device_dirty.ranges == [(0, 4096)]
+
+def test_read_device_dirty_array():
+    arr, cache, vcsm = tracked_array()
+    view = arr[64:128]
+    cache.mark_device(0, 4096)
+    np.asarray(view)
+    assert vcsm.calls == []
+    assert asarray(view).shape == (64,)
+    assert vcsm.calls == [('invalidate', 0x1000 + 256, 256)]
+    del vcsm.calls[:]
+    view.astype('float32')
+    view.copy()
+    assert vcsm.calls == []
+    arr.astype('float32')
+    assert vcsm.calls == [('invalidate', 0x1000, 256),
+                          ('invalidate', 0x1000 + 512, 3584)]
+    assert cache.device_dirty.ranges == []
+
+def test_ufunc_at():
+    arr, cache, vcsm = tracked_array()
+    assert np.add.at(arr, [0, 20], 1) is None
+    assert arr[20] == 1
+    assert cache.host_dirty.ranges == [(0, 4096)]
+
+@qpu
+def increment(asm):
+    setup_vpm_write()
+    setup_dma_load(nrows=1)
+    start_dma_load(uniform)
+    wait_dma_load()
+    setup_vpm_read(nrows=1)
+    setup_vpm_write()
+    iadd(vpm, vpm, 1)
+    setup_dma_store(nrows=1)
+    start_dma_store(uniform)
+    wait_dma_store()
+    exit()
+
+def test_cached_execute():
+    with Driver(cache_mode=rpi_vcsm.CACHE_HOST) as drv:
+        x = drv.alloc(16, 'int32')
+        x[:] = np.arange(16)
+        prog = drv.program(increment)
+        for i in range(3):
+            drv.execute(1, prog, [x.address, x.address])
+            assert np.all(x == np.arange(16) + i + 1)
+
+def test_declared_buffers():
+    with Driver(cache_mode=rpi_vcsm.CACHE_HOST) as drv:
+        x = drv.alloc(16, 'int32')
+        y = drv.alloc(16, 'int32')
+        x[:] = np.arange(16)
+        y[:] = 0
+        prog = drv.program(increment, input_uniforms=[0],
+                           output_uniforms=[1])
+        drv.execute(1, prog, [x.address, y.address])
+        assert drv.datmem.cache.device_dirty.ranges == [(64, 128)]
+        assert np.all(y == np.arange(16) + 1)
@@ -0,0 +1,66 @@
+'Test of convolution'
+
+import numpy as np
+
+from videocore.conv import Conv2D, conv2d, _convs
+from videocore.driver import Driver
+
+def conv2d_ref(x, w, stride, padding):
+    KH, KW, C, OC = w.shape
+    p = padding
+    x = np.pad(x, [(0, 0), (p, p), (p, p), (0, 0)], 'constant')
+    N, H, W, _ = x.shape
+    OH = (H - KH) // stride + 1
+    OW = (W - KW) // stride + 1
+    y = np.zeros((N, OH, OW, OC), dtype='float32')
+    for ky in range(KH):
+        for kx in range(KW):
+            patch = x[:, ky:ky+stride*OH:stride, kx:kx+stride*OW:stride, :]
+            y += np.dot(patch, w[ky, kx])
+    return y
+
+def test_conv2d():
+    with Driver() as drv:
+        for shape, kernel, stride, padding in [
+                ((1, 8, 8, 1), (3, 3, 1, 4), 1, 0),
+                ((2, 19, 21, 3), (3, 3, 3, 20), 1, 1),
+                ((1, 33, 40, 8), (5, 5, 8, 16), 2, 2),
+                ((1, 10, 10, 6), (1, 1, 6, 3), 3, 0)]:
+            x = np.random.randn(*shape).astype('float32')
+            w = np.random.randn(*kernel).astype('float32')
+            conv = Conv2D(drv, w, stride, padding)
+            y = conv(drv.copy(x))
+            assert y.shape == conv.output_shape(shape)
+            assert np.allclose(conv2d_ref(x, w, stride, padding), y,
+                               rtol=1e-4, atol=1e-3)
+
+def test_single_image():
+    with Driver() as drv:
+        x = np.random.randn(12, 12, 2).astype('float32')
+        w = np.random.randn(3, 3, 2, 5).astype('float32')
+        y = Conv2D(drv, w)(drv.copy(x))
+        assert y.shape == (10, 10, 5)
+        assert np.allclose(conv2d_ref(x[None], w, 1, 0)[0], y,
+                           rtol=1e-4, atol=1e-3)
+
+def test_single_image_padded():
+    with Driver() as drv:
+        x = np.random.randn(9, 11, 3).astype('float32')
+        w = np.random.randn(3, 3, 3, 4).astype('float32')
+        for padding in [0, 1]:
+            y = Conv2D(drv, w, padding=padding)(drv.copy(x))
+            assert y.shape == (7 + 2*padding, 9 + 2*padding, 4)
+            assert np.allclose(conv2d_ref(x[None], w, 1, padding)[0], y,
+                               rtol=1e-4, atol=1e-3)
+
+def test_conv2d_weights_updated():
+    with Driver() as drv:
+        x = np.random.randn(1, 8, 8, 2).astype('float32')
+        w = np.random.randn(3, 3, 2, 4).astype('float32')
+        y = conv2d(drv, drv.copy(x), w, padding=1)
+        assert np.allclose(conv2d_ref(x, w, 1, 1), y, rtol=1e-4, atol=1e-3)
+        conv = _convs[drv][1, 1]
+        w *= 2
+        y = conv2d(drv, drv.copy(x), w, padding=1)
+        assert _convs[drv][1, 1] is conv
+        assert np.allclose(conv2d_ref(x, w, 1, 1), y, rtol=1e-4, atol=1e-3)
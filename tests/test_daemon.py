@@ -0,0 +1,138 @@
+'Test of QPU daemon'
+
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.assembler import qpu
+from videocore.driver import DriverError
+from videocore.daemon import QPUServer, Client, _HEADER, _recv
+
+class FakeVCSM(object):
+    'Stand-in of VCSM allocating host memory.'
+
+    def __init__(self):
+        self.busaddr = 0xc0000000
+
+    def malloc_cache(self, size, cache_mode, name):
+        busaddr = self.busaddr
+        self.busaddr += (size + 4095) // 4096 * 4096
+        return (1, busaddr, 0, mmap.mmap(-1, size))
+
+    def free(self, handle, buffer):
+        pass
+
+class FakeMailBox(object):
+    'Stand-in of MailBox recording launches.'
+
+    def __init__(self):
+        self.enabled = []
+        self.launches = []
+
+    def enable_qpu(self, enable):
+        self.enabled.append(enable)
+        return 0
+
+    def execute_qpu(self, n_threads, message, noflush, timeout):
+        self.launches.append(n_threads)
+        return 0
+
+@qpu
+def finish(asm):
+    exit()
+
+class Daemon(object):
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp()
+        self.mailbox = FakeMailBox()
+        self.server = QPUServer(os.path.join(self.dir, 'qpu.sock'),
+                                client_data_area_size = 4096,
+                                mailbox = self.mailbox, vcsm = FakeVCSM())
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.start()
+        while self.server.sock is None or not self.server.running:
+            pass
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+def test_arrays():
+    with Daemon() as d:
+        with Client(d.server.path) as client:
+            x = client.copy(np.arange(5, dtype='float32'))
+            y = client.alloc((2, 3), 'int32')
+            assert x.address % 16 == 0 and y.address % 16 == 0
+            assert y.address >= x.address + 20
+            client.write(y, [[1, 2, 3], [4, 5, 6]])
+            assert np.all(client.read(x) == np.arange(5))
+            assert np.all(client.read(y) == [[1, 2, 3], [4, 5, 6]])
+            assert_raises(DriverError, client.alloc, 8192, 'uint8')
+
+def test_execute():
+    with Daemon() as d:
+        with Client(d.server.path, name='a') as a:
+            with Client(d.server.path, name='b') as b:
+                prog = a.program(finish)
+                a.execute(2, prog, np.zeros((2, 3)))
+                a.execute(1, prog)
+                assert_raises(DriverError, b.execute, 1, prog)
+                assert_raises(DriverError, a.execute, 13, prog)
+                stats = b.stats()
+                assert [c['name'] for c in stats['clients']] == ['a', 'b']
+                assert [c['launches'] for c in stats['clients']] == [2, 0]
+        assert d.mailbox.launches == [2, 1]
+    assert d.mailbox.enabled == [1, 0]
+
+def test_invalid_requests():
+    with Daemon() as d:
+        with Client(d.server.path) as client:
+            prog = client.program(finish)
+            x = client.alloc(4, 'uint32')
+            for header in [
+                    {'op': 'execute', 'program': prog.id, 'n_threads': 0,
+                     'timeout': 1000},
+                    {'op': 'execute', 'program': prog.id, 'timeout': 1000},
+                    {'op': 'execute', 'program': -1, 'n_threads': 1,
+                     'timeout': 1000},
+                    {'op': 'read', 'handle': 'x', 'offset': 0, 'nbytes': 4},
+                    {'op': 'read', 'handle': -1, 'offset': 0, 'nbytes': 4},
+                    {'op': 'alloc'}]:
+                assert_raises(DriverError, client._call, header)
+            client.execute(1, prog)
+            assert client.read(x).shape == (4,)
+        assert d.mailbox.launches == [1]
+
+
+def test_uniforms_reused():
+    with Daemon() as d:
+        with Client(d.server.path) as client:
+            prog = client.program(finish)
+            for i in range(100):
+                client.execute(2, prog, np.zeros((2, 4)))
+            client.execute(1, prog, np.zeros(3))
+            pool = d.server.sessions[0].pool
+            assert len(pool.allocations['uniforms'][0]) == 1
+        assert len(d.mailbox.launches) == 101
+
+def test_malformed_messages():
+    with Daemon() as d:
+        with Client(d.server.path) as client:
+            for message in [
+                    _HEADER.pack(3, 0) + b'{x]',
+                    _HEADER.pack(2, 0) + b'[]',
+                    _HEADER.pack(2, 1 << 20) + b'{}' + b'\0' * (1 << 20),
+                    _HEADER.pack(1 << 20, 0) + b'\0' * (1 << 20)]:
+                client.sock.sendall(message)
+                (response, _) = _recv(client.sock)
+                assert 'error' in response
+            x = client.copy(np.arange(3, dtype='int32'))
+            assert np.all(client.read(x) == np.arange(3))
@@ -0,0 +1,102 @@
+'Test of QPU disassembler'
+
+from random import getrandbits
+from struct import pack
+
+from videocore.assembler import qpu, assemble, get_label_positions
+from videocore.disassembler import disassemble, load_source
+
+def round_trip(code, labels=None):
+    source = disassemble(code, labels)
+    assert assemble(load_source(source)) == code
+    return source
+
+@qpu
+def alu_ops(asm):
+    mov(ra0, uniform)
+    iadd(r0, r0, 1)
+    fsub(r1, r0, 2.0, set_flags=False, cond='zs')
+    itof(r2, ra0)
+    isub(null, r1, rb3, sig='thread switch')
+    fadd(ra1, r0, r1).fmul(rb1, r2, r3)
+    mov(r0, r1).mov(r2, r3, cond='nc')
+    imul24(r3, r1, 15)
+    nop()
+
+def test_alu_ops():
+    source = round_trip(assemble(alu_ops))
+    assert 'mov(ra0, uniform)' in source
+    assert 'iadd(r0, r0, 1)' in source
+    assert "fsub(r1, r0, 2.0, cond='zs', set_flags=False)" in source
+    assert 'fadd(ra1, r0, r1).fmul(rb1, r2, r3)' in source
+
+@qpu
+def pack_unpack(asm):
+    iadd(ra1.pack('16a'), r0, r1)
+    fadd(r0, ra1.unpack('16b'), rb1)
+    fmul(r0, r4.unpack('8a'), r1, pack='8b')
+    v8adds(ra2.pack('8c sat'), r0, r1).v8muld(rb2, r2, r3)
+
+def test_pack_unpack():
+    source = round_trip(assemble(pack_unpack))
+    assert "iadd(ra1.pack('16a'), r0, r1)" in source
+    assert "fmul(r0, r4.unpack('8a'), r1, pack='8b')" in source
+
+@qpu
+def rotations(asm):
+    rotate(r1, r0, 3)
+    rotate(r1, r0, r5)
+    iadd(r2, r2, -13).rotate(r1, r0, 3)
+
+def test_rotate():
+    source = round_trip(assemble(rotations))
+    assert 'rotate(r1, r0, 3)' in source
+    assert 'rotate(r1, r0, r5)' in source
+
+@qpu
+def loads(asm):
+    ldi(rb1, 0x12345678)
+    ldi(r1, [1, -2, 0, 1])
+    ldi(r1, ra2, [1, 2, 3])
+    ldi(null, 1.5, set_flags=True, cond='zs')
+    setup_dma_load(nrows=2)
+    sema_up(3)
+    sema_down(15)
+    raw(0xDEADBEEF, 0xFEEDFACE)
+
+def test_loads():
+    source = round_trip(assemble(loads))
+    assert 'ldi(r1, [1, -2, 0, 1])' in source
+    assert 'sema_down(15)' in source
+    assert 'raw(0xdeadbeef, 0xfeedface)' in source
+
+@qpu
+def branches(asm):
+    L.loop
+    isub(r0, r0, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+    jmp(reg=ra0, link=rb5)
+    nop(); nop(); nop()
+    jmp(-800)
+    jmp(8, absolute=True)
+    with namespace('ns'):
+        jmp(L.end)
+        nop(); nop(); nop()
+        L.end
+    exit()
+
+def test_branch_labels():
+    source = round_trip(assemble(branches))
+    assert source.startswith('L.L0\n')
+    assert 'jzc(L.L0)' in source
+    assert 'jmp(link=rb5, reg=ra0)' in source
+    assert 'jmp(-800)' in source
+
+    source = round_trip(assemble(branches), get_label_positions(branches))
+    assert source.startswith('L.loop\n')
+    assert "jmp(L['ns.end'])" in source
+
+def test_random_words():
+    code = b''.join(pack('<Q', getrandbits(64)) for i in range(1000))
+    round_trip(code)
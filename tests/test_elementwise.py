@@ -0,0 +1,74 @@
+'Test of elementwise kernels'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.assembler import AssembleError
+from videocore.driver import Driver
+from videocore.elementwise import ElementwiseKernel, Expression, partition
+
+def test_expression():
+    expr = Expression('a*x + y*(a*x)')
+    assert expr.names == ['a', 'x', 'y']
+    assert len(expr.nodes) == 6     # a*x is shared
+    assert_raises(AssembleError, Expression, 'x ** 2')
+    assert_raises(AssembleError, Expression, 'exp2(x)', 'int32')
+    assert_raises(AssembleError, Expression, 'max(x)')
+
+def test_partition():
+    for n in [1, 15, 16, 17, 1000, 12*16*3+5]:
+        n_threads, start, count = partition(n, 12)
+        assert count.sum() == n
+        assert np.all(start[1:] == start[:-1] + count[:-1])
+        assert np.all(count[:-1] % 16 == 0)
+    n_threads, start, count = partition(20, 12, unit=1)
+    assert n_threads == 12 and count.sum() == 20 and count.max() == 2
+
+def test_float32():
+    with Driver() as drv:
+        axpy = ElementwiseKernel(drv, 'a*x + y')
+        relu = ElementwiseKernel(drv, 'max(x, 0)')
+        for n in [1, 15, 16, 17, 1000, 12*16*3+5]:
+            X = drv.copy(np.random.randn(n).astype('float32'))
+            Y = drv.copy(np.random.randn(n).astype('float32'))
+            Z = axpy(a=2.0, x=X, y=Y)
+            assert np.allclose(2.0*X + Y, Z, rtol=1e-5, atol=1e-6)
+            Z = relu(x=X)
+            assert np.all(np.maximum(X, 0) == Z)
+
+def test_sfu():
+    with Driver() as drv:
+        f = ElementwiseKernel(drv, 'recip(x) + exp2(y) - log2(x)*3.0')
+        X = drv.copy(np.random.uniform(0.5, 2, 1234).astype('float32'))
+        Y = drv.copy(np.random.uniform(-1, 1, 1234).astype('float32'))
+        Z = f(x=X, y=Y)
+        assert np.allclose(1/X + np.exp2(Y) - 3*np.log2(X), Z, atol=5e-2)
+
+def test_int32():
+    with Driver() as drv:
+        f = ElementwiseKernel(drv, 'max(x, -y) * 3 + abs(x) - c', 'int32')
+        X = drv.copy(np.random.randint(-1000, 1000, 999).astype('int32'))
+        Y = drv.copy(np.random.randint(-1000, 1000, 999).astype('int32'))
+        out = drv.alloc(999, 'int32')
+        f(out=out, x=X, y=Y, c=100)
+        assert np.all(np.maximum(X, -Y)*3 + np.abs(X) - 100 == out)
+
+def test_tail_is_not_overwritten():
+    with Driver() as drv:
+        f = ElementwiseKernel(drv, 'x + 1.0')
+        X = drv.copy(np.zeros(37, dtype='float32'))
+        out = drv.alloc(37, 'float32')
+        guard = drv.copy(np.full(11, -1, dtype='float32'))  # next to out
+        f(out=out, x=X)
+        assert np.all(out == 1.0)
+        assert np.all(guard == -1.0)
+
+def test_output_reused():
+    with Driver() as drv:
+        f = ElementwiseKernel(drv, 'x + 1.0')
+        X = drv.copy(np.zeros(100, dtype='float32'))
+        Y = f(x=X)
+        Z = f(x=Y)          # the buffer of Y is not overwritten by Z
+        assert Z.address != Y.address
+        assert np.all(Y == 1.0) and np.all(Z == 2.0)
+        assert f(x=X).address == Y.address
@@ -0,0 +1,53 @@
+'Test of FFT'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.driver import Driver, DriverError
+from videocore.fft import FFT, bit_reverse, fft, ifft, passes
+
+def test_passes():
+    assert passes(16) == [(16, 1)]
+    assert passes(32) == [(2, 1), (16, 2)]
+    assert passes(4096) == [(16, 1), (16, 16), (16, 256)]
+    for n in [16, 64, 2048, 16384]:
+        assert np.prod([R for R, L in passes(n)]) == n
+
+def test_bit_reverse():
+    assert list(bit_reverse(np.arange(8), 3)) == [0, 4, 2, 6, 1, 5, 3, 7]
+
+def random_complex(*shape):
+    return (np.random.randn(*shape) +
+            1j * np.random.randn(*shape)).astype('complex64')
+
+def test_fft():
+    with Driver() as drv:
+        for n in [16, 32, 64, 128, 256, 1024, 4096]:
+            x = drv.copy(random_complex(5, n))
+            X = fft(drv, x)
+            assert np.allclose(np.fft.fft(x), X, atol=1e-4 * n)
+            assert np.allclose(x, ifft(drv, X), atol=1e-4)
+
+def test_batch_shape():
+    with Driver() as drv:
+        x = random_complex(2, 3, 64)
+        X = fft(drv, x)         # host arrays are copied to the device
+        assert X.shape == (2, 3, 64)
+        assert np.allclose(np.fft.fft(x), X, atol=1e-2)
+
+def test_invalid_length():
+    with Driver() as drv:
+        f = FFT(drv)
+        assert_raises(DriverError, f, random_complex(8))
+        assert_raises(DriverError, f, random_complex(48))
+
+def test_output_reused():
+    with Driver() as drv:
+        f = FFT(drv)
+        x = random_complex(3, 64)
+        X = f(x)
+        assert np.allclose(np.fft.fft(x), X, atol=1e-2)
+        Y = f(X, inverse=True)  # the buffer of X is not overwritten
+        assert Y.address != X.address
+        assert np.allclose(x, Y, atol=1e-4)
+        assert f(x).address == X.address
@@ -0,0 +1,64 @@
+'Test of tiled matrix multiplication'
+
+import numpy as np
+
+from videocore.driver import Driver
+from videocore.gemm import Sgemm, batched_sgemm, chunks, hgemm, pack_b, qgemm
+
+def test_chunks():
+    assert chunks(9) == (3, 1)
+    assert chunks(8) == (2, 4)
+    assert chunks(1) == (1, 1)
+
+def test_pack_b():
+    B = np.random.randn(5, 20).astype('float32')
+    packed = pack_b(B)
+    assert packed.shape == (2, 5, 16)
+    assert np.all(packed[0] == B[:, :16])
+    assert np.all(packed[1, :, :4] == B[:, 16:])
+    assert np.all(packed[1, :, 4:] == 0)
+
+def test_sgemm():
+    with Driver() as drv:
+        sgemm = Sgemm(drv)
+        for m, k, n in [(1, 1, 1), (16, 16, 16), (17, 5, 33), (100, 77, 45)]:
+            A = drv.copy(np.random.randn(m, k).astype('float32'))
+            B = drv.copy(np.random.randn(k, n).astype('float32'))
+            C = sgemm(A, B)
+            assert np.allclose(np.dot(A, B), C, rtol=1e-4, atol=1e-4)
+
+def test_sgemm_programs():
+    with Driver() as drv:
+        sgemm = Sgemm(drv)
+        for k in [4, 40, 2000]:
+            A = drv.copy(np.random.randn(20, k).astype('float32'))
+            B = drv.copy(np.random.randn(k, 20).astype('float32'))
+            C = sgemm(A, B)
+            assert np.allclose(np.dot(A, B), C, rtol=1e-3, atol=1e-3)
+        assert len(sgemm._programs) == 1
+
+def test_batched_sgemm():
+    with Driver() as drv:
+        for N, m, k, n in [(1, 16, 16, 16), (100, 16, 16, 16), (37, 20, 64, 33)]:
+            A = drv.copy(np.random.randn(N, m, k).astype('float32'))
+            B = drv.copy(np.random.randn(N, k, n).astype('float32'))
+            C = batched_sgemm(drv, A, B)
+            assert C.shape == (N, m, n)
+            assert np.allclose(np.matmul(A, B), C, rtol=1e-4, atol=1e-4)
+
+def test_hgemm():
+    with Driver() as drv:
+        A = drv.copy(np.random.randn(50, 38).astype('float16'))
+        B = drv.copy(np.random.randn(38, 21).astype('float32'))
+        C = hgemm(drv, A, B)
+        assert C.dtype == np.float32
+        assert np.allclose(np.dot(A.astype('float32'), B), C,
+                           rtol=1e-4, atol=1e-4)
+
+def test_qgemm():
+    with Driver() as drv:
+        A = drv.copy(np.random.randint(0, 256, (40, 36)).astype('uint8'))
+        B = drv.copy(np.random.randint(-128, 128, (36, 18)).astype('int8'))
+        C = qgemm(drv, A, B)
+        assert C.dtype == np.int32
+        assert np.all(np.dot(A.astype('int32'), B.astype('int32')) == C)
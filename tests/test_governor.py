@@ -0,0 +1,98 @@
+'Test of clock and thermal governor'
+
+from videocore.assembler import qpu
+from videocore.driver import Driver
+from videocore.mailbox import MailBox
+from videocore.governor import Governor, THROTTLED_SOFT_TEMP, estimate_power
+
+class FakeMailBox(object):
+    """Stand-in of MailBox whose temperature rises with clock rates.
+
+    The temperature is 40 degree Celsius plus 0.1 degree per MHz of V3D and
+    0.02 degree per MHz of core clock.
+    """
+
+    def __init__(self, v3d=500000000, core=500000000):
+        self.rates = {MailBox.CLOCK_V3D: v3d, MailBox.CLOCK_CORE: core}
+        self.set_calls = []
+        self.batches = 0
+
+    def batch(self, *requests):
+        self.batches += 1
+        return [getattr(self, r[0])(*r[1:]) for r in requests]
+
+    def temperature(self):
+        return (40 + 0.1 * self.rates[MailBox.CLOCK_V3D] / 1e6 +
+                0.02 * self.rates[MailBox.CLOCK_CORE] / 1e6)
+
+    def get_temperature(self, id):
+        return (id, int(self.temperature() * 1000))
+
+    def get_throttled(self):
+        return THROTTLED_SOFT_TEMP if self.temperature() > 80 else 0
+
+    def get_clock_rate(self, clock):
+        return (clock, self.rates[clock])
+
+    def get_min_clock_rate(self, clock):
+        return (clock, 250000000)
+
+    def get_max_clock_rate(self, clock):
+        return (clock, 500000000)
+
+    def get_voltage(self, id):
+        return (id, 1200000)
+
+    def set_clock_rate(self, clock, rate, skip_turbo):
+        self.set_calls.append((clock, rate))
+        self.rates[clock] = rate
+        return (clock, rate)
+
+def test_adjust():
+    mb = FakeMailBox()
+    governor = Governor(mb, target=70.0, interval=0)
+    assert governor.last.temperature == 100.0
+    assert governor.adjust(governor.sample())
+    assert mb.rates[MailBox.CLOCK_V3D] == 475000000
+    mb = FakeMailBox(v3d=250000000, core=250000000)
+    governor = Governor(mb, target=80.0, interval=0)
+    assert governor.adjust(governor.sample())
+    assert mb.rates[MailBox.CLOCK_V3D] == 275000000
+    mb = FakeMailBox(v3d=250000000, core=250000000)
+    governor = Governor(mb, target=70.0, interval=0)
+    assert not governor.adjust(governor.sample())
+    assert not mb.set_calls
+
+def test_converge():
+    mb = FakeMailBox()
+    governor = Governor(mb, target=75.0, interval=0, history=10)
+    for i in range(30):
+        assert governor.launch(lambda: i, work=1000) == i
+    assert abs(mb.temperature() - governor.target) <= 5.0
+    assert len(governor.telemetry) == 10
+    assert mb.batches == 32     # limits, first sample and 30 windows
+    telemetry = governor.telemetry[-1]
+    assert telemetry.launches == 1
+    assert telemetry.work == 1000
+    assert telemetry.power == estimate_power(mb.rates, 1.2)
+    assert telemetry.throughput_per_watt > 0
+
+def test_window():
+    governor = Governor(FakeMailBox(), interval=3600)
+    for i in range(5):
+        governor.launch(lambda: None, work=10)
+    assert not governor.telemetry
+    telemetry = governor.close_window()
+    assert telemetry.launches == 5
+    assert telemetry.work == 50
+
+@qpu
+def finish(asm):
+    exit()
+
+def test_driver():
+    with MailBox() as mb:
+        governor = Governor(mb, interval=0)
+        with Driver(governor=governor) as drv:
+            drv.execute(1, drv.program(finish), work=1)
+        assert governor.telemetry[-1].launches == 1
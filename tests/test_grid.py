@@ -0,0 +1,114 @@
+'Test of grid partitioning'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.assembler import qpu
+from videocore.driver import Driver, DriverError
+from videocore.grid import Grid, init_counter, next_tile, finish_counter
+
+def test_tiles():
+    grid = Grid((100, 70), (16, 32))
+    assert grid.counts == (7, 3)
+    assert grid.size == 21
+    tiles = grid.tiles()
+    assert np.all(tiles[0] == [[0, 0], [16, 32]])
+    assert np.all(tiles[-1] == [[96, 64], [4, 6]])
+    assert np.prod(tiles[:, 1], axis=1).sum() == 100 * 70
+    assert_raises(DriverError, Grid, (1, 2, 3, 4), (1, 1, 1, 1))
+    assert_raises(DriverError, Grid, (10, 10), (0, 1))
+
+def test_partition():
+    grid = Grid((100, 70), (16, 32))
+    for max_threads in [1, 5, 12, 30]:
+        n_threads, start, count = grid.partition(max_threads)
+        assert n_threads == min(max_threads, grid.size)
+        assert np.all(count > 0)
+        assert np.all(start == np.concatenate([[0], np.cumsum(count)[:-1]]))
+        assert count.sum() == grid.size
+    # Threads get 1024 elements at most, which is optimal.
+    n_threads, start, count = grid.partition(12)
+    cost = np.prod(grid.tiles()[:, 1], axis=1)
+    assert max(cost[s:s+c].sum() for s, c in zip(start, count)) == 1024
+
+def test_partition_unit():
+    grid = Grid((3, 4, 5), (2, 2, 2), unit=3)
+    n_threads, start, count = grid.partition(7)
+    assert n_threads == 4
+    assert np.all(start % 3 == 0)
+    assert count.sum() == grid.size
+
+def test_partition_cost():
+    cost = np.ones(10)
+    cost[0] = 100
+    n_threads, start, count = Grid(10, 1).partition(3, cost)
+    assert list(count) == [1, 1, 8]
+
+def test_uniforms():
+    grid = Grid(100, 10)
+    n_threads, uniforms = grid.uniforms(4, 7, np.arange(4))
+    assert n_threads == 4
+    assert list(uniforms[:, 1]) == [3, 2, 3, 2]
+    assert list(uniforms[:, 2]) == [0, 1, 2, 3]
+    assert np.all(uniforms[:, 3:] == [[4, 7, 0], [4, 7, 1], [4, 7, 2],
+                                      [4, 7, 3]])
+    n_threads, uniforms = grid.uniforms(12, dynamic=True)
+    assert n_threads == 10
+    assert np.all(uniforms[:, :2] == [0, 10])
+
+@qpu
+def claim_tiles(asm):
+    """Write the thread index to rows of claimed tiles."""
+    COMPLETED = 0
+    mov(ra1, uniform)       # unused start tile
+    mov(ra1, uniform)       # number of tiles
+    mov(ra2, uniform)       # thread index
+    mov(ra3, uniform)       # number of threads
+    mov(ra4, uniform)       # output address
+    ldi(r0, 0x1a00)         # setup_vpm_write(Y=thread)
+    bor(rb5, r0, ra2)
+    shl(r1, ra2, 7)
+    ldi(r0, 0x80904000)     # setup_dma_store(nrows=1, Y=thread)
+    bor(rb6, r0, r1)
+    init_counter(asm, ra2)
+
+    L.loop
+    next_tile(asm, r1)
+    isub(null, r1, ra1)
+    jnc(L.done)
+    shl(r1, r1, 6)          # delay slot
+    iadd(r1, r1, ra4)       # delay slot
+    nop()                   # delay slot
+    mov(vpmvcd_wr_setup, rb5)
+    mov(vpm, ra2)
+    mov(vpmvcd_wr_setup, rb6)
+    start_dma_store(r1)
+    wait_dma_store()
+    jmp(L.loop)
+    nop(); nop(); nop()
+
+    L.done
+    sema_up(COMPLETED)
+    mov(null, ra2, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+    mov(r0, ra3)
+    L.sem_down
+    sema_down(COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    finish_counter(asm)
+    interrupt()
+    L.skip_fin
+    exit(interrupt=False)
+
+def test_dynamic():
+    with Driver() as drv:
+        grid = Grid(200, 1)
+        out = drv.alloc((grid.size, 16), 'uint32')
+        out[:] = 0xffffffff
+        n_threads, uniforms = grid.uniforms(12, out.address, dynamic=True)
+        drv.execute(n_threads, drv.program(claim_tiles), uniforms)
+        assert np.all(out < n_threads)
+        assert np.all(out == out[:, :1])
@@ -0,0 +1,95 @@
+'Test of image processing'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.driver import Driver, DriverError
+from videocore.image import (yuv420_to_rgba, downscale2x, gaussian_blur,
+                             dilate, erode, gaussian_weights, ImageProcessor)
+
+def random_image(drv, h, w, c=4):
+    return drv.copy(np.random.randint(0, 256, (h, w, c)).astype('uint8'))
+
+def separable_ref(x, weights, op):
+    'Filter rows then columns of ``x``, clamping taps to edges.'
+    r = len(weights) // 2
+    x = x.astype('float64')
+    for axis in [1, 0]:
+        index = np.arange(x.shape[axis])
+        taps = [np.take(x, np.clip(index + t - r, 0, x.shape[axis] - 1),
+                        axis=axis) for t in range(len(weights))]
+        if op == 'conv':
+            x = np.clip(np.round(sum(w * t for w, t in zip(weights, taps))),
+                        0, 255)
+        else:
+            x = getattr(np, op).reduce(taps)
+    return x
+
+def test_gaussian_weights():
+    w = gaussian_weights(1.0)
+    assert len(w) == 7
+    assert np.isclose(w.sum(), 1)
+    assert np.allclose(w, w[::-1])
+    assert len(gaussian_weights(10.0)) == 15
+
+def test_yuv420_to_rgba():
+    with Driver() as drv:
+        h, w = 18, 136
+        y = drv.copy(np.random.randint(0, 256, (h, w)).astype('uint8'))
+        u = drv.copy(np.random.randint(0, 256, (h//2, w//2)).astype('uint8'))
+        v = drv.copy(np.random.randint(0, 256, (h//2, w//2)).astype('uint8'))
+        rgba = yuv420_to_rgba(drv, y, u, v)
+        Y = y.astype('float64')
+        U = np.repeat(np.repeat(u, 2, 0), 2, 1) - 128.0
+        V = np.repeat(np.repeat(v, 2, 0), 2, 1) - 128.0
+        ref = np.stack([Y + 1.402 * V,
+                        Y - 0.344136 * U - 0.714136 * V,
+                        Y + 1.772 * U], axis=-1)
+        assert rgba.shape == (h, w, 4)
+        assert np.abs(rgba[..., :3] - np.clip(ref, 0, 255)).max() <= 1
+        assert np.all(rgba[..., 3] == 255)
+
+def test_downscale2x():
+    with Driver() as drv:
+        img = random_image(drv, 20, 70)
+        small = downscale2x(drv, img)
+        ref = img.astype('float64').reshape(10, 2, 35, 2, 4).mean(axis=(1, 3))
+        assert small.shape == (10, 35, 4)
+        assert np.abs(small - ref).max() <= 1
+
+def test_filters():
+    with Driver() as drv:
+        img = random_image(drv, 23, 41)
+        out = gaussian_blur(drv, img, sigma=1.0)
+        ref = separable_ref(img, gaussian_weights(1.0), 'conv')
+        assert np.abs(out - ref).max() <= 2
+        assert np.all(dilate(drv, img, 2) == separable_ref(img, [0] * 5, 'max'))
+        assert np.all(erode(drv, img) == separable_ref(img, [0] * 3, 'min'))
+
+def test_filter_programs():
+    with Driver() as drv:
+        proc = ImageProcessor(drv)
+        for sigma, (h, w) in [(0.5, (9, 20)), (1.0, (17, 40)), (2.0, (9, 33))]:
+            img = random_image(drv, h, w)
+            weights = gaussian_weights(sigma, radius=2)
+            out = proc.separable_filter(img, weights)
+            assert np.abs(out - separable_ref(img, weights, 'conv')).max() <= 2
+            proc.downscale2x(random_image(drv, 4, 2 * w))
+        assert len(proc._programs) == 3
+
+def test_output_reused():
+    with Driver() as drv:
+        img = random_image(drv, 16, 32)
+        once = gaussian_blur(drv, img, sigma=1.0)
+        ref = separable_ref(once, gaussian_weights(1.0), 'conv')
+        twice = gaussian_blur(drv, once, sigma=1.0)
+        assert twice.address != once.address
+        assert np.abs(twice - ref).max() <= 2
+        assert gaussian_blur(drv, img, sigma=1.0).address == once.address
+
+def test_invalid_image():
+    with Driver() as drv:
+        assert_raises(DriverError, downscale2x, drv, random_image(drv, 3, 4))
+        assert_raises(DriverError, downscale2x, drv, random_image(drv, 4, 4, 3))
+        assert_raises(DriverError, downscale2x, drv,
+                      np.zeros((4, 4, 4), 'uint8'))
@@ -0,0 +1,107 @@
+'Test of mailbox property interface'
+
+from struct import pack_into, unpack_from
+
+from nose.tools import assert_raises
+
+import videocore.mailbox
+from videocore.mailbox import MailBox, MailBoxException
+
+class FakeFirmware(object):
+    """Stand-in of ioctl of /dev/vcio answering property tags.
+
+    ``responses`` maps tags to packed response values.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+
+    def __call__(self, fd, request, buf, mutate):
+        self.calls += 1
+        size, code = unpack_from('=2L', buf, 0)
+        assert size <= len(buf) and code == 0
+        pos = 8
+        while True:
+            tag, = unpack_from('=L', buf, pos)
+            if tag == 0:
+                break
+            tag_size, = unpack_from('=L', buf, pos + 4)
+            value = self.responses[tag]
+            assert len(value) <= tag_size
+            pack_into('=L', buf, pos + 8, 0x80000000 | len(value))
+            pack_into('={}s'.format(len(value)), buf, pos + 12, value)
+            pos += 12 + tag_size
+        assert pos + 4 == size
+        pack_into('=L', buf, 4, 0x80000000)
+        return 0
+
+def fake_mailbox(responses):
+    mb = MailBox.__new__(MailBox)
+    mb.fd = None
+    mb._init_buffer()
+    firmware = FakeFirmware(responses)
+    videocore.mailbox.ioctl = firmware
+    return mb, firmware
+
+def words(*values):
+    buf = bytearray(4 * len(values))
+    pack_into('={}L'.format(len(values)), buf, 0, *values)
+    return bytes(buf)
+
+RESPONSES = {
+    0x00000001: words(0x5a0b5a0b),                  # firmware revision
+    0x00010005: words(0, 0x3b000000),               # arm memory
+    0x00010006: words(0x3b000000, 0x05000000),      # vc memory
+    0x00030002: words(5, 250000000),                # clock rate
+    0x00030006: words(0, 48312),                    # temperature
+    0x00030046: words(0x50000),                     # throttled
+    0x00010007: words(0, 1, 0, 3, 3, 5),            # clocks
+    0x00050001: b'console=tty1 root=/dev/mmcblk0p2\0', # command line
+    0x0004800b: words(0),                           # set palette
+    }
+
+def test_simple_call():
+    ioctl = videocore.mailbox.ioctl
+    try:
+        mb, firmware = fake_mailbox(RESPONSES)
+        assert mb.get_firmware_revision() == 0x5a0b5a0b
+        assert mb.get_temperature(0) == (0, 48312)
+        assert firmware.calls == 2
+    finally:
+        videocore.mailbox.ioctl = ioctl
+
+def test_batch():
+    ioctl = videocore.mailbox.ioctl
+    try:
+        mb, firmware = fake_mailbox(RESPONSES)
+        r = mb.batch(('get_temperature', 0), ('get_throttled',),
+                     ('get_vc_memory',))
+        assert r == [(0, 48312), 0x50000, (0x3b000000, 0x05000000)]
+        assert firmware.calls == 1
+        status = mb.get_status()
+        assert firmware.calls == 2
+        assert status['temperature'] == 48.312
+        assert status['v3d_clock'] == 250000000
+        assert status['arm_memory'] == (0, 0x3b000000)
+        assert_raises(MailBoxException, mb.batch, ('get_clocks',))
+        assert_raises(MailBoxException, mb.batch,
+                      *[('get_edid_block', 0)] * 8)
+    finally:
+        videocore.mailbox.ioctl = ioctl
+
+def test_variable_call():
+    ioctl = videocore.mailbox.ioctl
+    try:
+        mb, firmware = fake_mailbox(RESPONSES)
+        buf = mb._buf
+        assert mb.get_clocks() == [(0, 1), (0, 3), (3, 5)]
+        assert mb.get_command_line() == b'console=tty1 root=/dev/mmcblk0p2'
+        assert mb.set_palette(0, 2, [0xff0000, 0x00ff00]) == 0
+        assert unpack_from('=5L', buf, 8) == (0x0004800b, 16, 0x80000004,
+                                              0, 2)
+        assert_raises(MailBoxException, mb.set_palette, 0, 3, [0])
+        assert mb._buf is buf
+        assert firmware.calls == 3
+    finally:
+        videocore.mailbox.ioctl = ioctl
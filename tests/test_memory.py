@@ -1,5 +1,10 @@
 'Test of memory allocation'
 
+import os
+import shutil
+import tempfile
+import threading
+
 import numpy as np
 from nose.tools import assert_raises
 from videocore.assembler import qpu, assemble
@@ -34,3 +39,50 @@ def test_too_large_code():
         code_one_nop = assemble(one_nop)
         code = code_one_nop * (DEFAULT_CODE_AREA_SIZE // 8 + 1)
         assert_raises(DriverError, drv.program, code)
+
+def test_from_file():
+    with Driver() as drv:
+        w = np.random.randn(3, 5).astype('float32')
+        d = tempfile.mkdtemp()
+        try:
+            np.save(os.path.join(d, 'w.npy'), w)
+            w.tofile(os.path.join(d, 'w.bin'))
+            a = drv.from_file(os.path.join(d, 'w.npy'))
+            assert a.shape == (3, 5) and np.all(a == w)
+            b = drv.from_file(os.path.join(d, 'w.bin'), 'float32', (5,),
+                              offset = 20)
+            assert np.all(b == w[1])
+            assert drv.from_file(os.path.join(d, 'w.bin'),
+                                 'float32').shape == (15,)
+            assert_raises(DriverError, drv.from_file,
+                          os.path.join(d, 'w.bin'), 'float32', 16)
+        finally:
+            shutil.rmtree(d)
+
+@qpu
+def store_uniform(asm):
+    mov(r0, uniform)
+    setup_vpm_write()
+    mov(vpm, r0)
+    setup_dma_store(nrows=1)
+    start_dma_store(uniform)
+    wait_dma_store()
+    exit()
+
+def test_threads():
+    with Driver(thread_safe = True) as drv:
+        prog = drv.program(store_uniform)
+        results = {}
+        def run(i):
+            outs = [drv.alloc(16, 'uint32') for j in range(20)]
+            for (j, out) in enumerate(outs):
+                drv.execute(1, prog, [100 * i + j, out.address])
+            results[i] = [int(out[0]) for out in outs]
+        threads = [threading.Thread(target = run, args = (i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            assert results[i] == [100 * i + j for j in range(20)]
@@ -0,0 +1,50 @@
+'Test of persistent threads'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.assembler import qpu, assemble
+from videocore.driver import Driver, DriverError
+from videocore.persistent import (PersistentLauncher, persistent_kernel,
+                                  persistent_uniforms)
+
+def test_persistent_uniforms():
+    n_threads, uniforms = persistent_uniforms(100, 12, 0x1000, 8)
+    assert n_threads == 12
+    assert uniforms[:, 1].sum() == 100
+    assert np.all(uniforms[:, 2] == np.arange(12))
+    assert np.all(uniforms[:, 4:] == [0x1000, 8])
+    n_threads, uniforms = persistent_uniforms(5, 12, 0x1000, 8, dynamic=True)
+    assert n_threads == 5
+    assert np.all(uniforms[:, :2] == [0, 5])
+
+@qpu
+def store_id(asm):
+    ldi(r0, 0x1a00)         # setup_vpm_write(Y=thread)
+    bor(vpmvcd_wr_setup, r0, ra29)
+    shl(r1, ra29, 7)
+    ldi(r0, 0x80904000)     # setup_dma_store(nrows=1, Y=thread)
+    mov(vpm, ra31)
+    bor(vpmvcd_wr_setup, r0, r1)
+    start_dma_store(uniform)
+    wait_dma_store()
+
+def test_assemble():
+    for dynamic in [False, True]:
+        assemble(persistent_kernel, store_id, dynamic=dynamic,
+                 sanity_check=True)
+
+def test_persistent():
+    with Driver() as drv:
+        n_items = 300
+        out = drv.alloc((n_items, 16), 'uint32')
+        addresses = out.address + 64 * np.arange(n_items)
+        for dynamic in [False, True]:
+            out[:] = 0xffffffff
+            launcher = PersistentLauncher(drv, store_id, dynamic=dynamic,
+                                          max_items=n_items)
+            launcher(addresses)
+            assert np.all(out == np.arange(n_items)[:, np.newaxis])
+        assert_raises(DriverError, launcher, [])
+        assert_raises(DriverError, launcher, np.arange(n_items + 1))
+        assert_raises(DriverError, launcher, np.zeros((1, 2)))
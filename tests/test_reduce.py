@@ -0,0 +1,58 @@
+'Test of parallel reductions'
+
+import threading
+
+import numpy as np
+
+from videocore.driver import Driver
+from videocore import reduce
+
+LENGTHS = [1, 15, 16, 17, 1000, 12*16*3+5, 100000]
+
+def test_float32():
+    with Driver() as drv:
+        for n in LENGTHS:
+            x = np.random.randn(n).astype('float32')
+            y = np.random.randn(n).astype('float32')
+            X = drv.copy(x)
+            Y = drv.copy(y)
+            assert np.isclose(reduce.sum(drv, X), np.sum(x, dtype='float64'),
+                              rtol=1e-4, atol=1e-3)
+            assert reduce.max(drv, X) == np.max(x)
+            assert reduce.argmax(drv, X) == np.argmax(x)
+            assert np.isclose(reduce.dot(drv, X, Y), np.dot(x, y),
+                              rtol=1e-4, atol=1e-3)
+
+def test_int32():
+    with Driver() as drv:
+        for n in LENGTHS:
+            x = np.random.randint(-1000, 1000, n).astype('int32')
+            y = np.random.randint(-1000, 1000, n).astype('int32')
+            X = drv.copy(x)
+            Y = drv.copy(y)
+            assert reduce.sum(drv, X) == np.sum(x, dtype='int32')
+            assert reduce.max(drv, X) == np.max(x)
+            assert reduce.argmax(drv, X) == np.argmax(x)
+            assert reduce.dot(drv, X, Y) == np.dot(x, y)
+
+def test_argmax_ties():
+    with Driver() as drv:
+        x = np.zeros(1000, dtype='float32')
+        x[[123, 456, 789]] = 1.0
+        assert reduce.argmax(drv, drv.copy(x)) == 123
+        assert reduce.argmax(drv, drv.copy(np.zeros(37, 'int32'))) == 0
+
+def test_threads():
+    with Driver(thread_safe=True) as drv:
+        xs = [drv.copy(np.arange(1000, dtype='int32') * (i + 1))
+              for i in range(4)]
+        results = {}
+        def run(i):
+            results[i] = [int(reduce.sum(drv, xs[i])) for _ in range(20)]
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            assert results[i] == [499500 * (i + 1)] * 20
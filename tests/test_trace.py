@@ -0,0 +1,57 @@
+'Test of tracing of driver operations'
+
+import io
+import json
+
+import numpy as np
+
+from videocore.assembler import qpu
+from videocore.driver import Driver
+from videocore.trace import Tracer
+
+def test_record():
+    tracer = Tracer(max_events=3)
+    t = tracer.now()
+    t = tracer.record('first', t, bytes=16)
+    with tracer.span('second', n_threads=12) as args:
+        args['extra'] = 1
+    events = tracer.to_chrome()['traceEvents']
+    assert [e['name'] for e in events] == ['first', 'second']
+    assert events[0]['ph'] == 'X'
+    assert events[0]['args'] == {'bytes': 16}
+    assert events[1]['args'] == {'n_threads': 12, 'extra': 1}
+    assert events[0]['ts'] + events[0]['dur'] <= events[1]['ts'] + 1e-3
+    for i in range(3):
+        tracer.record('third', tracer.now())
+    assert len(tracer.events) == 3
+    assert tracer.totals()['third'][0] == 3
+    tracer.clear()
+    assert not tracer.events
+
+def test_save():
+    tracer = Tracer()
+    with tracer.span('span'):
+        pass
+    f = io.StringIO()
+    tracer.save(f)
+    trace = json.loads(f.getvalue())
+    assert trace['traceEvents'][0]['name'] == 'span'
+
+@qpu
+def finish(asm):
+    exit()
+
+def test_driver():
+    tracer = Tracer()
+    with Driver(tracer=tracer) as drv:
+        x = drv.array(np.zeros(16, dtype='float32'))
+        program = drv.program(finish)
+        drv.execute(1, program, [x.address])
+    names = [e['name'] for e in tracer.events]
+    for name in ['array', 'assemble', 'upload', 'program', 'stage_uniforms',
+                 'lock_wait', 'message', 'execute_qpu', 'execute']:
+        assert name in names
+    program_event = tracer.events[names.index('program')]
+    assert program_event['args'] == {'kernel': 'finish',
+                                     'bytes': program.size}
+    assert tracer.events[names.index('execute')]['args']['n_threads'] == 1
@@ -0,0 +1,123 @@
+'Test of dynamic work queues'
+
+import numpy as np
+from nose.tools import assert_raises
+
+from videocore.assembler import qpu, assemble, AssembleError
+from videocore.driver import Driver, DriverError
+from videocore.workqueue import (WorkQueue, chunk_size, init_queue, pop_work,
+                                 take_work, finish_queue)
+
+def test_chunk_size():
+    assert chunk_size(1000, 12) == 21
+    assert chunk_size(1000, 12, chunks_per_thread=1) == 84
+    assert chunk_size(1000, 12, min_grain=16) == 32
+    assert chunk_size(5, 12) == 1
+    assert chunk_size(0, 12) == 1
+    assert_raises(DriverError, chunk_size, 10, 0)
+
+def test_work_queue():
+    queue = WorkQueue(1000, 12, index=1)
+    assert queue.grain == 21
+    assert queue.n_chunks == 48
+    assert queue.macro_args == {'sem': 14, 'row': 62}
+    assert np.all(queue.uniforms() == [1000, 21])
+    assert WorkQueue(1000, 12, grain=100).n_chunks == 10
+    assert_raises(DriverError, WorkQueue, 1000, 12, index=4)
+    assert_raises(DriverError, WorkQueue, 1000, 12, grain=0)
+
+@qpu
+def pop_to_regfile(asm):
+    pop_work(asm, ra0, r1, ra1)
+
+@qpu
+def pop_large_grain(asm):
+    pop_work(asm, r0, r1, ra1, 16)
+
+@qpu
+def numpy_integers(asm, start, grain):
+    init_queue(asm, ra0, start)
+    pop_work(asm, r0, r1, ra1, grain)
+
+def test_pop_errors():
+    assert_raises(AssembleError, assemble, pop_to_regfile)
+    assert_raises(AssembleError, assemble, pop_large_grain)
+    assert_raises(AssembleError, assemble, numpy_integers, 0, np.int64(16))
+
+def test_numpy_integers():
+    assert (assemble(numpy_integers, np.int64(100), np.int32(4)) ==
+            assemble(numpy_integers, 100, 4))
+
+@qpu
+def claim_items(asm, queue):
+    """Write the thread index to rows of claimed items."""
+    COMPLETED = 0
+    mov(ra0, uniform)       # thread index
+    mov(ra1, uniform)       # number of threads
+    mov(ra2, uniform)       # number of items
+    mov(rb2, uniform)       # grain
+    mov(ra3, uniform)       # output address
+    ldi(r0, 0x1a00)         # setup_vpm_write(Y=thread)
+    bor(rb5, r0, ra0)
+    shl(r1, ra0, 7)
+    ldi(r0, 0x80904000)     # setup_dma_store(nrows=1, Y=thread)
+    bor(rb6, r0, r1)
+    ldi(rb7, 64)            # bytes of a row
+    init_queue(asm, ra0, **queue.macro_args)
+
+    L.loop
+    pop_work(asm, r1, r2, ra2, rb2, **queue.macro_args)
+    jnc(L.done)
+    shl(r1, r1, 6)          # delay slot
+    iadd(r1, r1, ra3)       # delay slot
+    nop()                   # delay slot
+    L.item
+    mov(vpmvcd_wr_setup, rb5)
+    mov(vpm, ra0)
+    mov(vpmvcd_wr_setup, rb6)
+    start_dma_store(r1)
+    wait_dma_store()
+    isub(r2, r2, 1)
+    jzc(L.item)
+    iadd(r1, r1, rb7)       # delay slot
+    nop()                   # delay slot
+    nop()                   # delay slot
+    jmp(L.loop)
+    nop(); nop(); nop()
+
+    L.done
+    sema_up(COMPLETED)
+    mov(null, ra0, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+    mov(r0, ra1)
+    L.sem_down
+    sema_down(COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    finish_queue(asm, queue.sem)
+    interrupt()
+    L.skip_fin
+    exit(interrupt=False)
+
+def test_pop_work():
+    with Driver() as drv:
+        n_threads = 12
+        queue = WorkQueue(301, n_threads, index=2)
+        out = drv.alloc((queue.size + 1, 16), 'uint32')
+        out[:] = 0xffffffff
+        uniforms = np.zeros((n_threads, 5), dtype='u4')
+        uniforms[:, 0] = np.arange(n_threads)
+        uniforms[:, 1] = n_threads
+        uniforms[:, 2:4] = queue.uniforms()
+        uniforms[:, 4] = out.address
+        drv.execute(n_threads, drv.program(claim_items, queue), uniforms)
+        assert np.all(out[:-1] < n_threads)
+        assert np.all(out[:-1] == out[:-1, :1])
+        assert np.all(out[-1] == 0xffffffff)
+        # Chunks are taken by single threads.
+        chunks = out[:-1:queue.grain, 0]
+        for k, thread in enumerate(chunks):
+            start = k * queue.grain
+            assert np.all(out[start:start+queue.grain, 0] == thread)
@@ -11,7 +11,8 @@ The QPU instruction set is described in the section 3 of the following document
 
 from __future__ import print_function
 import sys
-from functools import partial
+from functools import partial, wraps
+from collections import namedtuple
 from struct import pack, unpack
 import inspect
 import ast
@@ -24,11 +25,54 @@ from videocore.checker import check_main
 import videocore.encoding as enc
 from videocore.encoding import REGISTERS, Register, AssembleError
 
-class _partialmethod(partial):
-    'A descriptor for methods behaves like :py:class:`functools.partial.`'
+class _emittermethod(object):
+    """A descriptor for instructions of the DSL.
+
+    ``asm.iadd`` is bound to ``_emit`` method of an emitter with the op code of
+    ``iadd``.  The bound method is created at the first access and cached in
+    the instance, so that emitting an instruction does not create a new
+    :py:class:`functools.partial`.
+    """
+
+    def __init__(self, name, emitter, code):
+        self.name = name
+        self.emitter = emitter    # attribute name of emitter, None for self
+        self.code = code
+
     def __get__(self, obj, type):
-        return partial(self.func, obj,
-                       *(self.args or ()), **(self.keywords or {}))
+        if obj is None:
+            return self
+        emitter = getattr(obj, self.emitter) if self.emitter else obj
+        method = partial(emitter._emit, self.code)
+        obj.__dict__[self.name] = method
+        return method
+
+# Default arguments as tuples to append them to positional arguments.
+_ADD_DEFAULT_ARGS = {op: tuple(args)
+                     for op, args in enc._ADD_DEFAULT_ARGS.items()}
+_MUL_DEFAULT_ARGS = {op: tuple(args)
+                     for op, args in enc._MUL_DEFAULT_ARGS.items()}
+
+#============================ Read operand cache ==============================
+
+# The same combinations of read operands appear many times in unrolled loops.
+# Encoding of them is cached with keys made of ``Register.read_key`` and
+# ``repr`` of immediates.  The cache is cleared when it gets full.
+READ_OPERANDS_CACHE_SIZE = 4096
+_read_operands_cache = {}
+_read_operands_stats = [0, 0]    # hits, misses
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+
+def read_operands_cache_info():
+    'Return statistics of the read operand cache as ``CacheInfo``.'
+    hits, misses = _read_operands_stats
+    return CacheInfo(hits, misses, len(_read_operands_cache))
+
+def clear_read_operands_cache():
+    'Clear the read operand cache and its statistics.'
+    _read_operands_cache.clear()
+    _read_operands_stats[:] = [0, 0]
 
 #============================ Instruction emitter =============================
 
@@ -68,8 +112,33 @@ class Emitter(object):
             mul_a=REGISTERS['r0'], mul_b=REGISTERS['r0']):
         """Encode input muxes, raddr_a, raddr_b, unpack from given four source
         registers.
+
+        Results are memoised in ``_read_operands_cache``.  Operands which fail
+        to be encoded are not cached, so that the error is raised every time.
         """
 
+        key = (
+            add_a.read_key if isinstance(add_a, Register) else repr(add_a),
+            add_b.read_key if isinstance(add_b, Register) else repr(add_b),
+            mul_a.read_key if isinstance(mul_a, Register) else repr(mul_a),
+            mul_b.read_key if isinstance(mul_b, Register) else repr(mul_b),
+            )
+        try:
+            result = _read_operands_cache[key]
+            _read_operands_stats[0] += 1
+            return result
+        except KeyError:
+            pass
+        result = self._encode_read_operands_uncached(add_a, add_b, mul_a, mul_b)
+        _read_operands_stats[1] += 1
+        if len(_read_operands_cache) >= READ_OPERANDS_CACHE_SIZE:
+            _read_operands_cache.clear()
+        _read_operands_cache[key] = result
+        return result
+
+    def _encode_read_operands_uncached(self, add_a, add_b, mul_a, mul_b):
+        'Encode read operands.  See :py:meth:`_encode_read_operands`.'
+
         operands = [add_a, add_b, mul_a, mul_b]
         muxes = [None, None, None, None]
         unpack_bits = 0
@@ -96,7 +165,8 @@ class Emitter(object):
 
         if all(m is not None for m in muxes):
             null_addr = REGISTERS['null'].addr
-            return [muxes, null_addr, null_addr, False, unpack_bits, pm_bit]
+            return (tuple(muxes), null_addr, null_addr, False, unpack_bits,
+                    pm_bit)
 
         # Locate operands which have to be regfile B register.
         for i, opd in enumerate(operands):
@@ -168,14 +238,55 @@ class Emitter(object):
             raddr_b = REGISTERS['null'].addr
 
         use_small_imm = (small_imm is not None)
-        return [muxes, raddr_a, raddr_b, use_small_imm, unpack_bits, pm_bit]
+        return (tuple(muxes), raddr_a, raddr_b, use_small_imm, unpack_bits,
+                pm_bit)
+
+class _DualIssue(object):
+    """Result of an Add ALU instruction.
+
+    Mul ALU instruction can be chained to it for dual-issue like
+    ``iadd(r0, r0, r1).fmul(r2, r2, r3)``.  The object is bound to the program
+    counter after the Add ALU instruction, so chaining is allowed only
+    once and only before the next instruction is emitted.  A MulEmitter which
+    holds arguments of the Add ALU instruction is created only when chaining
+    is actually used, and shared by later instructions of the AddEmitter.
+    """
+
+    __slots__ = ['add', 'args', 'pc']
+
+    def __init__(self, add, args, pc):
+        self.add = add
+        self.args = args
+        self.pc = pc
+
+    def __getattr__(self, name):
+        # Other names must not consume the Add ALU instruction.
+        if name not in _MUL_METHODS:
+            raise AttributeError(
+                    '{!r} is not a Mul ALU instruction'.format(name))
+        add = self.add
+        if self.args is None or add.asm._program_counter != self.pc:
+            raise AssembleError('Mul ALU instruction must be chained to the '
+                                'last Add ALU instruction')
+        emitter = add._mul
+        if emitter is None:
+            emitter = add._mul = MulEmitter(add.asm, increment=False)
+        (emitter.op_add, emitter.add_dst, emitter.add_opd1, emitter.add_opd2,
+         emitter.cond_add, emitter.sig, emitter.set_flags) = self.args
+        self.args = None
+        return getattr(emitter, name)
 
 class AddEmitter(Emitter):
     'Emitter of Add ALU instructions.'
 
+    def __init__(self, asm):
+        super(AddEmitter, self).__init__(asm)
+        self._mul = None    # MulEmitter of chained Mul ALU instructions
+
     def _emit(self, op_add, *args, **kwargs):
-        l = enc._ADD_DEFAULT_ARGS.get(op_add, [])
-        args = list(args) + l
+        defaults = _ADD_DEFAULT_ARGS.get(op_add)
+        if defaults:
+            args += defaults
         return self._emit_with_defaults(op_add, *args, **kwargs)
 
     def _emit_with_defaults(self, op_add, dst, opd1, opd2, sig='no signal', set_flags=True, **kwargs):
@@ -210,25 +321,20 @@ class AddEmitter(Emitter):
         cond_add = enc._COND[cond_add_str]
         cond_mul = enc._COND['never']
 
-        insn = enc.AluInsn(
-                sig=sig_bits, unpack=unpack, pm=pm, pack=pack,
-                sf=set_flags, ws=write_swap, cond_add=cond_add,
-                cond_mul=cond_mul, op_add=op_add, op_mul=enc._MUL_INSN['nop'],
-                waddr_add=waddr_add, waddr_mul=waddr_mul, raddr_a=raddr_a,
-                raddr_b=raddr_b, add_a=muxes[0], add_b=muxes[1],
-                mul_a=muxes[2], mul_b=muxes[3]
+        word = enc.alu_word(
+                sig_bits, unpack, pm, pack, cond_add, cond_mul, set_flags,
+                write_swap, waddr_add, waddr_mul, op_add, enc._MUL_INSN['nop'],
+                raddr_a, raddr_b, muxes[0], muxes[1], muxes[2], muxes[3]
                 )
 
+        verbose = None
         if self.asm.sanity_check:
-            insn.verbose = AddInstr(enc._ADD_INSN_REV[op_add], dst, opd1, opd2, sig, set_flags, cond_add_str)
-        self.asm._emit(insn)
+            verbose = AddInstr(enc._ADD_INSN_REV[op_add], dst, opd1, opd2, sig, set_flags, cond_add_str)
+        self.asm._emit_word(word, enc.KIND_ALU, verbose)
 
-        # Create MulEmitter which holds arguments of Add ALU for dual
-        # issuing.
-        return MulEmitter(
-                self.asm, op_add=op_add, add_dst=dst, add_opd1=opd1,
-                add_opd2=opd2, cond_add=cond_add, sig=sig, set_flags=set_flags,
-                increment=False)
+        # Hold arguments of Add ALU for dual issuing.
+        return _DualIssue(self, (op_add, dst, opd1, opd2, cond_add, sig,
+                                 set_flags), self.asm._program_counter)
 
 class MulEmitter(Emitter):
     """ Emitter of Mul ALU instructions.
@@ -251,8 +357,9 @@ class MulEmitter(Emitter):
         self.increment = increment
 
     def _emit(self, op_mul, *args, **kwargs):
-        l = enc._MUL_DEFAULT_ARGS.get(op_mul, [])
-        args = list(args) + l
+        defaults = _MUL_DEFAULT_ARGS.get(op_mul)
+        if defaults:
+            args += defaults
         return self._emit_with_defaults(op_mul, *args, **kwargs)
 
     def _emit_with_defaults(self, op_mul, mul_dst, mul_opd1, mul_opd2, rotate=0, pack='nop', **kwargs):
@@ -334,17 +441,16 @@ class MulEmitter(Emitter):
         cond_mul_str = kwargs.get('cond', 'always')
         cond_mul = enc._COND[cond_mul_str]
 
-        insn = enc.AluInsn(
-                sig=sig_bits, unpack=unpack, pm=pm, pack=pack,
-                sf=self.set_flags, ws=write_swap, cond_add=cond_add,
-                cond_mul=cond_mul, op_add=self.op_add, op_mul=op_mul,
-                waddr_add=waddr_add, waddr_mul=waddr_mul, raddr_a=raddr_a,
-                raddr_b=raddr_b, add_a=muxes[0], add_b=muxes[1],
-                mul_a=muxes[2], mul_b=muxes[3]
+        word = enc.alu_word(
+                sig_bits, unpack, pm, pack, cond_add, cond_mul, self.set_flags,
+                write_swap, waddr_add, waddr_mul, self.op_add, op_mul,
+                raddr_a, raddr_b, muxes[0], muxes[1], muxes[2], muxes[3]
                 )
+        verbose = None
         if self.asm.sanity_check:
-            insn.verbose = MulInstr(enc._MUL_INSN_REV[op_mul], mul_dst, mul_opd1, mul_opd2, sig, self.set_flags, cond_mul_str, rotate)
-        self.asm._emit(insn, increment=self.increment)
+            verbose = MulInstr(enc._MUL_INSN_REV[op_mul], mul_dst, mul_opd1, mul_opd2, sig, self.set_flags, cond_mul_str, rotate)
+        self.asm._emit_word(word, enc.KIND_ALU, verbose,
+                            increment=self.increment)
 
 class LoadEmitter(Emitter):
     'Emitter of load instructions.'
@@ -421,14 +527,14 @@ class LoadEmitter(Emitter):
         cond_add = cond_mul = enc._COND[kwargs.get('cond', 'always')]
         set_flags = kwargs.get('set_flags', False)
 
-        insn = enc.LoadInsn(
-                sig=0xe, unpack=unpack, pm=0, pack=pack, cond_add=cond_add,
-                cond_mul=cond_mul, sf=set_flags, ws=write_swap,
-                waddr_add=waddr_add, waddr_mul=waddr_mul, immediate=imm
+        word = enc.load_word(
+                0xe, unpack, 0, pack, cond_add, cond_mul, set_flags,
+                write_swap, waddr_add, waddr_mul, imm
                 )
+        verbose = None
         if self.asm.sanity_check:
-            insn.verbose = LoadImmInstr(reg1, reg2, imm)
-        self.asm._emit(insn)
+            verbose = LoadImmInstr(reg1, reg2, imm)
+        self.asm._emit_word(word, enc.KIND_LOAD, verbose)
 
 class Label(object):
     def __init__(self, asm, name):
@@ -539,7 +645,7 @@ class Assembler(object):
     _REGISTERS = REGISTERS
 
     def __init__(self, sanity_check=False):
-        self._instructions = []
+        self._instructions = enc.InsnArray(keep_verbose=sanity_check)
         self._program_counter = 0
         self._labels = []
         self._label_name_spaces = []
@@ -562,14 +668,21 @@ class Assembler(object):
         last instruction with ``insn``.
         """
 
+        self._emit_word(unpack('<Q', insn.to_bytes())[0],
+                        enc.INSN_KINDS.index(insn.__class__),
+                        getattr(insn, 'verbose', None), increment)
+
+    def _emit_word(self, word, kind, verbose=None, increment=True):
+        'Same as _emit but takes an instruction encoded as 64-bit integer.'
+
         if increment:
-            self._instructions.append(insn)
+            self._instructions.append_word(word, kind, verbose)
             self._program_counter += 8
         else:
-            add_op = self._instructions[-1]
             if self.sanity_check:
-                insn.verbose = ComposedInstr (add_op.verbose, insn.verbose)
-            self._instructions[-1] = insn
+                add_op = self._instructions.verbose[-1]
+                verbose = ComposedInstr (add_op, verbose)
+            self._instructions.set_word(-1, word, kind, verbose)
 
     def _emit_add(self, *args, **kwargs):
         return self._add._emit(*args, **kwargs)
@@ -617,7 +730,8 @@ class Assembler(object):
             assert(isinstance(insn, enc.BranchInsn))
             assert(insn.rel)
 
-            insn.immediate = labels[label] - 8*(i + 4)
+            self._instructions.set_field(
+                i, 'immediate', labels[label] - 8*(i + 4))
         self._backpatch_list = []
 
     def _add_backpatch_item(self, target):
@@ -627,7 +741,7 @@ class Assembler(object):
         'Convert list of _instructions to executable bytes.'
 
         self._backpatch()
-        return b''.join(insn.to_bytes() for insn in self._instructions)
+        return self._instructions.tobytes()
 
     def _generate_label_name(self, name):
         return '.'.join(self._label_name_spaces + [name])
@@ -638,15 +752,15 @@ def alias(f):
     setattr(Assembler, f.__name__, f)
 
 for name, code in enc._ADD_INSN.items():
-    setattr(Assembler, name, _partialmethod(Assembler._emit_add, code))
+    setattr(Assembler, name, _emittermethod(name, '_add', code))
 
 for name, code in enc._MUL_INSN.items():
     if name not in enc._ADD_INSN:
-        setattr(Assembler, name, _partialmethod(Assembler._emit_mul, code))
-    setattr(MulEmitter, name, _partialmethod(MulEmitter._emit, code))
+        setattr(Assembler, name, _emittermethod(name, '_mul', code))
+    setattr(MulEmitter, name, _emittermethod(name, None, code))
 
 for name, code in enc._BRANCH_INSN.items():
-    setattr(Assembler, name, _partialmethod(Assembler._emit_branch, code))
+    setattr(Assembler, name, _emittermethod(name, '_branch', code))
 
 Assembler.ldi = Assembler._emit_load
 
@@ -669,6 +783,9 @@ def mul_mov(self, dst, src, **kwargs):
 
 MulEmitter.mov = mul_mov
 
+# Names of Mul ALU instructions which can be chained to Add ALU ones.
+_MUL_METHODS = frozenset(list(enc._MUL_INSN) + ['rotate', 'mov'])
+
 @alias
 def mutex_acquire(asm):
     return asm.mov(REGISTERS['null'], REGISTERS['mutex'])
@@ -859,6 +976,7 @@ def qpu(f):
         raise AssembleError('Argument named \'asm\' is necessary')
 
     def decorate(f):
+        @wraps(f)
         def decorated(asm, *args, **kwargs):
             g = f.__globals__
             for reg in Assembler._REGISTERS:
@@ -0,0 +1,311 @@
+"""Binary diff of QPU programs.
+
+This module compares two assembled variants of a kernel.  Programs are split
+into basic blocks which are aligned by their labels, then instructions of
+aligned blocks are compared with :py:meth:`videocore.encoding.Insn.__eq__`.
+Relative branches are compared by their targets instead of immediates, so
+that inserting an instruction does not make every following branch differ.
+
+>>> print_diff(kernel_v1, kernel_v2)
+"""
+
+from __future__ import print_function
+import sys
+from collections import Counter
+from difflib import SequenceMatcher
+from struct import unpack
+
+import videocore.encoding as enc
+from videocore.assembler import assemble, get_label_positions
+from videocore.disassembler import Disassembler
+
+#============================= Instruction costs ==============================
+
+# Register addresses related to VPM, DMA and TMU.
+_MEMORY_WRITE_ADDRS = set([36, 48, 49, 50] + list(range(56, 64)))
+_MEMORY_READ_ADDRS = set([48, 49, 50])
+_MEMORY_SIGNALS = set([enc._SIGNAL['load tmu0'], enc._SIGNAL['load tmu1']])
+
+# Categories of instructions summarised by ProgramDiff.
+CATEGORIES = ['instructions', 'alu', 'dual_issue', 'nop', 'load_imm',
+              'branch', 'semaphore', 'memory']
+
+def _reads(insn, muxes):
+    addrs = []
+    if 6 in muxes:
+        addrs.append(insn.raddr_a)
+    if 7 in muxes and insn.sig != enc._SIGNAL['alu small imm']:
+        addrs.append(insn.raddr_b)
+    return addrs
+
+def classify(insn):
+    'Return set of categories which instruction ``insn`` belongs to.'
+
+    never = enc._COND['never']
+    nop = enc._ADD_INSN['nop']
+    categories = set(['instructions'])
+    writes = []
+    reads = []
+    if isinstance(insn, enc.BranchInsn):
+        categories.add('branch')
+    elif isinstance(insn, enc.SemaInsn):
+        categories.add('semaphore')
+    elif isinstance(insn, enc.LoadInsn):
+        categories.add('load_imm')
+        if insn.cond_add != never:
+            writes.append(insn.waddr_add)
+        if insn.cond_mul != never:
+            writes.append(insn.waddr_mul)
+    elif isinstance(insn, enc.AluInsn):
+        add = insn.op_add != nop and insn.cond_add != never
+        mul = insn.op_mul != nop and insn.cond_mul != never
+        if add:
+            writes.append(insn.waddr_add)
+            reads += _reads(insn, [insn.add_a, insn.add_b])
+        if mul:
+            writes.append(insn.waddr_mul)
+            reads += _reads(insn, [insn.mul_a, insn.mul_b])
+        if add or mul:
+            categories.add('alu')
+        if add and mul:
+            categories.add('dual_issue')
+        if not (add or mul) and insn.sig in [enc._SIGNAL['no signal'],
+                                             enc._SIGNAL['alu small imm']]:
+            categories.add('nop')
+        if insn.sig in _MEMORY_SIGNALS:
+            categories.add('memory')
+    if (_MEMORY_WRITE_ADDRS.intersection(writes) or
+            _MEMORY_READ_ADDRS.intersection(reads)):
+        categories.add('memory')
+    return categories
+
+def cost(insns):
+    'Count instructions of each category in ``insns``.'
+    counter = Counter(dict.fromkeys(CATEGORIES, 0))
+    for insn in insns:
+        counter.update(classify(insn))
+    return counter
+
+#================================ Basic blocks ================================
+
+def _branch_target(index, insn):
+    'Index of target instruction of relative branch, otherwise None.'
+    if not isinstance(insn, enc.BranchInsn) or not insn.rel or insn.reg:
+        return None
+    imm = insn.immediate
+    if imm & 0x80000000:
+        imm -= 1 << 32
+    if imm % 8 != 0:
+        return None
+    return index + 4 + imm // 8
+
+class BasicBlock(object):
+    """Basic block of decoded program.
+
+    Blocks starting at a label are named after it.  Other blocks are named
+    ``<previous label>+<n>``, or ``entry+<n>`` before the first label.
+    """
+
+    def __init__(self, name, start, insns, words):
+        self.name = name
+        self.start = start     # index of the first instruction
+        self.insns = insns
+        self.words = words
+
+    def __len__(self):
+        return len(self.insns)
+
+    def cost(self):
+        return cost(self.insns)
+
+class DecodedProgram(object):
+    'Decoded program split into basic blocks.'
+
+    def __init__(self, code, labels=None):
+        code = memoryview(code).tobytes()
+        if len(code) % 8 != 0:
+            raise enc.AssembleError('Length of code must be multiple of 8')
+        n = len(code) // 8
+        self.words = unpack('<{}Q'.format(n), code)
+        self.insns = [enc.Insn.from_bytes(code[8*i:8*i+8]) for i in range(n)]
+
+        label_names = {}
+        for label, pc in (labels or []):
+            if label.pinned and pc % 8 == 0:
+                label_names.setdefault(pc // 8, label.name)
+
+        # Blocks start at labels, branch targets and after delay slots of
+        # branches and thread ends.
+        starts = set([0]) | set(label_names)
+        for i, insn in enumerate(self.insns):
+            if isinstance(insn, enc.BranchInsn):
+                starts.add(i + 4)
+                starts.add(_branch_target(i, insn))
+            elif insn.sig == enc._SIGNAL['thread end']:
+                starts.add(i + 3)
+        starts = sorted(i for i in starts if i is not None and 0 <= i < n)
+
+        self.blocks = []
+        self.block_names = {}   # start index -> block name
+        prefix, k = 'entry', 0
+        for start, end in zip(starts, starts[1:] + [n]):
+            if start in label_names:
+                prefix, k = label_names[start], 0
+                name = prefix
+            else:
+                name = '{}+{}'.format(prefix, k)
+            k += 1
+            self.block_names[start] = name
+            self.blocks.append(BasicBlock(
+                name, start, self.insns[start:end], self.words[start:end]))
+
+    def key(self, index):
+        """Comparison key of the instruction at ``index``.
+
+        Relative branches are identified by names of their target blocks.
+        """
+
+        insn = self.insns[index]
+        target = _branch_target(index, insn)
+        if target is None:
+            return insn
+        fields = tuple(getattr(insn, f) for f, _, _ in insn._fields_
+                       if f not in ['dontcare', 'immediate'])
+        return (fields, self.block_names.get(target, target - index))
+
+    def target_name(self, index):
+        target = _branch_target(index, self.insns[index])
+        if target is None:
+            return None
+        return self.block_names.get(target)
+
+#==================================== Diff ====================================
+
+class BlockDiff(object):
+    """Difference of a pair of aligned basic blocks.
+
+    Either ``a`` or ``b`` is None when the block exists in only one program.
+    ``opcodes`` are those of :py:meth:`difflib.SequenceMatcher.get_opcodes`
+    over instructions of the blocks.
+    """
+
+    def __init__(self, name, a, b, opcodes):
+        self.name = name
+        self.a = a
+        self.b = b
+        self.opcodes = opcodes
+
+    def changed(self):
+        return any(tag != 'equal' for tag, _, _, _, _ in self.opcodes)
+
+    def cost_delta(self):
+        delta = self.b.cost() if self.b else cost([])
+        delta.subtract(self.a.cost() if self.a else cost([]))
+        return delta
+
+class ProgramDiff(object):
+    'Difference of two programs.'
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        self.blocks = []
+
+        names_a = [block.name for block in a.blocks]
+        names_b = [block.name for block in b.blocks]
+        matcher = SequenceMatcher(None, names_a, names_b, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for block_a, block_b in zip(a.blocks[i1:i2], b.blocks[j1:j2]):
+                    self.blocks.append(self._diff_blocks(block_a, block_b))
+                continue
+            for block in a.blocks[i1:i2]:
+                self.blocks.append(self._diff_blocks(block, None))
+            for block in b.blocks[j1:j2]:
+                self.blocks.append(self._diff_blocks(None, block))
+
+    def _diff_blocks(self, block_a, block_b):
+        keys_a = ([self.a.key(block_a.start + i) for i in range(len(block_a))]
+                  if block_a else [])
+        keys_b = ([self.b.key(block_b.start + i) for i in range(len(block_b))]
+                  if block_b else [])
+        matcher = SequenceMatcher(None, keys_a, keys_b, autojunk=False)
+        return BlockDiff((block_a or block_b).name, block_a, block_b,
+                         matcher.get_opcodes())
+
+    def changed(self):
+        return any(block.changed() for block in self.blocks)
+
+    def summary(self):
+        """Return {category: (count in a, count in b, delta)} over whole
+        programs.
+        """
+        cost_a = cost(self.a.insns)
+        cost_b = cost(self.b.insns)
+        return {c: (cost_a[c], cost_b[c], cost_b[c] - cost_a[c])
+                for c in CATEGORIES}
+
+    def format(self, context=2):
+        'Format the difference like unified diff.'
+
+        disasm = Disassembler()
+
+        def line(program, index, mark):
+            word = program.words[index]
+            stmt = disasm.statement(word, program.target_name(index))
+            return '{}{:5d}: {}'.format(mark, index, stmt)
+
+        lines = []
+        for block in self.blocks:
+            if not block.changed():
+                continue
+            delta = block.cost_delta()
+            lines.append('@@ {} @@ {}'.format(block.name, ', '.join(
+                '{}{:+d}'.format(c, delta[c]) for c in CATEGORIES
+                if delta[c])))
+            last = len(block.opcodes) - 1
+            for n, (tag, i1, i2, j1, j2) in enumerate(block.opcodes):
+                if tag == 'equal':
+                    ranges = []
+                    if n > 0:
+                        ranges.append((i1, min(i2, i1 + context)))
+                    if n < last:
+                        ranges.append((max(i1 + context, i2 - context), i2))
+                    shown = sorted(set(i for r in ranges for i in range(*r)))
+                    for k, i in enumerate(shown):
+                        if k > 0 and i != shown[k-1] + 1:
+                            lines.append(' ...')
+                        lines.append(line(self.a, block.a.start + i, ' '))
+                    continue
+                for i in range(i1, i2):
+                    lines.append(line(self.a, block.a.start + i, '-'))
+                for j in range(j1, j2):
+                    lines.append(line(self.b, block.b.start + j, '+'))
+
+        lines.append('{:<14}{:>8}{:>8}{:>8}'.format('', 'a', 'b', 'delta'))
+        summary = self.summary()
+        for c in CATEGORIES:
+            lines.append('{:<14}{:>8}{:>8}{:>+8}'.format(c, *summary[c]))
+        return '\n'.join(lines) + '\n'
+
+def _program(program, labels):
+    if hasattr(program, '__call__'):
+        if labels is None:
+            labels = get_label_positions(program)
+        program = assemble(program)
+    return DecodedProgram(program, labels)
+
+def diff(a, b, labels_a=None, labels_b=None):
+    """Compare two QPU programs.
+
+    :param a, b: bytes-like objects of QPU programs or functions decorated by
+        ``@qpu``.  Labels of functions are obtained by
+        ``get_label_positions``.
+    :param labels_a, labels_b: list of (label, position) pairs used to align
+        basic blocks.
+    """
+    return ProgramDiff(_program(a, labels_a), _program(b, labels_b))
+
+def print_diff(a, b, labels_a=None, labels_b=None, file=sys.stdout):
+    'Print difference of two QPU programs.'
+    print(diff(a, b, labels_a, labels_b).format(), end='', file=file)
@@ -279,7 +279,10 @@ def extract_verbose(instr):
   return instr.verbose
 
 def prepare(instrs, labels):
-  instrs = list (map(extract_verbose, instrs))
+  if isinstance(instrs, enc.InsnArray):
+    instrs = list (instrs.verbose)
+  else:
+    instrs = list (map(extract_verbose, instrs))
   labels = dict (map (lambda x: (x[0].name, x[1]), filter (lambda p: p[0].pinned, labels)))
   return (instrs, labels)
 
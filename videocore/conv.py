@@ -0,0 +1,138 @@
+"""Two dimensional convolution.
+
+>>> conv = Conv2D(drv, weights, stride=2, padding=1)
+>>> y = conv(x)
+
+Images are NHWC and weights are ``(KH, KW, C, OC)`` float32 arrays.  The
+convolution is the product of the matrix of patches of the input and weights
+reshaped to ``(KH*KW*C, OC)``, but the matrix of patches is never made.  Rows
+of a tile are 16 horizontally adjacent output pixels and the QPU gathers their
+patches by DMA loads whose stride is the horizontal stride of the convolution
+(see :py:mod:`videocore.gemm`).  Only padded inputs are copied to a zero
+filled device buffer.
+"""
+
+import weakref
+
+import numpy as np
+
+from videocore.driver import DriverError, asarray
+from videocore.gemm import TILE, MAX_STRIDE, TiledProduct, pack_b, view
+
+class Conv2D(TiledProduct):
+    """Convolution by weights packed to a device buffer.
+
+    Weights are packed at construction and by :py:meth:`set_weights`, which
+    reuses the buffer.
+
+    :param drv: :py:class:`videocore.driver.Driver`.
+    :param weights: array of shape ``(KH, KW, C, OC)``.
+    :param stride: stride of the convolution.
+    :param padding: number of zero pixels padded to each side of inputs.
+    """
+
+    def __init__(self, drv, weights, stride=1, padding=0, max_threads=None):
+        super(Conv2D, self).__init__(drv, max_threads)
+        if stride < 1 or padding < 0:
+            raise DriverError('Invalid stride or padding')
+        self.stride = stride
+        self.padding = padding
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        'Pack ``weights`` of shape ``(KH, KW, C, OC)`` to the device buffer.'
+        weights = asarray(weights, dtype='float32')
+        if weights.ndim != 4:
+            raise DriverError('Weights must be (KH, KW, C, OC) array')
+        KH, KW, C, OC = weights.shape
+        t = (OC + TILE - 1) // TILE
+        with self.lock:
+            packed = self.workspace.get('weights', (t, KH*KW*C, TILE),
+                                        'float32')
+            pack_b(weights.reshape(KH*KW*C, OC), out=packed)
+            self.kernel_shape = weights.shape
+            self.packed = packed
+
+    def output_shape(self, shape):
+        'Shape of the output for input of ``shape``.'
+        N, H, W, C = shape
+        KH, KW, _, OC = self.kernel_shape
+        p, s = self.padding, self.stride
+        return (N, (H + 2*p - KH) // s + 1, (W + 2*p - KW) // s + 1, OC)
+
+    def _padded(self, x):
+        p = self.padding
+        if p == 0:
+            if not hasattr(x, 'address') or not x.flags.c_contiguous:
+                raise DriverError('Input must be a contiguous device array')
+            return x
+        N, H, W, C = x.shape
+        xp = self.workspace.get('padded', (N, H + 2*p, W + 2*p, C), 'float32')
+        xp[:] = 0
+        xp[:, p:p+H, p:p+W, :] = x
+        return xp
+
+    def __call__(self, x, out=None):
+        """Convolve ``x`` of shape ``(N, H, W, C)`` or ``(H, W, C)``.
+
+        :param out: optional output device array.
+        """
+
+        KH, KW, C, OC = self.kernel_shape
+        s = self.stride
+        single = (np.ndim(x) == 3)
+        if single:
+            # A reshaped device array loses its address.
+            if hasattr(x, 'address') and x.flags.c_contiguous:
+                x = view(x, (1,) + x.shape, x.dtype)
+            else:
+                x = np.reshape(x, (1,) + np.shape(x))
+        if x.ndim != 4 or x.shape[3] != C or x.dtype != np.float32:
+            raise DriverError('Input must be float32 NHWC array with {} '
+                              'channels'.format(C))
+        N, OH, OW, _ = shape = self.output_shape(x.shape)
+        if OH <= 0 or OW <= 0:
+            raise DriverError('Input is smaller than the kernel')
+        if 4 * s * C > MAX_STRIDE:
+            raise DriverError('Too many channels for the stride')
+        if out is None:
+            out = self.drv.alloc(shape[1:] if single else shape, 'float32')
+        if (not hasattr(out, 'address') or out.dtype != np.float32 or
+                out.size != N*OH*OW*OC or not out.flags.c_contiguous):
+            raise DriverError('Invalid output array')
+        with self.lock:
+            xp = self._padded(x)
+            Hp, Wp = xp.shape[1:3]
+
+            b, oy, ox, t = [a.ravel() for a in np.meshgrid(
+                np.arange(N), np.arange(OH), np.arange(0, OW, TILE),
+                np.arange((OC + TILE - 1) // TILE), indexing='ij')]
+            self.run(
+                words=KW*C,
+                a_pitch=4*C*s,
+                a_addr=xp.address + 4*C*((b*Hp + oy*s)*Wp + ox*s),
+                c_addr=out.address + 4*(((b*OH + oy)*OW + ox)*OC + TILE*t),
+                b_addr=self.packed.address + 4*KH*KW*C*TILE*t,
+                nrows=np.minimum(TILE, OW - ox),
+                ncols=np.minimum(TILE, OC - TILE*t),
+                c_pitch=4*OC,
+                segments=KH,
+                segment_stride=4*C*Wp)
+            return out
+
+
+_convs = weakref.WeakKeyDictionary()
+
+def conv2d(drv, x, weights, stride=1, padding=0):
+    """Convolve device array ``x`` by ``weights``.
+
+    Weights are packed at every call to a buffer reused by calls of the same
+    stride and padding.  Use :py:class:`Conv2D` to pack them once.
+    """
+    convs = _convs.setdefault(drv, {})
+    conv = convs.get((stride, padding))
+    if conv is None:
+        conv = convs[stride, padding] = Conv2D(drv, weights, stride, padding)
+    with conv.lock:
+        conv.set_weights(weights)
+        return conv(x)
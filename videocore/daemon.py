@@ -0,0 +1,560 @@
+"""QPU daemon shared by several processes.
+
+A daemon owns the mailbox and VCSM, and runs programs launched by client
+processes connected to a Unix socket.  QPUs are enabled while at least one
+client is connected, and launches of clients are interleaved in round robin
+order.
+
+::
+
+    $ sudo python -m videocore.daemon /run/videocore.sock
+
+>>> with Client('/run/videocore.sock', name='detector') as client:
+...     x = client.copy(np.arange(16, dtype='float32'))
+...     prog = client.program(kernel)
+...     client.execute(1, prog, [x.address])
+...     y = client.read(x)
+
+Each client has its own device memory released when it disconnects.  Arrays
+are written and read through the socket since VCSM allocations are not shared
+between processes.  Programs of clients are trusted; nothing prevents them
+from accessing memory of other clients.
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import rpi_vcsm
+import rpi_vcsm.VCSM
+
+from videocore.mailbox import MailBox
+from videocore.assembler import assemble
+from videocore.driver import Mempool, DriverError, DEFAULT_MAX_THREADS
+
+DEFAULT_SOCKET_PATH = '/tmp/videocore-qpu.sock'
+DEFAULT_CLIENT_DATA_AREA_SIZE = 16 * 1024 * 1024
+DEFAULT_CLIENT_CODE_AREA_SIZE = 256 * 1024
+UNIFORMS_AREA_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+
+_HEADER = struct.Struct('=LL')
+
+#================================== Protocol ==================================
+
+# A message is lengths of the header and the payload, the header encoded by
+# JSON and the payload of raw bytes.
+
+def _send(sock, header, payload=b''):
+    header = json.dumps(header).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(header), len(payload)) + header)
+    if payload:
+        sock.sendall(payload)
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        size = sock.recv_into(view[pos:], n - pos)
+        if size == 0:
+            raise EOFError('Connection closed')
+        pos += size
+    return buf
+
+def _discard(sock, n):
+    while n > 0:
+        size = len(sock.recv(min(n, 65536)))
+        if size == 0:
+            raise EOFError('Connection closed')
+        n -= size
+
+def _recv(sock, max_payload_size = None):
+    """Receive a message.
+
+    A message larger than ``max_payload_size`` or :py:data:`MAX_HEADER_SIZE`
+    is discarded and raises DriverError, and a malformed header raises
+    ValueError.  Both are raised after the whole message is read, so that the
+    next message can be received.
+    """
+    (header_size, payload_size) = _HEADER.unpack(
+            bytes(_recv_exactly(sock, _HEADER.size)))
+    if header_size > MAX_HEADER_SIZE or (
+            max_payload_size is not None and payload_size > max_payload_size):
+        _discard(sock, header_size + payload_size)
+        raise DriverError('Message too large')
+    header = bytes(_recv_exactly(sock, header_size))
+    payload = _recv_exactly(sock, payload_size)
+    header = json.loads(header.decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError('Header must be an object')
+    return (header, payload)
+
+#=================================== Server ===================================
+
+class QPUEnabler(object):
+    'Reference count of enablement of QPUs.'
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.count == 0:
+                self.mailbox.enable_qpu(1)
+            self.count += 1
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+            if self.count == 0:
+                self.mailbox.enable_qpu(0)
+
+class Session(object):
+    'Device memory, programs and statistics of a client.'
+
+    def __init__(self, client_id, name, vcsm, data_area_size, code_area_size):
+        self.id = client_id
+        self.name = name
+        self.pool = Mempool({'data': data_area_size,
+                             'uniforms': UNIFORMS_AREA_SIZE,
+                             'code': code_area_size},
+                            vcsm = vcsm, cache_mode = rpi_vcsm.CACHE_NONE)
+        self.arrays = []
+        self.programs = []
+        self.staging = None
+        self.pending = deque()
+        self.connected_at = time.time()
+        self.launches = 0
+        self.qpu_time = 0.0
+        self.wait_time = 0.0
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+        self.pool = None
+        self.arrays = None
+        self.programs = None
+        self.staging = None
+
+    def stage_uniforms(self, uniforms):
+        """Copy ``uniforms`` to the device array reused by launches and
+        return its address.  The array is reallocated only when it is too
+        small, because the pool never frees memory.
+        """
+        if self.staging is None or self.staging.size < uniforms.size:
+            self.staging = self.pool.alloc('uniforms', shape = uniforms.size,
+                                           dtype = np.uint32)
+        self.staging[:uniforms.size] = uniforms.ravel()
+        return self.staging.address
+
+    def stats(self):
+        elapsed = time.time() - self.connected_at
+        return {
+            'client': self.id,
+            'name': self.name,
+            'launches': self.launches,
+            'qpu_time': self.qpu_time,
+            'wait_time': self.wait_time,
+            'utilization': self.qpu_time / elapsed if elapsed > 0 else 0.0,
+        }
+
+class _Launch(object):
+    def __init__(self, session, n_threads, program, uniforms, timeout):
+        self.session = session
+        self.n_threads = n_threads
+        self.program = program
+        self.uniforms = uniforms
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.done = threading.Event()
+        self.error = None
+
+class QPUServer(object):
+    """QPU daemon.
+
+    :param path: path of the Unix socket.
+    :param max_threads: maximum number of threads of a launch.
+    :param mailbox: :py:class:`videocore.mailbox.MailBox`.  Default is a new
+        one.
+    :param vcsm: :py:class:`rpi_vcsm.VCSM.VCSM`.  Default is a new one.
+    """
+
+    def __init__(self, path = DEFAULT_SOCKET_PATH,
+                 max_threads = DEFAULT_MAX_THREADS,
+                 client_data_area_size = DEFAULT_CLIENT_DATA_AREA_SIZE,
+                 client_code_area_size = DEFAULT_CLIENT_CODE_AREA_SIZE,
+                 mailbox = None, vcsm = None):
+        self.path = path
+        self.max_threads = max_threads
+        self.client_data_area_size = client_data_area_size
+        self.client_code_area_size = client_code_area_size
+        self.mailbox = mailbox or MailBox()
+        self.vcsm = vcsm or rpi_vcsm.VCSM.VCSM()
+        self.enabler = QPUEnabler(self.mailbox)
+        self.ctlmem = Mempool({'message': max_threads * 2 * 4},
+                              vcsm = self.vcsm,
+                              cache_mode = rpi_vcsm.CACHE_NONE)
+        self.message = self.ctlmem.alloc('message', shape = (max_threads, 2),
+                                         dtype = np.uint32)
+        self.sessions = []
+        self.next_id = 0
+        self.turn = 0
+        self.started_at = time.time()
+        self.busy_time = 0.0
+        self.running = False
+        self.cond = threading.Condition()
+        self.sock = None
+        self.clients = {}
+
+    #==== Scheduler ====
+
+    def submit(self, session, n_threads, program, uniforms, timeout):
+        'Queue a launch and wait for its completion.'
+        if not (1 <= n_threads and n_threads <= self.max_threads):
+            raise DriverError('n_threads exceeds max_threads')
+        launch = _Launch(session, n_threads, program, uniforms, timeout)
+        with self.cond:
+            session.pending.append(launch)
+            self.cond.notify_all()
+        launch.done.wait()
+        if launch.error:
+            raise DriverError(launch.error)
+
+    def _next_launch(self):
+        'Pop a launch of the next client with pending launches.'
+        n = len(self.sessions)
+        for i in range(n):
+            session = self.sessions[(self.turn + i) % n]
+            if session.pending:
+                self.turn = (self.turn + i + 1) % n
+                return session.pending.popleft()
+        return None
+
+    def _run(self, launch):
+        session = launch.session
+        address = session.stage_uniforms(launch.uniforms)
+        stride = launch.uniforms.nbytes // launch.n_threads
+        n_threads = launch.n_threads
+        self.message[:n_threads, 0] = \
+                address + stride * np.arange(n_threads)
+        self.message[:n_threads, 1] = launch.program.address
+        start = time.time()
+        r = self.mailbox.execute_qpu(n_threads, self.message.address, 0,
+                                     launch.timeout)
+        elapsed = time.time() - start
+        session.launches += 1
+        session.qpu_time += elapsed
+        session.wait_time += start - launch.queued_at
+        self.busy_time += elapsed
+        if r > 0:
+            launch.error = 'QPU execution timeout'
+
+    def _schedule(self):
+        while True:
+            with self.cond:
+                launch = self._next_launch()
+                while launch is None and self.running:
+                    self.cond.wait()
+                    launch = self._next_launch()
+                if launch is None:
+                    return
+            try:
+                self._run(launch)
+            except Exception as e:
+                launch.error = str(e)
+            launch.done.set()
+
+    def stats(self):
+        'Statistics of the daemon and connected clients.'
+        with self.cond:
+            elapsed = time.time() - self.started_at
+            return {
+                'clients': [s.stats() for s in self.sessions],
+                'busy_time': self.busy_time,
+                'utilization': self.busy_time / elapsed if elapsed else 0.0,
+            }
+
+    #==== Clients ====
+
+    def _open_session(self, name):
+        session = Session(self.next_id, name, self.vcsm,
+                          self.client_data_area_size,
+                          self.client_code_area_size)
+        self.next_id += 1
+        self.enabler.acquire()
+        with self.cond:
+            self.sessions.append(session)
+        return session
+
+    def _close_session(self, session):
+        with self.cond:
+            for launch in session.pending:
+                launch.error = 'Client disconnected'
+                launch.done.set()
+            session.pending.clear()
+            self.sessions.remove(session)
+            self.turn = 0
+        session.close()
+        self.enabler.release()
+
+    @staticmethod
+    def _lookup(items, index, message):
+        # Negative indices of clients must not wrap around.
+        if not (0 <= index and index < len(items)):
+            raise DriverError(message)
+        return items[index]
+
+    def _dispatch(self, session, header, payload):
+        op = header['op']
+        if op == 'alloc':
+            # Arrays are aligned to 16 bytes for DMA and TMU.
+            nbytes = (header['nbytes'] + 15) // 16 * 16
+            arr = session.pool.alloc('data', shape = nbytes, dtype = np.uint8)
+            session.arrays.append(arr)
+            return ({'handle': len(session.arrays) - 1,
+                     'address': int(arr.address)}, b'')
+        if op in ['write', 'read']:
+            arr = self._lookup(session.arrays, header['handle'],
+                               'Invalid array handle')
+            start = header['offset']
+            end = start + (len(payload) if op == 'write' else header['nbytes'])
+            if not (0 <= start <= end <= arr.nbytes):
+                raise DriverError('Out of range access')
+            if op == 'write':
+                arr[start:end] = np.frombuffer(payload, np.uint8)
+                return ({}, b'')
+            return ({}, arr[start:end].tobytes())
+        if op == 'program':
+            code = bytes(payload)
+            arr = session.pool.alloc(
+                    'code', shape = (len(code) + 7) // 8, dtype = np.uint64)
+            arr.buffer[arr.offset:arr.offset+len(code)] = code
+            session.programs.append(arr)
+            return ({'program': len(session.programs) - 1,
+                     'address': int(arr.address)}, b'')
+        if op == 'execute':
+            program = self._lookup(session.programs, header['program'],
+                                   'Invalid program')
+            n_threads = header['n_threads']
+            if not (1 <= n_threads and n_threads <= self.max_threads):
+                raise DriverError('n_threads exceeds max_threads')
+            uniforms = np.frombuffer(payload, np.uint32)
+            if uniforms.size == 0:
+                uniforms = np.zeros(n_threads, np.uint32)
+            if uniforms.size % n_threads != 0:
+                raise DriverError('Invalid uniforms')
+            self.submit(session, n_threads, program,
+                        uniforms.reshape(n_threads, -1), header['timeout'])
+            return ({}, b'')
+        if op == 'stats':
+            return (self.stats(), b'')
+        raise DriverError('Unknown request {}'.format(op))
+
+    def _serve_client(self, conn):
+        session = None
+        # Payloads are at most arrays and programs of the session.
+        max_payload_size = max(self.client_data_area_size,
+                               self.client_code_area_size)
+        try:
+            (header, _) = _recv(conn, 0)
+            session = self._open_session(header.get('name'))
+            _send(conn, {'client': session.id})
+            while True:
+                try:
+                    (header, payload) = _recv(conn, max_payload_size)
+                    (response, data) = self._dispatch(session, header,
+                                                      payload)
+                except DriverError as e:
+                    (response, data) = ({'error': str(e)}, b'')
+                except (KeyError, TypeError, ValueError) as e:
+                    # Malformed requests must not end the session.
+                    (response, data) = (
+                            {'error': 'Invalid request: {!r}'.format(e)}, b'')
+                _send(conn, response, data)
+        except (EOFError, socket.error, DriverError, ValueError):
+            # The connection is closed if the first message is invalid.
+            pass
+        finally:
+            if session is not None:
+                self._close_session(session)
+            with self.cond:
+                self.clients.pop(conn, None)
+            conn.close()
+
+    def serve_forever(self):
+        """Accept clients until :py:meth:`shutdown` is called, and then
+        disconnect them.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.running = True
+        scheduler = threading.Thread(target = self._schedule)
+        scheduler.daemon = True
+        scheduler.start()
+        try:
+            while self.running:
+                try:
+                    (conn, _) = self.sock.accept()
+                except socket.error:
+                    break
+                t = threading.Thread(target = self._serve_client,
+                                     args = (conn,))
+                t.daemon = True
+                with self.cond:
+                    self.clients[conn] = t
+                t.start()
+        finally:
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+                clients = list(self.clients.items())
+            # Sessions of connected clients are closed before returning.
+            for (conn, t) in clients:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                t.join()
+            scheduler.join()
+
+    def shutdown(self):
+        'Stop accepting clients.'
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.sock:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+
+    def close(self):
+        if self.ctlmem:
+            self.ctlmem.close()
+        self.ctlmem = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+#=================================== Client ===================================
+
+class RemoteArray(object):
+    'Array in device memory of the daemon.'
+
+    def __init__(self, handle, address, shape, dtype):
+        self.handle = handle
+        self.address = address
+        self.shape = shape
+        self.dtype = dtype
+        self.nbytes = int(np.prod(shape)) * dtype.itemsize
+
+class RemoteProgram(object):
+    def __init__(self, program_id, address, size):
+        self.id = program_id
+        self.address = address
+        self.size = size
+
+class Client(object):
+    """Client of the QPU daemon.
+
+    Methods follow those of :py:class:`videocore.driver.Driver`.
+
+    :param path: path of the Unix socket of the daemon.
+    :param name: name of the client shown in statistics.
+    """
+
+    def __init__(self, path = DEFAULT_SOCKET_PATH, name = None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+            (header, _) = self._call({'op': 'hello', 'name': name})
+            self.id = header['client']
+        except:
+            self.close()
+            raise
+
+    def _call(self, header, payload = b''):
+        _send(self.sock, header, payload)
+        (response, data) = _recv(self.sock)
+        if 'error' in response:
+            raise DriverError(response['error'])
+        return (response, data)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+        return exc_type is None
+
+    def alloc(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        (header, _) = self._call({'op': 'alloc', 'nbytes': nbytes})
+        return RemoteArray(header['handle'], header['address'], shape, dtype)
+
+    def write(self, arr, data):
+        data = np.ascontiguousarray(data, dtype = arr.dtype)
+        if data.nbytes != arr.nbytes:
+            raise DriverError('Size mismatch')
+        self._call({'op': 'write', 'handle': arr.handle, 'offset': 0},
+                   data.tobytes())
+
+    def read(self, arr):
+        (_, data) = self._call({'op': 'read', 'handle': arr.handle,
+                                'offset': 0, 'nbytes': arr.nbytes})
+        return np.frombuffer(data, arr.dtype).reshape(arr.shape)
+
+    def copy(self, arr):
+        arr = np.asarray(arr)
+        new_arr = self.alloc(arr.shape, arr.dtype)
+        self.write(new_arr, arr)
+        return new_arr
+
+    def program(self, program, *args, **kwargs):
+        if hasattr(program, '__call__'):
+            program = assemble(program, *args, **kwargs)
+        code = memoryview(program).tobytes()
+        (header, _) = self._call({'op': 'program'}, code)
+        return RemoteProgram(header['program'], header['address'], len(code))
+
+    def execute(self, n_threads, program, uniforms = None, timeout = 10000):
+        if uniforms is None:
+            payload = b''
+        else:
+            payload = np.ascontiguousarray(uniforms, dtype = 'u4').tobytes()
+        self._call({'op': 'execute', 'n_threads': n_threads,
+                    'program': program.id, 'timeout': timeout}, payload)
+
+    def stats(self):
+        'Statistics of the daemon and its clients.'
+        return self._call({'op': 'stats'})[0]
+
+def main(argv):
+    server = QPUServer(argv[1] if len(argv) > 1 else DEFAULT_SOCKET_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        server.mailbox.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
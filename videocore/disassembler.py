@@ -0,0 +1,413 @@
+"""VideoCore IV QPU disassembler.
+
+This module reconstructs source code of the assembly language implemented in
+:py:mod:`videocore.assembler` from binary QPU programs, e.g. programs saved by
+``save_bin`` and loaded by ``Driver.load_bin``.
+
+Every decoded instruction is encoded again by the assembler before it is
+printed. Instructions which can not be written in the DSL (e.g. ones with
+don't-care bits set) are printed as ``raw(...)``. Therefore the following
+holds for any program ``code``::
+
+    assemble(load_source(disassemble(code))) == code
+"""
+
+from __future__ import print_function
+import sys
+import re
+import keyword
+from struct import pack, unpack
+
+import videocore.encoding as enc
+from videocore.encoding import REGISTERS
+from videocore.assembler import Assembler, LabelEmitter, assemble, qpu
+
+#================================ Decode tables ===============================
+
+def _register_names(flag):
+    return {reg.addr: name for name, reg in REGISTERS.items()
+            if reg.spec & flag}
+
+_READ_A = _register_names(enc._REG_AR)
+_READ_B = _register_names(enc._REG_BR)
+_WRITE_A = _register_names(enc._REG_AW)
+_WRITE_B = _register_names(enc._REG_BW)
+
+# Small immediate values indexed by raddr_b.  See encoding._SMALL_IMM.
+_SMALL_IMM_VALUES = (
+    list(range(16)) + list(range(-16, 0)) +
+    [2.0**i for i in range(8)] + [2.0**i for i in range(-8, 0)]
+    )
+
+_UNARY_ADD_INSN = [name for name, code in enc._ADD_INSN.items()
+                   if len(enc._ADD_DEFAULT_ARGS.get(code, [])) == 1]
+
+_NULL_ADDR = REGISTERS['null'].addr
+_SIG_SMALL_IMM = enc._SIGNAL['alu small imm']
+_SIG_LOAD = enc._SIGNAL['load']
+_SIG_BRANCH = enc._SIGNAL['branch']
+_COND_NEVER = enc._COND['never']
+_COND_ALWAYS = enc._COND['always']
+
+#================================== Decoder ===================================
+
+def _kwargs(**kwargs):
+    return ''.join(', {}={}'.format(k, v) for k, v in sorted(kwargs.items()))
+
+def _call(name, args, kwargs):
+    s = '{}({}{})'.format(name, ', '.join(args), _kwargs(**kwargs))
+    return s.replace('(, ', '(')
+
+def _read_operand(insn, mux):
+    'Source operand of ALU instruction selected by input multiplexer ``mux``.'
+
+    if mux < 6:
+        name = 'r{}'.format(mux)
+        if mux == 4 and insn.pm and insn.unpack:
+            name += ".unpack('{}')".format(enc._UNPACK_REV[insn.unpack])
+        return name
+    if mux == 6:
+        name = _READ_A.get(insn.raddr_a)
+        if name and not insn.pm and insn.unpack:
+            name += ".unpack('{}')".format(enc._UNPACK_REV[insn.unpack])
+        return name
+    if insn.sig != _SIG_SMALL_IMM:
+        return _READ_B.get(insn.raddr_b)
+    if insn.raddr_b < 48:
+        return repr(_SMALL_IMM_VALUES[insn.raddr_b])
+    # raddr_b encodes a vector rotation.  The small immediate seen by the
+    # add ALU is -16 for 'r5 rotate' and n-16 for 'n-upward rotate'.
+    return repr(insn.raddr_b - 64 if insn.raddr_b > 48 else -16)
+
+def _write_operands(insn):
+    'Destination registers of Add ALU (or load) and Mul ALU.'
+
+    if insn.ws:
+        add_dst = _WRITE_B.get(insn.waddr_add)
+        mul_dst = _WRITE_A.get(insn.waddr_mul)
+    else:
+        add_dst = _WRITE_A.get(insn.waddr_add)
+        mul_dst = _WRITE_B.get(insn.waddr_mul)
+    if getattr(insn, 'pack', 0) and not insn.pm:
+        packed = ".pack('{}')".format(enc._PACK_REV[insn.pack])
+        if insn.ws and mul_dst:
+            mul_dst += packed
+        elif not insn.ws and add_dst:
+            add_dst += packed
+    return add_dst, mul_dst
+
+def _signal(insn):
+    sig = enc._SIGNAL_REV[insn.sig]
+    if sig in ['no signal', 'alu small imm']:
+        return {}
+    return {'sig': repr(sig)}
+
+def _decode_alu(insn):
+    add_dst, mul_dst = _write_operands(insn)
+    add_a, add_b, mul_a, mul_b = [
+        _read_operand(insn, mux)
+        for mux in [insn.add_a, insn.add_b, insn.mul_a, insn.mul_b]]
+    if None in [add_dst, mul_dst, add_a, add_b, mul_a, mul_b]:
+        return []
+
+    add_only = (insn.op_mul == enc._MUL_INSN['nop'] and
+                insn.cond_mul == _COND_NEVER and insn.waddr_mul == _NULL_ADDR
+                and insn.mul_a == 0 and insn.mul_b == 0)
+    mul_only = (insn.op_add == enc._ADD_INSN['nop'] and
+                insn.cond_add == _COND_NEVER and insn.waddr_add == _NULL_ADDR
+                and insn.add_a == 0 and insn.add_b == 0 and not insn.sf)
+
+    # Add ALU part.
+    op_add = enc._ADD_INSN_REV.get(insn.op_add)
+    if op_add is None:
+        return []
+    kwargs = _signal(insn)
+    if insn.cond_add != _COND_ALWAYS:
+        kwargs['cond'] = repr(enc._COND_REV[insn.cond_add])
+    if op_add == 'nop':
+        add_part = [_call('nop', [], kwargs)]
+    elif op_add in _UNARY_ADD_INSN and insn.add_b == 0:
+        if not insn.sf:
+            kwargs['set_flags'] = 'False'
+        add_part = [_call(op_add, [add_dst, add_a], kwargs)]
+    else:
+        add_part = []
+        if op_add == 'bor' and insn.add_a == insn.add_b:
+            mov_kwargs = dict(kwargs)
+            if insn.sf:
+                mov_kwargs['set_flags'] = 'True'
+            add_part.append(_call('mov', [add_dst, add_a], mov_kwargs))
+        if not insn.sf:
+            kwargs['set_flags'] = 'False'
+        add_part.append(_call(op_add, [add_dst, add_a, add_b], kwargs))
+
+    if add_only:
+        return add_part
+
+    # Mul ALU part.
+    op_mul = enc._MUL_INSN_REV[insn.op_mul]
+    kwargs = _signal(insn) if mul_only else {}
+    if insn.cond_mul != _COND_ALWAYS:
+        kwargs['cond'] = repr(enc._COND_REV[insn.cond_mul])
+    if insn.pm and insn.pack:
+        if insn.pack not in enc._MUL_PACK_REV:
+            return []
+        kwargs['pack'] = repr(enc._MUL_PACK_REV[insn.pack])
+    rotate = None
+    if insn.sig == _SIG_SMALL_IMM and insn.raddr_b >= 48:
+        rotate = 'r5' if insn.raddr_b == 48 else str(insn.raddr_b - 48)
+    if op_mul == 'nop':
+        mul_part = [_call('nop', [], kwargs)]
+    else:
+        mul_part = []
+        if op_mul == 'v8min' and insn.mul_a == insn.mul_b:
+            if rotate is not None:
+                mul_part.append(
+                    _call('rotate', [mul_dst, mul_a, rotate], kwargs))
+            elif not mul_only:
+                mul_part.append(_call('mov', [mul_dst, mul_a], kwargs))
+        if rotate is not None:
+            kwargs['rotate'] = rotate
+        mul_part.append(_call(op_mul, [mul_dst, mul_a, mul_b], kwargs))
+
+    if mul_only and (op_mul not in enc._ADD_INSN or
+                     mul_part[0].startswith('rotate(')):
+        return mul_part
+    return [a + '.' + m for a in add_part for m in mul_part]
+
+def _decode_load(insn):
+    dst1, dst2 = _write_operands(insn)
+    if None in [dst1, dst2]:
+        return []
+    args = [dst1] if insn.waddr_mul == _NULL_ADDR else [dst1, dst2]
+
+    imm = insn.immediate
+    if insn.unpack == 0:
+        args.append(str(imm) if imm < 0x10000 else '0x{:08x}'.format(imm))
+    elif insn.unpack in [1, 3]:
+        high = imm >> 16
+        values = [(high >> i & 1) << 1 | (imm >> i & 1) for i in range(16)]
+        if insn.unpack == 1:
+            values = [v - 4 if v >= 2 else v for v in values]
+        while len(values) > 1 and values[-1] == 0:
+            values.pop()
+        args.append(repr(values))
+    else:
+        return []
+
+    kwargs = {}
+    if insn.cond_add != _COND_ALWAYS:
+        kwargs['cond'] = repr(enc._COND_REV[insn.cond_add])
+    if insn.sf:
+        kwargs['set_flags'] = 'True'
+    return [_call('ldi', args, kwargs)]
+
+def _decode_sema(insn):
+    return ['{}({})'.format(['sema_up', 'sema_down'][insn.sa], insn.semaphore)]
+
+def _decode_branch(insn):
+    'Return (condition, signed immediate, keyword arguments) of branch.'
+
+    cond = enc._BRANCH_INSN_REV.get(insn.cond_br)
+    link, _ = _write_operands(insn)
+    if cond is None or link is None:
+        return None
+    kwargs = {}
+    if insn.reg:
+        kwargs['reg'] = _READ_A.get(insn.raddr_a)
+        if kwargs['reg'] is None:
+            return None
+    if not insn.rel:
+        kwargs['absolute'] = 'True'
+    if link != 'null':
+        kwargs['link'] = link
+    imm = insn.immediate
+    if imm & 0x80000000:
+        imm -= 1 << 32
+    return cond, imm, kwargs
+
+def _raw(word):
+    return 'raw(0x{:08x}, 0x{:08x})'.format(word & 0xffffffff, word >> 32)
+
+class _Verifier(object):
+    """Encode a statement with the assembler to verify it.
+
+    Statements are evaluated in the same namespace as a function decorated
+    by :py:func:`videocore.assembler.qpu`.
+    """
+
+    def __init__(self):
+        self.asm = Assembler()
+        f, self.namespace = _compile_source('', '_verify')
+        qpu(f)(self.asm)
+
+    def encode(self, stmt):
+        asm = self.asm
+        asm._instructions = enc.InsnArray()
+        asm._program_counter = 0
+        asm._labels = []
+        asm._backpatch_list = []
+        try:
+            eval(stmt, self.namespace)
+        except Exception:
+            return None
+        return asm._instructions.tobytes()
+
+    def first_valid(self, candidates, word):
+        code = pack('<Q', word)
+        for stmt in candidates:
+            if self.encode(stmt) == code:
+                return stmt
+        return None
+
+class Disassembler(object):
+    """QPU Disassembler.
+
+    Decoded instructions are memoised by their encodings, since unrolled
+    kernels consist of a small number of distinct instructions.
+    """
+
+    def __init__(self):
+        self._verifier = _Verifier()
+        self._cache = {}
+
+    def decode(self, word):
+        """Decode 64-bit instruction ``word``.
+
+        Return a statement or, for relative branches, a tuple (condition,
+        signed immediate, keyword arguments).
+        """
+
+        try:
+            return self._cache[word]
+        except KeyError:
+            pass
+
+        insn = enc.Insn.from_bytes(pack('<Q', word))
+        if insn.sig == _SIG_BRANCH:
+            result = _decode_branch(insn)
+            if result is not None:
+                cond, imm, kwargs = result
+                stmt = _call(cond, [str(imm)] if imm else [], kwargs)
+                if self._verifier.first_valid([stmt], word) is None:
+                    result = None
+                elif not insn.rel or insn.reg:
+                    result = stmt
+        else:
+            if insn.sig != _SIG_LOAD:
+                candidates = _decode_alu(insn)
+            elif isinstance(insn, enc.SemaInsn):
+                candidates = _decode_sema(insn)
+            else:
+                candidates = _decode_load(insn)
+            result = self._verifier.first_valid(candidates, word)
+        if result is None:
+            result = _raw(word)
+
+        self._cache[word] = result
+        return result
+
+    def disassemble(self, code, labels=None):
+        'Disassemble bytes-like object ``code`` to list of source lines.'
+
+        code = memoryview(code).tobytes()
+        if len(code) % 8 != 0:
+            raise enc.AssembleError('Length of code must be multiple of 8')
+        n = len(code) // 8
+        words = unpack('<{}Q'.format(n), code)
+        decoded = [self.decode(w) for w in words]
+
+        label_names = {}
+        for label, pc in (labels or []):
+            if label.pinned:
+                label_names.setdefault(pc, []).append(label.name)
+        used = set(name for names in label_names.values() for name in names)
+        # Relative branches into the program get labels.  Others keep their
+        # immediates.
+        for i, d in enumerate(decoded):
+            if isinstance(d, tuple):
+                target = 8*(i + 4) + d[1]
+                if target % 8 != 0 or not (0 <= target <= len(code)):
+                    decoded[i] = self.statement(words[i])
+        targets = sorted(set(
+            8*(i + 4) + d[1] for i, d in enumerate(decoded)
+            if isinstance(d, tuple)))
+        n_generated = 0
+        for pc in targets:
+            if pc in label_names:
+                continue
+            while 'L{}'.format(n_generated) in used:
+                n_generated += 1
+            label_names[pc] = ['L{}'.format(n_generated)]
+            n_generated += 1
+
+        lines = []
+        for i, d in enumerate(decoded + [None]):
+            for name in label_names.get(8*i, []):
+                lines.append(_label(name))
+            if d is None:
+                break
+            if isinstance(d, tuple):
+                d = self.statement(words[i], label_names[8*(i + 4) + d[1]][0])
+            lines.append(d)
+        return lines
+
+    def statement(self, word, target=None):
+        """Source code of 64-bit instruction ``word``.
+
+        A relative branch refers to label ``target`` if given.
+        """
+
+        d = self.decode(word)
+        if isinstance(d, tuple):
+            cond, imm, kwargs = d
+            if target is None:
+                return _call(cond, [str(imm)] if imm else [], kwargs)
+            return _call(cond, [_label(target)], kwargs)
+        return d
+
+def _label(name):
+    if (re.match(r'[A-Za-z]\w*$', name) and not keyword.iskeyword(name) and
+            not hasattr(LabelEmitter, name) and name != 'asm'):
+        return 'L.' + name
+    return 'L[{!r}]'.format(name)
+
+#=============================== User interface ===============================
+
+_default_disassembler = None
+
+def disassemble(program, labels=None, *args, **kwargs):
+    """Disassemble QPU program to source code.
+
+    :param program: bytes-like object of QPU program or a function decorated
+        by ``@qpu``.  The function is assembled with remaining arguments.
+    :param labels: list of (label, position) pairs returned by
+        ``get_label_positions`` or ``restore_asm``.  Branch targets without
+        labels are named ``L0``, ``L1``, ...
+
+    The result is the body of a function decorated by ``@qpu``. Use
+    :py:func:`load_source` to assemble it again.
+    """
+
+    global _default_disassembler
+    if hasattr(program, '__call__'):
+        program = assemble(program, *args, **kwargs)
+    if _default_disassembler is None:
+        _default_disassembler = Disassembler()
+    return '\n'.join(_default_disassembler.disassemble(program, labels)) + '\n'
+
+def _compile_source(source, name):
+    'Return a function whose body is ``source`` and its globals.'
+    lines = ['    ' + line for line in source.splitlines()]
+    code = 'def {}(asm):\n{}\n    pass\n'.format(name, '\n'.join(lines))
+    g = {}
+    exec(compile(code, '<disassembly>', 'exec'), g)
+    return g[name], g
+
+def load_source(source, name='program'):
+    'Create a function decorated by ``@qpu`` from disassembled source.'
+    return qpu(_compile_source(source, name)[0])
+
+def print_disasm(program, file=sys.stdout, *args, **kwargs):
+    'Print QPU program as source code.'
+    print(disassemble(program, None, *args, **kwargs), end='', file=file)
@@ -3,9 +3,12 @@
 import os
 import struct
 import mmap
+import threading
+from bisect import bisect_right
 from math import ceil
 
 import numpy as np
+from numpy.lib import format as npy_format
 
 import rpi_vcsm.VCSM
 
@@ -15,17 +18,172 @@ from videocore.assembler import assemble
 DEFAULT_MAX_THREADS = 12
 DEFAULT_DATA_AREA_SIZE = 32 * 1024 * 1024
 DEFAULT_CODE_AREA_SIZE = 1024 * 1024
+DEFAULT_ARENA_SIZE = 1024 * 1024
 
 class DriverError(Exception):
     'Exception related to QPU driver'
 
+# Size of cache lines of ARM cores.  Invalidation of a range is widened to
+# cache lines, so host-dirty data sharing the lines is cleaned before.
+CACHE_LINE_SIZE = 64
+
+# Stale ranges closer than this are cleaned by one vcsm call together with
+# the gap between them.
+CACHEOP_COALESCE_GAP = 4096
+
+def _coalesce(ranges, gap):
+    'Merge sorted ranges separated by at most ``gap`` bytes.'
+    merged = []
+    for (s, e) in ranges:
+        if merged and s - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+class _Ranges(object):
+    'Sorted disjoint half-open byte ranges.'
+
+    def __init__(self):
+        self.ranges = []
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def add(self, start, end):
+        'Add [start, end) merging overlapping and adjacent ranges.'
+        if start >= end:
+            return
+        merged = []
+        for (s, e) in self.ranges:
+            if e < start or end < s:
+                merged.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append((start, end))
+        merged.sort()
+        self.ranges = merged
+
+    def take(self, start, end):
+        'Remove [start, end) and return removed ranges.'
+        taken = []
+        rest = []
+        for (s, e) in self.ranges:
+            if e <= start or end <= s:
+                rest.append((s, e))
+                continue
+            if s < start:
+                rest.append((s, start))
+            if end < e:
+                rest.append((end, e))
+            taken.append((max(s, start), min(e, end)))
+        self.ranges = rest
+        return taken
+
+class CacheTracker(object):
+    """Stale ranges of a memory area cached by the host.
+
+    Host-dirty ranges are written by the CPU and not cleaned yet, and
+    device-dirty ranges may be written by QPU after they are invalidated.
+    Ranges are byte offsets from the start of the area.  Only stale ranges
+    are cleaned or invalidated, each contiguous range by one vcsm call.
+
+    :param vcsm: :py:class:`rpi_vcsm.VCSM.VCSM` object.
+    :param usraddr: user virtual address of the area.
+    :param buffer: mmap object of the area.
+    :param size: size of the area.
+    """
+
+    def __init__(self, vcsm, usraddr, buffer, size):
+        self.vcsm = vcsm
+        self.usraddr = usraddr
+        self.size = size
+        self.pointer = np.frombuffer(buffer, np.uint8, count = 1).ctypes.data
+        self.host_dirty = _Ranges()
+        self.device_dirty = _Ranges()
+        self.lock = threading.RLock()
+
+    def extent(self, arr):
+        'Byte range of ``arr`` in the area, or None if it is out of the area.'
+        start = end = arr.__array_interface__['data'][0] - self.pointer
+        for (n, stride) in zip(arr.shape, arr.strides):
+            if n == 0:
+                return None
+            if stride < 0:
+                start += (n - 1) * stride
+            else:
+                end += (n - 1) * stride
+        end += arr.itemsize
+        if start < 0 or self.size < end:
+            return None
+        return (start, end)
+
+    def mark_host(self, start, end):
+        with self.lock:
+            self.host_dirty.add(start, end)
+
+    def mark_device(self, start, end):
+        with self.lock:
+            self.device_dirty.add(start, end)
+
+    def clean(self, start = 0, end = None):
+        'Write host-dirty data in [start, end) back to memory.'
+        if end is None:
+            end = self.size
+        with self.lock:
+            for (s, e) in self.host_dirty.take(start, end):
+                self.vcsm.clean(self.usraddr + s, e - s)
+
+    def clean_ranges(self, ranges):
+        """Clean host-dirty data in ``ranges`` by coalesced vcsm calls.
+
+        Ranges are widened to cache lines, so that lines shared with them are
+        not written back over data written by QPU.
+        """
+        with self.lock:
+            stale = []
+            for (start, end) in ranges:
+                start -= start % CACHE_LINE_SIZE
+                end = min(-(-end // CACHE_LINE_SIZE) * CACHE_LINE_SIZE,
+                          self.size)
+                stale += self.host_dirty.take(start, end)
+            for (s, e) in _coalesce(sorted(stale), CACHEOP_COALESCE_GAP):
+                self.host_dirty.take(s, e)
+                self.vcsm.clean(self.usraddr + s, e - s)
+
+    def invalidate(self, start = 0, end = None):
+        'Discard cached data of device-dirty ranges in [start, end).'
+        if end is None:
+            end = self.size
+        with self.lock:
+            for (s, e) in self.device_dirty.take(start, end):
+                s -= s % CACHE_LINE_SIZE
+                e = min(-(-e // CACHE_LINE_SIZE) * CACHE_LINE_SIZE, self.size)
+                self.clean(s, e)
+                self.device_dirty.take(s, e)
+                self.vcsm.invalidate(self.usraddr + s, e - s)
+
 class Array(np.ndarray):
+    """Array on memory shared with QPU.
+
+    Arrays on memory cached by the host track their stale ranges by
+    :py:class:`CacheTracker`.  Reading or writing elements by indexing and
+    ufuncs invalidates device-dirty ranges of the array, and writing marks
+    them host-dirty so that :py:meth:`Driver.execute` cleans them.  Other
+    writes such as ``fill`` and ``np.copyto`` must be followed by
+    :py:meth:`mark_host_dirty`.  ``astype`` and ``copy`` invalidate the array
+    before reading it, but ``np.asarray`` and other functions reading the
+    buffer directly do not, so call :py:meth:`sync_host` or :py:func:`asarray`
+    before them.
+    """
+
     def __new__(cls, *args, **kwargs):
         vcsm = kwargs.pop('vcsm')
         address = kwargs.pop('address')  # bus address
         usraddr = kwargs.pop('usraddr')
         buffer = kwargs.pop('buffer')
         offset = kwargs.pop('offset')
+        cache = kwargs.pop('cache', None)
 
         try:
             obj = super(Array, cls).__new__(cls, *args, buffer = buffer,
@@ -38,8 +196,86 @@ class Array(np.ndarray):
         obj.usraddr = usraddr
         obj.buffer = buffer
         obj.offset = offset
+        obj.cache = cache
         return obj
 
+    def __array_finalize__(self, obj):
+        self.cache = getattr(obj, 'cache', None)
+
+    def _extent(self, key = None):
+        if key is not None:
+            # A new axis makes a view even for an element.
+            if not isinstance(key, tuple):
+                key = (key,)
+            sub = np.ndarray.__getitem__(self, key + (np.newaxis,))
+            if isinstance(sub, np.ndarray):
+                if sub.size == 0:
+                    return None
+                extent = self.cache.extent(sub)
+                if extent is not None:
+                    return extent
+        return self.cache.extent(self)
+
+    def __getitem__(self, key):
+        if self.cache is not None and self.cache.device_dirty:
+            extent = self._extent(key)
+            if extent is not None:
+                self.cache.invalidate(*extent)
+        return super(Array, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if self.cache is None:
+            return super(Array, self).__setitem__(key, value)
+        extent = self._extent(key)
+        if extent is not None:
+            self.cache.invalidate(*extent)
+        if isinstance(value, Array):
+            value.sync_host()
+        super(Array, self).__setitem__(key, value)
+        if extent is not None:
+            self.cache.mark_host(*extent)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # Operands are passed as ndarray views after they are synchronized.
+        outputs = kwargs.get('out', ())
+        tracked = [x for x in inputs + outputs
+                   if isinstance(x, Array) and x.cache is not None]
+        for arr in tracked:
+            arr.sync_host()
+        args = [x.view(np.ndarray) if isinstance(x, Array) else x
+                for x in inputs]
+        if outputs:
+            kwargs['out'] = tuple(
+                    x.view(np.ndarray) if isinstance(x, Array) else x
+                    for x in outputs)
+        result = getattr(ufunc, method)(*args, **kwargs)
+        # ufunc.at writes the first operand in place.
+        written = inputs[:1] if method == 'at' else outputs
+        for arr in written:
+            if isinstance(arr, Array) and arr.cache is not None:
+                arr.mark_host_dirty()
+        if outputs:
+            return outputs[0] if len(outputs) == 1 else outputs
+        if not isinstance(result, np.ndarray):
+            return result
+        return result.view(type(self))
+
+    def astype(self, *args, **kwargs):
+        self.sync_host()
+        return super(Array, self).astype(*args, **kwargs)
+
+    def copy(self, *args, **kwargs):
+        self.sync_host()
+        return super(Array, self).copy(*args, **kwargs)
+
+    def __repr__(self):
+        self.sync_host()
+        return super(Array, self).__repr__()
+
+    def __str__(self):
+        self.sync_host()
+        return super(Array, self).__str__()
+
     def addresses(self):
         return np.arange(
             self.address,
@@ -52,10 +288,53 @@ class Array(np.ndarray):
     # from memory when user read from the location.
     def invalidate(self):
         self.vcsm.invalidate(self.usraddr, self.nbytes)
+        if self.cache is not None:
+            with self.cache.lock:
+                self.cache.device_dirty.take(self.offset,
+                                             self.offset + self.nbytes)
 
     # Write the content of CPU cache to memory.
     def clean(self):
         self.vcsm.clean(self.usraddr, self.nbytes)
+        if self.cache is not None:
+            with self.cache.lock:
+                self.cache.host_dirty.take(self.offset,
+                                           self.offset + self.nbytes)
+
+    def sync_host(self):
+        'Invalidate device-dirty ranges of the array before host access.'
+        if self.cache is not None:
+            extent = self._extent()
+            if extent is not None:
+                self.cache.invalidate(*extent)
+
+    def sync_device(self):
+        'Clean host-dirty ranges of the array before QPU access.'
+        if self.cache is not None:
+            extent = self._extent()
+            if extent is not None:
+                self.cache.clean(*extent)
+
+    def mark_host_dirty(self):
+        'Mark the array as written by the host.'
+        if self.cache is not None:
+            extent = self._extent()
+            if extent is not None:
+                self.cache.mark_host(*extent)
+
+    def mark_device_dirty(self):
+        'Mark the array as written by QPU.'
+        if self.cache is not None:
+            extent = self._extent()
+            if extent is not None:
+                self.cache.mark_device(*extent)
+
+def asarray(obj, *args, **kwargs):
+    """``np.asarray`` of ``obj`` after device-dirty ranges of it are
+    invalidated if it is an :py:class:`Array`."""
+    if isinstance(obj, Array):
+        obj.sync_host()
+    return np.asarray(obj, *args, **kwargs)
 
 class Memory(object):
     def __init__(self, vcsm, size, cache_mode = rpi_vcsm.CACHE_NONE):
@@ -90,14 +369,22 @@ class Mempool(object):
 
         self.start_pos = {}
         self.cur_pos = {}
+        self.allocations = {}
         total = 0
         for (n, s) in size.items():
             self.start_pos[n] = self.cur_pos[n] = total
+            self.allocations[n] = ([], [])
             total += s
         self.total = total
 
+        self.lock = threading.Lock()
+        self.memory = None
+        self.cache = None
         try:
             self.memory = Memory(self.vcsm, total, cache_mode=cache_mode)
+            if cache_mode in [rpi_vcsm.CACHE_HOST, rpi_vcsm.CACHE_BOTH]:
+                self.cache = CacheTracker(self.vcsm, self.memory.usraddr,
+                                          self.memory.buffer, total)
         except:
             self.close()
             raise
@@ -108,47 +395,185 @@ class Mempool(object):
         if self.memory:
             self.memory.close()
         self.memory = None
+        self.cache = None
         self.start_pos = None
         self.cur_pos = None
+        self.allocations = None
 
-    def alloc(self, name, *args, **kwargs):
-        pos = self.cur_pos[name]
-        arr = Array(
+    def array(self, pos, *args, **kwargs):
+        'Array at byte offset ``pos`` of the pool.'
+        return Array(
                 *args,
                 vcsm = self.vcsm,
                 address = self.memory.busaddr + pos,
                 usraddr = self.memory.usraddr + pos,
                 buffer  = self.memory.buffer,
                 offset  = pos,
+                cache   = self.cache,
                 **kwargs)
-        if (pos - self.start_pos[name]) + arr.nbytes > self.size[name]:
+
+    def alloc(self, name, *args, **kwargs):
+        with self.lock:
+            pos = self.cur_pos[name]
+            arr = self.array(pos, *args, **kwargs)
+            self._bump(name, arr.nbytes)
+        return arr
+
+    def reserve(self, name, size):
+        'Reserve ``size`` bytes and return the offset of them.'
+        with self.lock:
+            pos = self.cur_pos[name]
+            self._bump(name, size)
+        return pos
+
+    def _bump(self, name, size):
+        pos = self.cur_pos[name]
+        if (pos - self.start_pos[name]) + size > self.size[name]:
             raise DriverError('Array too large')
-        self.cur_pos[name] += arr.nbytes
+        self.cur_pos[name] += size
+        if size > 0:
+            (starts, ends) = self.allocations[name]
+            starts.append(pos)
+            ends.append(pos + size)
+
+    def allocation(self, name, address):
+        'Byte range of the array allocated at bus ``address``, or None.'
+        (starts, ends) = self.allocations[name]
+        pos = int(address) - self.memory.busaddr
+        i = bisect_right(starts, pos) - 1
+        if i < 0 or ends[i] <= pos:
+            return None
+        return (starts[i], ends[i])
+
+def _nbytes(shape, dtype = float, *args, **kwargs):
+    'Size of an array of arguments of :py:class:`numpy.ndarray`.'
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+class Arena(object):
+    """Range of a memory pool reserved by a thread.
+
+    Arrays are allocated from the range without locking the pool.  The whole
+    range is one allocation for :py:meth:`Mempool.allocation`.
+    """
+
+    def __init__(self, pool, name, size):
+        self.pool = pool
+        self.pos = pool.reserve(name, size)
+        self.end = self.pos + size
+
+    def alloc(self, *args, **kwargs):
+        arr = self.pool.array(self.pos, *args, **kwargs)
+        if self.pos + arr.nbytes > self.end:
+            raise DriverError('Array too large')
+        self.pos += arr.nbytes
         return arr
 
+def view(arr, shape, dtype):
+    'Device array of ``shape`` and ``dtype`` sharing memory with ``arr``.'
+    return Array(shape, dtype, vcsm = arr.vcsm, address = arr.address,
+                 usraddr = arr.usraddr, buffer = arr.buffer,
+                 offset = arr.offset, cache = arr.cache)
+
+def _overlaps(a, b):
+    return (a.address < b.address + b.nbytes and
+            b.address < a.address + a.nbytes)
+
+class Workspace(object):
+    """Device buffers reused across calls.
+
+    Buffers are allocated from the driver and grow when larger one is
+    requested.
+    """
+
+    def __init__(self, drv):
+        self.drv = drv
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buf = self.buffers.get(name)
+        if buf is None or buf.nbytes < nbytes:
+            buf = self.buffers[name] = self.drv.alloc(max(nbytes, 1), 'uint8')
+        return view(buf, shape, dtype)
+
+    def output(self, name, shape, dtype, inputs = ()):
+        """Buffer ``name`` for results returned by a call, as :py:meth:`get`.
+
+        Results are overwritten by the next call.  If the buffer overlaps
+        ``inputs``, e.g. the result of the previous call is passed again,
+        another buffer is used.
+        """
+        inputs = [x for x in inputs if hasattr(x, 'address')]
+        for k in range(len(inputs) + 1):
+            out = self.get('{}.{}'.format(name, k) if k else name, shape,
+                           dtype)
+            if not any(_overlaps(out, x) for x in inputs):
+                return out
+
 class Program(object):
-    def __init__(self, code_addr, usraddr, code, size):
+    def __init__(self, code_addr, usraddr, code, size,
+                 input_uniforms = None, output_uniforms = None):
         self.address = code_addr
         self.usraddr = usraddr
         self.code    = code
         self.size    = size
+        # Indices of uniforms of each thread which are addresses of buffers
+        # read and written by the program.  None if they are not declared.
+        self.input_uniforms  = input_uniforms
+        self.output_uniforms = output_uniforms
+
+    @property
+    def declares_buffers(self):
+        return (self.input_uniforms is not None or
+                self.output_uniforms is not None)
 
 class Driver(object):
+    """QPU driver.
+
+    Launches of :py:meth:`execute` are serialized by a lock and uniforms are
+    staged in a buffer of each thread, so that several threads can share a
+    driver.  If ``thread_safe`` is True, each thread also allocates arrays
+    from its own arena of ``arena_size`` bytes without locking the memory
+    pool except when it reserves a new arena.
+
+    Functions of library modules such as :py:func:`videocore.gemm.sgemm`
+    and :py:func:`videocore.reduce.sum`, and the helpers behind them, e.g.
+    :py:class:`videocore.gemm.Sgemm`, :py:class:`videocore.conv.Conv2D`,
+    :py:class:`videocore.fft.FFT`, :py:class:`videocore.image.ImageProcessor`
+    and :py:class:`videocore.persistent.PersistentLauncher`, hold a lock of
+    the helper while they stage parameters in its buffers, launch and read
+    results, so they may also be called from several threads.  Calls of a
+    helper are serialized even when the driver is not.
+
+    If ``governor`` is a :py:class:`videocore.governor.Governor`, launches
+    are timed by it and clocks are adjusted to hold its target temperature.
+
+    If ``tracer`` is a :py:class:`videocore.trace.Tracer`, phases of
+    :py:meth:`program`, :py:meth:`array`, :py:meth:`execute` and
+    :py:meth:`load_bin` are recorded to it.  It can also be set to the
+    ``tracer`` attribute at any time.
+    """
+
     def __init__(self,
             data_area_size = DEFAULT_DATA_AREA_SIZE,
             code_area_size = DEFAULT_CODE_AREA_SIZE,
             max_threads    = DEFAULT_MAX_THREADS,
-            cache_mode     = rpi_vcsm.CACHE_NONE
+            cache_mode     = rpi_vcsm.CACHE_NONE,
+            thread_safe    = False,
+            arena_size     = DEFAULT_ARENA_SIZE,
+            governor       = None,
+            tracer         = None
             ):
+        self.thread_safe = thread_safe
+        self.governor = governor
+        self.tracer = tracer
+        self.arena_size = arena_size
+        self.launch_lock = threading.Lock()
+        self._local = threading.local()
         self.mailbox = MailBox()
         self.mailbox.enable_qpu(1)
         self.vcsm = rpi_vcsm.VCSM.VCSM()
 
-        if cache_mode in [rpi_vcsm.CACHE_HOST, rpi_vcsm.CACHE_BOTH]:
-            self.is_cacheop_needed = True
-        else:
-            self.is_cacheop_needed = False
-
         self.max_threads = max_threads
         message_area_size = max_threads * 2 * 4
 
@@ -194,50 +619,213 @@ class Driver(object):
         return new_arr
 
     def alloc(self, *args, **kwargs):
-        return self.datmem.alloc('data', *args, **kwargs)
+        if not self.thread_safe:
+            return self.datmem.alloc('data', *args, **kwargs)
+        if _nbytes(*args, **kwargs) > self.arena_size // 4:
+            return self.datmem.alloc('data', *args, **kwargs)
+        arena = getattr(self._local, 'arena', None)
+        try:
+            return arena.alloc(*args, **kwargs)
+        except (AttributeError, DriverError):
+            pass
+        arena = self._local.arena = Arena(self.datmem, 'data', self.arena_size)
+        return arena.alloc(*args, **kwargs)
 
     def array(self, *args, **kwargs):
-        arr = np.array(*args, copy = False, **kwargs)
+        tracer = self.tracer
+        if tracer:
+            start = tracer.now()
+        arr = asarray(*args, **kwargs)
         new_arr = self.alloc(arr.shape, arr.dtype)
         new_arr[:] = arr
+        if tracer:
+            tracer.record('array', start, bytes = new_arr.nbytes)
         return new_arr
 
+    def _stage_uniforms(self, uniforms):
+        'Copy uniforms to the staging buffer of the current thread.'
+        uniforms = np.asarray(uniforms, dtype = 'u4')
+        buf = getattr(self._local, 'uniforms', None)
+        if buf is None or buf.size < uniforms.size:
+            size = max(uniforms.size, 2 * buf.size if buf is not None else 256)
+            buf = self._local.uniforms = self.alloc(size, 'u4')
+        staged = Array(uniforms.shape, 'u4', vcsm = buf.vcsm,
+                       address = buf.address, usraddr = buf.usraddr,
+                       buffer = buf.buffer, offset = buf.offset,
+                       cache = buf.cache)
+        staged[...] = uniforms
+        return staged
+
+    def from_file(self, file, dtype = None, shape = None, offset = 0):
+        """Read an array from a file directly into device memory.
+
+        :param file: path or binary file object.
+        :param dtype: type of elements.  If None, ``file`` is read as a .npy
+            file and ``shape`` and ``offset`` are taken from its header.
+        :param shape: shape of the array.  Default is all elements from
+            ``offset`` to the end of the file.
+        :param offset: byte offset of the array in the file.
+        """
+        if not hasattr(file, 'readinto'):
+            with open(file, 'rb') as f:
+                return self.from_file(f, dtype, shape, offset)
+        if dtype is None:
+            file.seek(offset)
+            if npy_format.read_magic(file) == (1, 0):
+                header = npy_format.read_array_header_1_0(file)
+            else:
+                header = npy_format.read_array_header_2_0(file)
+            (shape, fortran_order, dtype) = header
+            if fortran_order or dtype.hasobject:
+                raise DriverError('Unsupported .npy file')
+            offset = file.tell()
+        dtype = np.dtype(dtype)
+        if shape is None:
+            file.seek(0, os.SEEK_END)
+            shape = (file.tell() - offset) // dtype.itemsize
+        arr = self.alloc(shape, dtype)
+        dest = memoryview(arr.buffer)[arr.offset:arr.offset+arr.nbytes]
+        file.seek(offset)
+        pos = 0
+        while pos < arr.nbytes:
+            n = file.readinto(dest[pos:])
+            if not n:
+                raise DriverError('File too short')
+            pos += n
+        arr.mark_host_dirty()
+        return arr
+
     def program(self, program, *args, **kwargs):
+        """Load QPU program.
+
+        ``input_uniforms`` and ``output_uniforms`` keyword arguments are
+        indices of uniforms of each thread which are addresses of arrays read
+        and written by the program.  With memory cached by the host,
+        :py:meth:`execute` cleans only these arrays and the uniforms before
+        launching the program, and marks only the output arrays as written
+        by QPU.  Otherwise all arrays are assumed to be read and written.
+        """
+        input_uniforms = kwargs.pop('input_uniforms', None)
+        output_uniforms = kwargs.pop('output_uniforms', None)
+        tracer = self.tracer
+        if tracer:
+            start = t = tracer.now()
+        name = getattr(program, '__name__', None)
         if hasattr(program, '__call__'):
             program = assemble(program, *args, **kwargs)
+            if tracer:
+                t = tracer.record('assemble', t, kernel = name)
         code = memoryview(program).tobytes()
+        program = self._upload(code, input_uniforms, output_uniforms)
+        if tracer:
+            tracer.record('upload', t, bytes = len(code))
+            tracer.record('program', start, kernel = name, bytes = len(code))
+        return program
+
+    def _upload(self, code, input_uniforms, output_uniforms):
+        'Copy ``code`` to the code area.'
         arr = self.ctlmem.alloc('code', shape = int(ceil(len(code) / 8.0)),
                                 dtype = np.uint64)
         arr.buffer[arr.offset:arr.offset+len(code)] = code
-        return Program(arr.address, arr.usraddr, code, len(code))
-
-    def execute(self, n_threads, program, uniforms = None, timeout = 10000):
+        return Program(arr.address, arr.usraddr, code, len(code),
+                       input_uniforms, output_uniforms)
+
+    def _buffer_ranges(self, uniforms, n_threads, indices):
+        'Byte ranges of arrays whose addresses are ``indices`` of uniforms.'
+        if uniforms is None or not indices:
+            return []
+        uniforms = np.asarray(uniforms).reshape(n_threads, -1)
+        ranges = set()
+        for address in np.unique(uniforms[:, list(indices)]):
+            extent = self.datmem.allocation('data', address)
+            if extent is not None:
+                ranges.add(extent)
+        return sorted(ranges)
+
+    def execute(self, n_threads, program, uniforms = None, timeout = 10000,
+                work = 0):
+        """Launch ``program`` on ``n_threads`` QPU threads.
+
+        ``work`` is the amount of work of the launch, e.g. flop, recorded by
+        the governor.
+        """
         if not (1 <= n_threads and n_threads <= self.max_threads):
             raise DriverError('n_threads exceeds max_threads')
 
+        tracer = self.tracer
+        if tracer:
+            start = t = tracer.now()
+        if uniforms is not None and not isinstance(uniforms, Array):
+            uniforms = self._stage_uniforms(uniforms)
+            if tracer:
+                t = tracer.record('stage_uniforms', t,
+                                  bytes = uniforms.nbytes)
+        with self.launch_lock:
+            if tracer:
+                tracer.record('lock_wait', t)
+            if self.governor is None:
+                self._launch(n_threads, program, uniforms, timeout)
+            else:
+                self.governor.launch(
+                    lambda: self._launch(n_threads, program, uniforms,
+                                         timeout), work)
+        if tracer:
+            tracer.record('execute', start, n_threads = n_threads,
+                          program_size = program.size)
+
+    def _launch(self, n_threads, program, uniforms, timeout):
+        tracer = self.tracer
+        if tracer:
+            t = tracer.now()
         message = self.message
 
         if uniforms is not None:
-            if not isinstance(uniforms, Array):
-                uniforms = self.array(uniforms, dtype = 'u4')
             message[:n_threads, 0] = uniforms.addresses().reshape(n_threads, -1)[:, 0]
         else:
             message[:n_threads, 0] = 0
 
         message[:n_threads, 1] = program.address
-
-        if self.is_cacheop_needed:
-            uniforms.clean()
+        if tracer:
+            t = tracer.record('message', t)
+
+        cache = self.datmem.cache
+        if cache is not None and program.declares_buffers:
+            inputs = self._buffer_ranges(uniforms, n_threads,
+                                         program.input_uniforms)
+            outputs = self._buffer_ranges(uniforms, n_threads,
+                                          program.output_uniforms)
+            if uniforms is not None:
+                extent = self.datmem.allocation('data', uniforms.address)
+                if extent is not None:
+                    inputs.append(extent)
+            cache.clean_ranges(inputs + outputs)
+        elif cache is not None:
+            cache.clean()
+        if tracer and cache is not None:
+            t = tracer.record('clean', t)
         r = self.mailbox.execute_qpu(n_threads, message.address, 0, timeout)
-        if self.is_cacheop_needed:
-            uniforms.invalidate()
+        if tracer:
+            t = tracer.record('execute_qpu', t, n_threads = n_threads)
+        if cache is not None and program.declares_buffers:
+            for (start, end) in outputs:
+                cache.mark_device(start, end)
+        elif cache is not None:
+            # Any allocated range may be written by the program.
+            cache.mark_device(0, self.datmem.cur_pos['data'])
+        if tracer and cache is not None:
+            tracer.record('mark_device', t)
         if r > 0:
             raise DriverError('QPU execution timeout')
 
     def load_bin(self, file, *args, **kwargs):
+        tracer = self.tracer
+        if tracer:
+            start = tracer.now()
         with open(file, 'rb') as f:
             code = f.read()
-        arr = self.ctlmem.alloc('code', shape = int(ceil(len(code) / 8.0)),
-                                dtype = np.uint64)
-        arr.buffer[arr.offset:arr.offset+len(code)] = code
-        return Program(arr.address, arr.usraddr, code, len(code))
+        program = self._upload(code, kwargs.get('input_uniforms'),
+                               kwargs.get('output_uniforms'))
+        if tracer:
+            tracer.record('load_bin', start, file = str(file),
+                          bytes = len(code))
+        return program
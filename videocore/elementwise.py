@@ -0,0 +1,582 @@
+"""Elementwise kernels.
+
+This module generates a fused QPU kernel from an arithmetic expression over
+device arrays, like NumPy ufuncs.
+
+>>> axpy = ElementwiseKernel(drv, 'a*x + y')
+>>> Z = axpy(a=2.0, x=X, y=Y)
+
+Names bound to :py:class:`videocore.driver.Array` are elementwise operands and
+names bound to numbers are scalars which are passed to the kernel as uniforms,
+so that the same kernel is reused for different scalar values.  All operations
+in the expression are computed in one pass over the arrays.
+
+The following operations are available.
+
+* float32: ``+``, ``-``, ``*``, ``/``, unary ``-``, ``max``, ``min``,
+  ``abs``, ``recip``, ``recipsqrt``, ``sqrt``, ``exp2`` and ``log2``.
+* int32: ``+``, ``-``, ``*``, unary ``-``, ``max``, ``min`` and ``abs``.
+
+``/``, ``recip``, ``recipsqrt``, ``sqrt``, ``exp2`` and ``log2`` are computed
+by the special function unit, whose results are approximations (relative error
+is about 1e-4, worse for ``log2``).  ``*`` of int32 is signed 24-bit
+multiplication, i.e. operands must be in [-2**23, 2**23).
+
+Each thread processes a contiguous range of 16-element vectors.  Operands are
+loaded by TMU one vector ahead and results are stored by VPM DMA, so that the
+loads, computation and the store of the previous vector overlap.  Addresses of
+the last vector are clamped to the end of the arrays and its DMA store is
+narrowed, so arrays of any length can be processed.
+"""
+
+import ast
+import numbers
+import threading
+from math import ceil
+
+import numpy as np
+
+from videocore.assembler import qpu, AssembleError
+from videocore.encoding import REGISTERS, _SMALL_IMM
+from videocore.driver import DriverError, Workspace
+
+#================================= Expression =================================
+
+_FUNCTIONS = {
+    'max': 'max', 'maximum': 'max', 'min': 'min', 'minimum': 'min',
+    'abs': 'abs', 'recip': 'recip', 'recipsqrt': 'recipsqrt', 'sqrt': 'sqrt',
+    'exp2': 'exp2', 'log2': 'log2',
+    }
+
+_BINARY_OPS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/'}
+
+# Supported operations of each data type.
+_OPERATIONS = {
+    'float32': set(['+', '-', '*', '/', 'neg', 'max', 'min', 'abs', 'recip',
+                    'recipsqrt', 'sqrt', 'exp2', 'log2']),
+    'int32': set(['+', '-', '*', 'neg', 'max', 'min', 'abs']),
+    }
+
+class Expression(object):
+    """Parsed elementwise expression.
+
+    The expression is stored in ``nodes`` as a list of tuples in topological
+    order.  Each node is one of ``('name', name)``, ``('const', value)`` and
+    ``(op, i, ...)`` where ``i`` are indices of operand nodes.  Common
+    subexpressions are shared.
+    """
+
+    def __init__(self, source, dtype='float32'):
+        if dtype not in _OPERATIONS:
+            raise AssembleError('Unsupported data type {}'.format(dtype))
+        self.source = source
+        self.dtype = dtype
+        self.nodes = []
+        self._index = {}
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise AssembleError('Invalid expression: {}'.format(e))
+        self.root = self._visit(tree.body)
+        self.names = sorted(set(
+            node[1] for node in self.nodes if node[0] == 'name'))
+
+    def _add(self, node):
+        if node not in self._index:
+            self._index[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self._index[node]
+
+    def _const(self, value):
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            raise AssembleError('Unsupported constant {!r}'.format(value))
+        if self.dtype == 'float32':
+            value = float(value)
+        elif value != int(value):
+            raise AssembleError('Non-integer constant {!r}'.format(value))
+        else:
+            value = int(value)
+        return self._add(('const', value))
+
+    def _op(self, op, *args):
+        if op not in _OPERATIONS[self.dtype]:
+            raise AssembleError('\'{}\' is not supported for {}'.format(
+                op, self.dtype))
+        if op == '/':
+            return self._add(('*', args[0], self._add(('recip', args[1]))))
+        if op == 'sqrt':
+            return self._add(('recip', self._add(('recipsqrt', args[0]))))
+        return self._add((op,) + args)
+
+    def _visit(self, node):
+        if isinstance(node, ast.Name):
+            return self._add(('name', node.id))
+        if isinstance(node, getattr(ast, 'Constant', ())):
+            return self._const(node.value)
+        if isinstance(node, getattr(ast, 'Num', ())):
+            return self._const(node.n)
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.UAdd):
+                return self._visit(node.operand)
+            if isinstance(node.op, ast.USub):
+                if isinstance(node.operand, getattr(ast, 'Num', ())):
+                    return self._const(-node.operand.n)
+                if isinstance(node.operand, getattr(ast, 'Constant', ())):
+                    return self._const(-node.operand.value)
+                return self._op('neg', self._visit(node.operand))
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return self._op(_BINARY_OPS[type(node.op)],
+                            self._visit(node.left), self._visit(node.right))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+                node.func.id in _FUNCTIONS and not node.keywords):
+            op = _FUNCTIONS[node.func.id]
+            nargs = 2 if op in ['max', 'min'] else 1
+            if len(node.args) != nargs:
+                raise AssembleError('{} takes {} arguments'.format(
+                    node.func.id, nargs))
+            return self._op(op, *[self._visit(arg) for arg in node.args])
+        raise AssembleError('Unsupported expression: {}'.format(
+            ast.dump(node)))
+
+#=============================== Code generation ==============================
+
+# Register assignment of the kernel.
+#   ra0       : byte offsets of elements of the next vector
+#   ra1..ra8  : base addresses of input arrays
+#   ra9       : number of remaining vectors
+#   rb0       : byte offset of the last element of the thread
+#   rb1       : address of the next vector of the output
+#   rb2, rb3  : DMA store setup of normal and last vector
+#   rb4       : VPM write setup
+#   rb6..rb13 : scalars
+#   rb14      : thread index
+#   rb15      : number of threads
+#   others    : temporaries
+MAX_INPUTS = 8
+MAX_SCALARS = 8
+_TEMPORARIES = ([REGISTERS['ra{}'.format(i)] for i in range(10, 32)],
+                [REGISTERS['rb{}'.format(i)] for i in range(16, 32)])
+
+# Semaphore used to notify completion of threads.
+_COMPLETED = 0
+
+_ALU_OPS = {
+    'float32': {'+': 'fadd', '-': 'fsub', '*': 'fmul', 'max': 'fmax',
+                'min': 'fmin', 'neg': 'fsub'},
+    'int32': {'+': 'iadd', '-': 'isub', '*': 'imul24', 'max': 'imax',
+              'min': 'imin', 'neg': 'isub'},
+    }
+
+_SFU = {'recip': 'sfu_recip', 'recipsqrt': 'sfu_recipsqrt',
+        'exp2': 'sfu_exp2', 'log2': 'sfu_log2'}
+
+def _regfile(opd):
+    'Regfile of read operand: \'a\', \'b\', \'imm\' or None for accumulators.'
+    if not hasattr(opd, 'name'):
+        return 'imm'
+    if opd.name.startswith('ra'):
+        return 'a'
+    if opd.name.startswith('rb'):
+        return 'b'
+    return None
+
+class _CodeGen(object):
+    """Emit instructions computing an expression.
+
+    A value written to a regfile can not be read by the next instruction, so
+    a nop is inserted in such case.  Accumulators r0-r3 are used as scratch.
+    """
+
+    def __init__(self, asm, expr, inputs, scalars):
+        """
+        :param inputs: list of (name, TMU) pairs in the order of loads.
+        :param scalars: dict of registers holding scalars.
+        """
+        self.asm = asm
+        self.expr = expr
+        self.values = {}
+        self.written = None
+        self.turn = 1
+        self.free = (list(_TEMPORARIES[0]), list(_TEMPORARIES[1]))
+        self.uses = [0] * len(expr.nodes)
+        for node in expr.nodes:
+            if node[0] not in ['name', 'const']:
+                for i in node[1:]:
+                    self.uses[i] += 1
+        self.uses[expr.root] += 1
+        for i, node in enumerate(expr.nodes):
+            if node[0] == 'name' and node[1] in scalars:
+                self.values[i] = scalars[node[1]]
+            elif node[0] == 'const':
+                self.values[i] = node[1]
+        nodes = {node[1]: i for i, node in enumerate(expr.nodes)
+                 if node[0] == 'name'}
+        self.inputs = [(nodes[name], unit) for name, unit in inputs]
+
+    def emit(self, op, *args, **kwargs):
+        if self.written is not None and any(
+                getattr(src, 'name', None) == self.written.name
+                for src in args[1:]):
+            self.asm.nop()
+        getattr(self.asm, op)(*args, **kwargs)
+        if args and _regfile(args[0]) in ['a', 'b']:
+            self.written = args[0]
+        else:
+            self.written = None
+
+    def alloc(self):
+        'Allocate a temporary from regfile A and B alternately.'
+        self.turn = 1 - self.turn
+        pool = self.free[self.turn] or self.free[1 - self.turn]
+        if not pool:
+            raise AssembleError('Expression is too complex')
+        return pool.pop(0)
+
+    def release(self, reg):
+        if reg in _TEMPORARIES[0]:
+            self.free[0].insert(0, reg)
+        elif reg in _TEMPORARIES[1]:
+            self.free[1].insert(0, reg)
+
+    def operand(self, i, acc):
+        'Location of node ``i`` readable as an ALU operand.'
+        value = self.values[i]
+        if _regfile(value) != 'imm' or repr(value) in _SMALL_IMM:
+            return value
+        self.emit('ldi', acc, value)
+        return acc
+
+    def operands(self, i, j):
+        a = self.operand(i, REGISTERS['r0'])
+        b = self.operand(j, REGISTERS['r1'])
+        fa, fb = _regfile(a), _regfile(b)
+        if fa == fb == 'imm':
+            conflict = _SMALL_IMM[repr(a)] != _SMALL_IMM[repr(b)]
+        elif fa == fb and fa is not None:
+            conflict = a.name != b.name
+        else:
+            conflict = set([fa, fb]) == set(['imm', 'b'])
+        if conflict:
+            if fa == 'b' and fb == 'imm':
+                self.emit('mov', REGISTERS['r0'], a)
+                a = REGISTERS['r0']
+            else:
+                self.emit('mov', REGISTERS['r1'], b)
+                b = REGISTERS['r1']
+        return a, b
+
+    def imul(self, i, j):
+        """Signed multiplication of nodes ``i`` and ``j`` into r0.
+
+        imul24 multiplies unsigned 24-bit integers, so absolute values are
+        multiplied and the sign is fixed after that.
+        """
+        r0, r1, r2, r3 = [REGISTERS['r{}'.format(k)] for k in range(4)]
+        for reg, k in [(r0, i), (r1, j)]:
+            opd = self.operand(k, reg)
+            if opd is not reg:
+                self.emit('mov', reg, opd)
+        self.emit('bxor', r2, r0, r1)
+        self.emit('isub', r3, 0, r0)
+        self.emit('imax', r0, r0, r3)
+        self.emit('isub', r3, 0, r1)
+        self.emit('imax', r1, r1, r3)
+        self.emit('imul24', r0, r0, r1)
+        self.emit('isub', r1, 0, r0)
+        self.emit('mov', REGISTERS['null'], r2, set_flags=True)
+        self.emit('mov', r0, r1, cond='ns')
+
+    def use(self, i):
+        self.uses[i] -= 1
+        if self.uses[i] == 0:
+            self.release(self.values[i])
+
+    def load_inputs(self, receive):
+        'Receive loaded vectors of input arrays.'
+        for i, unit in self.inputs:
+            dst = self.alloc()
+            receive(unit)
+            self.emit('mov', dst, REGISTERS['r4'])
+            self.values[i] = dst
+
+    def compute(self):
+        'Emit instructions and return location of the result.'
+        ops = _ALU_OPS[self.expr.dtype]
+        zero = 0.0 if self.expr.dtype == 'float32' else 0
+        for i, node in enumerate(self.expr.nodes):
+            op = node[0]
+            if op in ['name', 'const']:
+                continue
+            if op in _SFU:
+                a = self.operand(node[1], REGISTERS['r0'])
+                self.emit('mov', REGISTERS[_SFU[op]], a)
+                self.emit('nop')
+                self.emit('nop')
+                self.use(node[1])
+                dst = self.alloc()
+                self.emit('mov', dst, REGISTERS['r4'])
+            elif op == 'neg':
+                a = self.operand(node[1], REGISTERS['r0'])
+                if _regfile(a) == 'b':
+                    self.emit('mov', REGISTERS['r0'], a)
+                    a = REGISTERS['r0']
+                self.use(node[1])
+                dst = self.alloc()
+                self.emit(ops['neg'], dst, zero, a)
+            elif op == 'abs':
+                a = self.operand(node[1], REGISTERS['r0'])
+                self.use(node[1])
+                dst = self.alloc()
+                if self.expr.dtype == 'float32':
+                    self.emit('fmaxabs', dst, a, a)
+                else:
+                    if _regfile(a) == 'b':
+                        self.emit('mov', REGISTERS['r0'], a)
+                        a = REGISTERS['r0']
+                    self.emit('isub', REGISTERS['r1'], 0, a)
+                    self.emit('imax', dst, a, REGISTERS['r1'])
+            elif op == '*' and self.expr.dtype == 'int32':
+                self.imul(node[1], node[2])
+                self.use(node[1])
+                self.use(node[2])
+                dst = self.alloc()
+                self.emit('mov', dst, REGISTERS['r0'])
+            else:
+                a, b = self.operands(node[1], node[2])
+                self.use(node[1])
+                self.use(node[2])
+                dst = self.alloc()
+                self.emit(ops[op], dst, a, b)
+            self.values[i] = dst
+        return self.values[self.expr.root]
+
+    def finish(self):
+        'Release the result.'
+        self.use(self.expr.root)
+
+@qpu
+def elementwise_kernel(asm, expr, inputs, scalars):
+    """Elementwise kernel computing ``expr``.
+
+    :param expr: :py:class:`Expression`.
+    :param inputs: names of input arrays.
+    :param scalars: names of scalars.
+
+    Uniforms of each thread are number of vectors, byte offset of the last
+    element, output address, DMA store setups of normal and last vector, VPM
+    write setup, thread index, number of threads, addresses of the first
+    element of inputs, then scalars.
+    """
+
+    if len(inputs) > MAX_INPUTS or len(scalars) > MAX_SCALARS:
+        raise AssembleError('Too many operands')
+
+    # Up to four inputs are loaded by each TMU.
+    units = {name: 0 if k < 4 else 1 for k, name in enumerate(inputs)}
+    input_regs = {name: ra[1+k] for k, name in enumerate(inputs)}
+    scalar_regs = {name: rb[6+k] for k, name in enumerate(scalars)}
+    tmu_s = [tmu0_s, tmu1_s]
+
+    def issue_loads():
+        ldi(r3, 64)
+        if inputs:
+            imin(r0, ra0, rb0)
+            for name in inputs:
+                iadd(tmu_s[units[name]], input_regs[name], r0)
+            iadd(ra0, ra0, r3)
+
+    def receive(unit):
+        nop(sig='load tmu{}'.format(unit))
+
+    mov(tmu_noswap, 1)
+    mov(ra9, uniform)
+    mov(rb0, uniform)
+    mov(rb1, uniform)
+    mov(rb2, uniform)
+    mov(rb3, uniform)
+    mov(rb4, uniform)
+    mov(rb14, uniform)
+    mov(rb15, uniform)
+    for name in inputs:
+        mov(input_regs[name], uniform)
+    for name in scalars:
+        mov(scalar_regs[name], uniform)
+    shl(ra0, element_number, 2)
+    mov(null, ra9, set_flags=True)
+    jzs(L.end)
+    nop(); nop(); nop()
+
+    issue_loads()
+
+    L.loop
+
+    gen = _CodeGen(asm, expr, [(name, units[name]) for name in inputs],
+                   scalar_regs)
+    gen.load_inputs(receive)
+    issue_loads()
+    gen.written = None
+    result = gen.compute()
+
+    # Store the result after the store of the previous vector finished.
+    wait_dma_store()
+    mov(vpmvcd_wr_setup, rb4)
+    if _regfile(result) == 'imm':
+        ldi(r0, result)
+        result = r0
+    mov(vpm, result)
+    gen.finish()
+    isub(null, ra9, 1)
+    mov(r2, rb2)
+    mov(r2, rb3, cond='zs')
+    mov(vpmvcd_wr_setup, r2)
+    start_dma_store(rb1)
+    ldi(r3, 64)
+    iadd(rb1, rb1, r3)
+
+    isub(ra9, ra9, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+
+    # Discard prefetched vectors.
+    for name in inputs:
+        receive(units[name])
+    wait_dma_store()
+
+    L.end
+
+    sema_up(_COMPLETED)
+    mov(null, rb14, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+
+    # Only thread 0 enters here.
+    mov(r0, rb15)
+    L.sem_down
+    sema_down(_COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    interrupt()
+
+    L.skip_fin
+
+    exit(interrupt=False)
+
+#================================ Host program ================================
+
+def _dma_store_setup(ncols, Y):
+    'Same as ``setup_dma_store(nrows=1, ncols=ncols, Y=Y)``.'
+    return 0x80000000 | 1 << 23 | (ncols & 0x7f) << 16 | 1 << 14 | Y << 7
+
+def _vpm_write_setup(Y, stride=1):
+    'Same as ``setup_vpm_write(Y=Y, stride=stride)``.'
+    return stride << 12 | 1 << 11 | 2 << 8 | Y
+
+def partition(n, n_threads, unit=16):
+    """Partition ``n`` elements into ranges of ``unit``-element vectors.
+
+    Return (number of threads, start element, element count) where the last
+    two are arrays of length of the number of threads.
+    """
+
+    nvec = int(ceil(n / float(unit)))
+    n_threads = max(1, min(n_threads, nvec))
+    vecs = np.full(n_threads, nvec // n_threads, dtype='int64')
+    vecs[:nvec % n_threads] += 1
+    start = unit * np.concatenate([[0], np.cumsum(vecs)[:-1]])
+    count = np.minimum(unit * vecs, n - start)
+    return n_threads, start, count
+
+class ElementwiseKernel(object):
+    """Elementwise kernel.
+
+    :param drv: :py:class:`videocore.driver.Driver`.
+    :param source: expression like ``'a*x + y'``.
+    :param dtype: ``'float32'`` or ``'int32'``.
+    :param max_threads: maximum number of threads.  Default is that of the
+        driver.
+
+    Without ``out``, results are written to a buffer of the kernel which is
+    overwritten by the next call.
+    """
+
+    def __init__(self, drv, source, dtype='float32', max_threads=None):
+        self.drv = drv
+        self.dtype = np.dtype(dtype)
+        self.expression = Expression(source, self.dtype.name)
+        self.max_threads = max_threads or drv.max_threads
+        self.workspace = Workspace(drv)
+        self.lock = threading.Lock()
+        self._programs = {}
+
+    def program(self, inputs, scalars):
+        'Return QPU program for given names of input arrays and scalars.'
+        key = (tuple(inputs), tuple(scalars))
+        if key not in self._programs:
+            self._programs[key] = self.drv.program(
+                elementwise_kernel, self.expression, list(inputs),
+                list(scalars), input_uniforms=range(8, 8 + len(inputs)),
+                output_uniforms=[2])
+        return self._programs[key]
+
+    def __call__(self, out=None, **operands):
+        names = self.expression.names
+        if sorted(operands) != names:
+            raise DriverError('Operands must be {}'.format(', '.join(names)))
+        inputs = [name for name in names
+                  if not isinstance(operands[name], numbers.Number)]
+        scalars = [name for name in names if name not in inputs]
+
+        shape = None
+        for name in inputs:
+            arr = operands[name]
+            if not hasattr(arr, 'address'):
+                raise DriverError('{} is not a device array'.format(name))
+            if arr.dtype != self.dtype or not arr.flags.c_contiguous:
+                raise DriverError(
+                    '{} must be a contiguous {} array'.format(
+                        name, self.dtype))
+            if shape is None:
+                shape = arr.shape
+            elif arr.size != operands[inputs[0]].size:
+                raise DriverError('Size mismatch of {}'.format(name))
+        if out is None:
+            if shape is None:
+                raise DriverError('Output array is required')
+            with self.lock:
+                out = self.workspace.output(
+                    'out', shape, self.dtype,
+                    [operands[name] for name in inputs])
+                return self(out=out, **operands)
+        elif (not hasattr(out, 'address') or out.dtype != self.dtype or
+                not out.flags.c_contiguous or
+                (shape is not None and out.size != np.prod(shape))):
+            raise DriverError('Invalid output array')
+        if out.size == 0:
+            return out
+
+        n_threads, start, count = partition(out.size, self.max_threads)
+        threads = np.arange(n_threads)
+        nvec = (count + 15) // 16
+        uniforms = np.zeros((n_threads, 8 + len(inputs) + len(scalars)),
+                            dtype='u4')
+        uniforms[:, 0] = nvec
+        uniforms[:, 1] = 4 * (count - 1)
+        uniforms[:, 2] = out.address + 4 * start
+        uniforms[:, 3] = _dma_store_setup(16, threads)
+        uniforms[:, 4] = _dma_store_setup(count - 16 * (nvec - 1), threads)
+        uniforms[:, 5] = _vpm_write_setup(threads)
+        uniforms[:, 6] = threads
+        uniforms[:, 7] = n_threads
+        for k, name in enumerate(inputs):
+            uniforms[:, 8+k] = operands[name].address + 4 * start
+        for k, name in enumerate(scalars):
+            uniforms[:, 8+len(inputs)+k] = np.array(
+                operands[name], dtype=self.dtype).view('u4')
+
+        self.drv.execute(
+                n_threads=n_threads,
+                program=self.program(inputs, scalars),
+                uniforms=uniforms
+                )
+        return out
@@ -1,5 +1,8 @@
 from ctypes import Structure, c_ulong, string_at, byref, sizeof
-from struct import pack, unpack
+from struct import Struct, pack, unpack, pack_into, unpack_from
+from array import array
+
+import numpy
 
 class AssembleError(Exception):
     'Exception related to QPU assembler'
@@ -105,6 +108,9 @@ _ADD_INSN_REV = rev(_ADD_INSN)
 _MUL_INSN_REV = rev(_MUL_INSN)
 _BRANCH_INSN_REV = rev(_BRANCH_INSN)
 _COND_REV = rev(_COND)
+_PACK_REV = rev(_PACK)
+_UNPACK_REV = rev(_UNPACK)
+_MUL_PACK_REV = rev(_MUL_PACK)
 
 
 #=================================== Register =================================
@@ -130,6 +136,8 @@ class Register(object):
         self.pack_bits = pack
         self.unpack_bits = unpack
         self.pm_bit = pm
+        # Identity of this register as a read operand.
+        self.read_key = (name, addr, spec, unpack, pm)
 
     def __str__(self):
         return self.name
@@ -347,6 +355,11 @@ class Insn(Structure):
     def __ne__(self, other):
         return not (self == other)
 
+    def __hash__(self):
+        return hash((self.__class__,) + tuple(
+            getattr(self, f) for f, _, _ in self._fields_ if f != 'dontcare'
+            ))
+
     def __repr__(self):
         return '{class_name}({fields})'.format(
             class_name=self.__class__.__name__,
@@ -386,3 +399,143 @@ class SemaInsn(Insn):
 
 class RawInsn(Insn):
     _fields_ = [ (f, c_ulong, n) for f, n in [('raw1', 32), ('raw2', 32)] ]
+
+# Encoders of hot instructions which return 64-bit integers without creating
+# Structures.  Bit positions must agree with _fields_ above.
+
+def alu_word(sig, unpack, pm, pack, cond_add, cond_mul, sf, ws, waddr_add,
+             waddr_mul, op_add, op_mul, raddr_a, raddr_b, add_a, add_b, mul_a,
+             mul_b):
+    'Encode fields of AluInsn.'
+    return (sig << 60 | unpack << 57 | pm << 56 | pack << 52 |
+            cond_add << 49 | cond_mul << 46 | sf << 45 | ws << 44 |
+            waddr_add << 38 | waddr_mul << 32 | op_mul << 29 | op_add << 24 |
+            raddr_a << 18 | raddr_b << 12 | add_a << 9 | add_b << 6 |
+            mul_a << 3 | mul_b)
+
+def load_word(sig, unpack, pm, pack, cond_add, cond_mul, sf, ws, waddr_add,
+              waddr_mul, immediate):
+    'Encode fields of LoadInsn.'
+    return (sig << 60 | unpack << 57 | pm << 56 | pack << 52 |
+            cond_add << 49 | cond_mul << 46 | sf << 45 | ws << 44 |
+            waddr_add << 38 | waddr_mul << 32 | (immediate & 0xffffffff))
+
+
+#============================= Instruction array ==============================
+
+
+# Kinds of instructions stored in InsnArray.kinds.
+INSN_KINDS = [AluInsn, BranchInsn, LoadInsn, SemaInsn, RawInsn]
+_INSN_KIND = {cls: kind for kind, cls in enumerate(INSN_KINDS)}
+KIND_ALU, KIND_BRANCH, KIND_LOAD, KIND_SEMA, KIND_RAW = range(len(INSN_KINDS))
+
+_pack_word = Struct('<Q').pack
+
+def _field_positions(cls):
+    positions = {}
+    offset = 0
+    for f, _, n in cls._fields_:
+        positions[f] = (offset, n)
+        offset += n
+    return positions
+
+_FIELD_POSITIONS = {cls: _field_positions(cls) for cls in INSN_KINDS}
+
+class InsnArray(object):
+    """Compact array of instructions.
+
+    Instructions are stored as a byte string of 64-bit encodings with a column
+    of their kinds (index of INSN_KINDS), instead of a list of Insn structures.
+    Verbose instructions for sanity checks are stored in ``verbose`` only when
+    ``keep_verbose`` is True.
+
+    Fields of all instructions can be read as NumPy arrays by
+    :py:meth:`column` without per-instruction objects. Indexing and iteration
+    return decoded Insn structures for compatibility.
+    """
+
+    def __init__(self, keep_verbose=False):
+        self.code = bytearray()
+        self.kinds = array('B')
+        self.keep_verbose = keep_verbose
+        self.verbose = []
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _index(self, i):
+        n = len(self.kinds)
+        if i < 0:
+            i += n
+        if not (0 <= i < n):
+            raise IndexError('instruction index out of range')
+        return i
+
+    def append(self, insn):
+        self.code += insn.to_bytes()
+        self.kinds.append(_INSN_KIND[insn.__class__])
+        if self.keep_verbose:
+            self.verbose.append(getattr(insn, 'verbose', None))
+
+    def append_word(self, word, kind, verbose=None):
+        'Append instruction encoded as 64-bit integer ``word``.'
+        self.code += _pack_word(word)
+        self.kinds.append(kind)
+        if self.keep_verbose:
+            self.verbose.append(verbose)
+
+    def set_word(self, i, word, kind, verbose=None):
+        'Replace the ``i``-th instruction with ``word``.'
+        i = self._index(i)
+        self.code[8*i:8*i+8] = _pack_word(word)
+        self.kinds[i] = kind
+        if self.keep_verbose:
+            self.verbose[i] = verbose
+
+    def __getitem__(self, i):
+        i = self._index(i)
+        insn = INSN_KINDS[self.kinds[i]].from_buffer_copy(self.code, 8*i)
+        if self.keep_verbose:
+            insn.verbose = self.verbose[i]
+        return insn
+
+    def __setitem__(self, i, insn):
+        i = self._index(i)
+        self.code[8*i:8*i+8] = insn.to_bytes()
+        self.kinds[i] = _INSN_KIND[insn.__class__]
+        if self.keep_verbose:
+            self.verbose[i] = getattr(insn, 'verbose', None)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def word(self, i):
+        'Encoding of the ``i``-th instruction as 64-bit integer.'
+        return unpack_from('<Q', self.code, 8*self._index(i))[0]
+
+    def set_field(self, i, name, value):
+        'Set field ``name`` of the ``i``-th instruction to ``value``.'
+        i = self._index(i)
+        offset, n = _FIELD_POSITIONS[INSN_KINDS[self.kinds[i]]][name]
+        mask = ((1 << n) - 1) << offset
+        word = unpack_from('<Q', self.code, 8*i)[0]
+        pack_into('<Q', self.code, 8*i,
+                  (word & ~mask) | ((value << offset) & mask))
+
+    def words(self):
+        'NumPy array of encodings. It shares memory with this array.'
+        return numpy.frombuffer(self.code, dtype='<u8') if self.code else \
+            numpy.zeros(0, dtype='<u8')
+
+    def column(self, name, kind=AluInsn):
+        """NumPy array of field ``name`` of all instructions, interpreting them
+        as instructions of class ``kind``.  Use with ``kinds`` to select
+        instructions of the kind.
+        """
+        offset, n = _FIELD_POSITIONS[kind][name]
+        return (self.words() >> numpy.uint64(offset)) & \
+            numpy.uint64((1 << n) - 1)
+
+    def tobytes(self):
+        return bytes(self.code)
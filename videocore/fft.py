@@ -0,0 +1,373 @@
+"""Fast Fourier transform.
+
+This module implements batched complex64 FFTs of power-of-two lengths from 16
+to 16384 along the last axis.
+
+>>> X = fft.fft(drv, x)
+>>> x = fft.ifft(drv, X)
+
+The transform is computed by Stockham passes without bit reversal of the
+output.  The first pass is of radix 2, 4, 8 or 16 and the others are of radix
+16.  A thread computes 16 points of a pass at a time: lanes gather elements of
+the butterfly by TMU, which are multiplied by twiddle factors and transformed
+across lanes by radix-2 stages exchanging lanes with ``rotate``.  Results are
+written to VPM as rows of real and imaginary parts and stored by a vertical
+DMA store, which transposes them into interleaved complex numbers at stride of
+the pass.
+
+Twiddle factors and other tables are computed once for each length and kept in
+device memory.
+"""
+
+import threading
+import weakref
+from collections import namedtuple
+
+import numpy as np
+
+from videocore.assembler import qpu, AssembleError
+from videocore.driver import DriverError, asarray
+from videocore.elementwise import partition, _vpm_write_setup
+from videocore.gemm import MAX_STRIDE, Workspace
+
+MIN_SIZE = 16
+MAX_SIZE = 16384
+
+_COMPLETED = 0
+
+#=================================== Tables ===================================
+
+def _log2(n):
+    return int(n).bit_length() - 1
+
+def bit_reverse(x, bits):
+    'Reverse lower ``bits`` bits of integers ``x``.'
+    x = np.asarray(x)
+    y = np.zeros_like(x)
+    for i in range(bits):
+        y |= ((x >> i) & 1) << (bits - 1 - i)
+    return y
+
+def passes(n):
+    'List of (radix, length of sub-transforms) of passes of ``n``-point FFT.'
+    bits = _log2(n) % 4 or 4
+    result = []
+    L = 1
+    for R in [1 << bits] + [16] * ((_log2(n) - bits) // 4):
+        result.append((R, L))
+        L *= R
+    return result
+
+def _twiddle(k, n, inverse):
+    return np.exp((2j if inverse else -2j) * np.pi * k / n)
+
+def lane_table(n, R, inverse=False):
+    """Constants of lanes of a pass of radix R.
+
+    The first row is byte offsets of elements gathered by lanes.  Lane l holds
+    element ``bitrev(l % R)`` of the ``l // R``-th butterfly so that the
+    radix-2 stages across lanes give results in order.  Following rows are
+    real and imaginary parts of twiddle factors of the stages of distance 2, 4
+    and 8.
+    """
+
+    table = np.ones((7, 16), dtype='float32')
+    lane = np.arange(16)
+    p = lane % R
+    table[0] = (8 * (lane // R + n // R * bit_reverse(p, _log2(R)))
+                ).astype('uint32').view('float32')
+    for s, d in enumerate([2, 4, 8]):
+        q = p % (2*d)
+        w = np.where(q >= d, _twiddle(q - d, 2*d, inverse), 1)
+        table[1+2*s] = w.real
+        table[2+2*s] = w.imag
+    return table
+
+def twiddle_table(L, inverse=False):
+    """Twiddle factors of a radix-16 pass following sub-transforms of length L.
+
+    Row k has real and imaginary parts for lanes.
+    """
+    k = np.arange(L).reshape(L, 1)
+    r = bit_reverse(np.arange(16), 4)
+    w = _twiddle(r * k, 16 * L, inverse)
+    return np.stack([w.real, w.imag], axis=1).astype('float32')
+
+#================================== Kernel ====================================
+
+@qpu
+def fft_kernel(asm, n, R, span, inverse=False):
+    """Kernel of a pass.
+
+    :param n: length of transforms.
+    :param R: radix of the pass.
+    :param span: length of sub-transforms of the previous passes.
+
+    Uniforms of each thread are address of :py:func:`lane_table`, address of
+    parameters of iterations, number of iterations, thread index, number of
+    threads, VPM write setup and DMA store setup.  Parameters of an iteration
+    are address of the first input, address of twiddle factors of
+    :py:func:`twiddle_table` (except for the first pass) and address of the
+    first output.
+
+    Registers:
+        ra0: byte offsets of inputs of lanes
+        ra1..ra3, rb1..rb3: twiddle factors of stages across lanes
+        ra5: byte offsets of lanes
+        ra6: number of remaining iterations
+        ra7: address of parameters
+        ra8: output address
+        ra10: real parts of twiddle factors of the pass
+        rb5, rb6: thread index and number of threads
+        rb10, rb11, rb12: VPM write setup, DMA store setup and stride setup
+        rb13: scale of inverse transform
+        rb14: 64
+    """
+
+    if R not in [2, 4, 8, 16] or n % (R * span) != 0 or n < MIN_SIZE:
+        raise AssembleError('Invalid pass')
+    stride = 8*span - 8
+    if stride > MAX_STRIDE:
+        raise AssembleError('Too long transform')
+    scale = inverse and span == 1
+    stages = [d for d in [1, 2, 4, 8] if d < R]
+
+    def cmul(wr, wi):
+        'Multiply (r0, r1) by (wr, wi).'
+        fmul(r3, r1, wi)
+        fmul(r2, r0, wr)
+        fsub(r2, r2, r3).fmul(r3, r0, wi)
+        fmul(r0, r1, wr)
+        fadd(r1, r0, r3).mov(r0, r2)
+
+    mov(tmu_noswap, 1)
+    mov(r0, uniform)
+    mov(ra7, uniform)
+    mov(ra6, uniform)
+    mov(rb5, uniform)
+    mov(rb6, uniform)
+    mov(rb10, uniform)
+    mov(rb11, uniform)
+    shl(ra5, element_number, 2)
+    ldi(rb12, 3 << 30 | stride)
+    if scale:
+        ldi(rb13, 1.0 / n)
+    ldi(rb14, 64)
+    iadd(r0, ra5, r0)
+
+    # Load constants of lanes.
+    rows = [ra0]
+    for s, d in enumerate([2, 4, 8]):
+        if d in stages:
+            rows.extend([ra[1+s], rb[1+s]])
+    for i, reg in enumerate(rows):
+        if i:
+            ldi(r1, 64 * i)
+            iadd(tmu0_s, r0, r1)
+        else:
+            mov(tmu0_s, r0)
+        nop(sig='load tmu0')
+        mov(reg, r4)
+
+    mov(uniforms_address, ra7)
+    nop(); nop()
+
+    L.loop
+
+    mov(r0, uniform)
+    iadd(r1, ra0, r0)
+    mov(tmu0_s, r1)
+    iadd(tmu0_s, r1, 4)
+    if span > 1:
+        mov(r2, uniform)
+        iadd(r3, ra5, r2)
+        mov(tmu1_s, r3)
+        iadd(tmu1_s, r3, rb14)
+    mov(ra8, uniform)
+    nop(sig='load tmu0')
+    mov(r0, r4, sig='load tmu0')
+    mov(r1, r4)
+    if span > 1:
+        nop(sig='load tmu1')
+        mov(ra10, r4, sig='load tmu1')
+        cmul(ra10, r4)
+    if scale:
+        fmul(r0, r0, rb13)
+        fmul(r1, r1, rb13)
+
+    # Radix-2 stages across lanes.  Lanes whose bit d is clear hold the upper
+    # element of butterflies.
+    for s, d in enumerate(stages):
+        if d > 1:
+            cmul(ra[s], rb[s])
+        band(null, element_number, d)
+        rotate(r2, r0, -d)
+        rotate(r2, r0, d, cond='zc')
+        rotate(r3, r1, -d)
+        rotate(r3, r1, d, cond='zc')
+        fadd(r0, r2, r0, cond='zs', set_flags=False)
+        fsub(r0, r2, r0, cond='zc', set_flags=False)
+        fadd(r1, r3, r1, cond='zs', set_flags=False)
+        fsub(r1, r3, r1, cond='zc', set_flags=False)
+
+    wait_dma_store()
+    mov(vpmvcd_wr_setup, rb10)
+    mov(vpm, r0)
+    mov(vpm, r1)
+    mov(vpmvcd_wr_setup, rb12)
+    mov(vpmvcd_wr_setup, rb11)
+    start_dma_store(ra8)
+
+    isub(ra6, ra6, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+
+    wait_dma_store()
+
+    sema_up(_COMPLETED)
+    mov(null, rb5, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+
+    # Only thread 0 enters here.
+    mov(r0, rb6)
+    L.sem_down
+    sema_down(_COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    interrupt()
+
+    L.skip_fin
+
+    exit(interrupt=False)
+
+#================================ Host program ================================
+
+def _dma_store_setup(Y):
+    'DMA store of 16 complex numbers from columns of rows Y and Y+1.'
+    return 0x80000000 | 16 << 23 | 2 << 16 | np.asarray(Y) << 7
+
+def iteration_params(n, R, L, batch, x_addr, y_addr, twiddle_addr=None):
+    """Parameters of iterations of a pass.
+
+    Return ``(batch * n / 16, 2 or 3)`` array of address of the first input,
+    address of twiddle factors if L > 1, and address of the first output.
+    """
+    b, i = [a.ravel() for a in np.meshgrid(
+        np.arange(batch, dtype='int64'), np.arange(n // 16), indexing='ij')]
+    x = x_addr + 8*n*b
+    y = y_addr + 8*n*b
+    if L == 1:
+        return np.stack([x + 8*(16//R)*i, y + 128*i], axis=1)
+    k = i & (L - 1)
+    return np.stack([x + 8*i, twiddle_addr + 128*k, y + 8*(16*(i - k) + k)],
+                    axis=1)
+
+_Pass = namedtuple('_Pass', ['R', 'L', 'program', 'lanes', 'twiddles'])
+
+class FFT(object):
+    """FFT on a driver.
+
+    Programs and tables are made at the first use of each length.
+
+    :param drv: :py:class:`videocore.driver.Driver`.
+    :param max_threads: maximum number of threads.
+    """
+
+    def __init__(self, drv, max_threads=None):
+        self.drv = drv
+        self.max_threads = max_threads or drv.max_threads
+        self.workspace = Workspace(drv)
+        self.lock = threading.RLock()
+        self._plans = {}
+
+    def plan(self, n, inverse=False):
+        'List of passes of ``n``-point transform.'
+        if n & (n - 1) or not MIN_SIZE <= n <= MAX_SIZE:
+            raise DriverError('Length must be a power of two from {} to {}'
+                              .format(MIN_SIZE, MAX_SIZE))
+        key = (n, inverse)
+        with self.lock:
+            if key not in self._plans:
+                self._plans[key] = [
+                    _Pass(R, L,
+                          self.drv.program(fft_kernel, n, R, L, inverse),
+                          self.drv.copy(lane_table(n, R, inverse)),
+                          self.drv.copy(twiddle_table(L, inverse))
+                          if L > 1 else None)
+                    for R, L in passes(n)]
+            return self._plans[key]
+
+    def __call__(self, x, out=None, inverse=False):
+        """Transform ``x`` along the last axis.
+
+        ``x`` is a complex64 device array or an array like object copied to a
+        buffer of the device.  Without ``out``, results are written to a
+        buffer which is overwritten by the next call.
+        """
+
+        with self.lock:
+            return self._transform(x, out, inverse)
+
+    def _transform(self, x, out, inverse):
+        if not hasattr(x, 'address') or x.dtype != np.complex64:
+            a = asarray(x, dtype='complex64')
+            x = self.workspace.get('input', a.shape, 'complex64')
+            x[...] = a
+        if not x.flags.c_contiguous or x.ndim == 0:
+            raise DriverError('Input must be a contiguous array')
+        n = x.shape[-1]
+        plan = self.plan(n, inverse)
+        if out is None:
+            out = self.workspace.output('out', x.shape, 'complex64', [x])
+        elif (not hasattr(out, 'address') or out.shape != x.shape or
+                out.dtype != np.complex64 or not out.flags.c_contiguous):
+            raise DriverError('Invalid output array')
+        batch = x.size // n
+        if batch == 0:
+            return out
+
+        n_iter = batch * n // 16
+        n_threads, start, count = partition(n_iter, self.max_threads, unit=1)
+        threads = np.arange(n_threads)
+        src = x
+        for p, ps in enumerate(plan):
+            dst = (out if p == len(plan) - 1 else
+                   self.workspace.get('work{}'.format(p % 2), x.shape,
+                                      'complex64'))
+            params = iteration_params(
+                n, ps.R, ps.L, batch, src.address, dst.address,
+                ps.twiddles.address if ps.twiddles is not None else None)
+            table = self.workspace.get('params', params.shape, 'u4')
+            table[:] = params
+            uniforms = np.zeros((n_threads, 7), dtype='u4')
+            uniforms[:, 0] = ps.lanes.address
+            uniforms[:, 1] = table.address + 4 * params.shape[1] * start
+            uniforms[:, 2] = count
+            uniforms[:, 3] = threads
+            uniforms[:, 4] = n_threads
+            uniforms[:, 5] = _vpm_write_setup(2 * threads)
+            uniforms[:, 6] = _dma_store_setup(2 * threads)
+            self.drv.execute(
+                    n_threads=n_threads,
+                    program=ps.program,
+                    uniforms=uniforms
+                    )
+            src = dst
+        return out
+
+_ffts = weakref.WeakKeyDictionary()
+
+def _fft(drv):
+    if drv not in _ffts:
+        _ffts[drv] = FFT(drv)
+    return _ffts[drv]
+
+def fft(drv, x, out=None):
+    'Discrete Fourier transform of ``x`` along the last axis like np.fft.fft.'
+    return _fft(drv)(x, out)
+
+def ifft(drv, x, out=None):
+    'Inverse discrete Fourier transform like np.fft.ifft.'
+    return _fft(drv)(x, out, inverse=True)
@@ -0,0 +1,545 @@
+"""Tiled matrix multiplication.
+
+This module implements a GEMM kernel C = A B whose rows of A are fetched by
+strided DMA loads, so that other operations can be built on it by describing
+where rows of A are.  :py:mod:`videocore.conv` gathers patches of images by
+this kernel without expanding them into a matrix.
+
+>>> C = sgemm(drv, A, B)
+>>> C = batched_sgemm(drv, As, Bs)     # (N, m, k) x (N, k, n)
+>>> C = qgemm(drv, A_uint8, B_int8)      # int32
+
+A tile of C is 16 rows by 16 columns.  Rows of a tile are held in lanes of 16
+accumulating registers, one for each column.  Each row of A is a sequence of
+*segments* of the same number of contiguous words at a fixed byte stride.
+Segments are loaded in chunks of 4 words by vertical DMA loads, so that a
+horizontal VPM read gives a column of A over the 16 rows of the tile.  B is
+packed as ``(number of column tiles, k, 16)`` and streamed as uniforms.
+
+The kernel loops over chunks at run time, so its code does not depend on the
+shape of A but on the number of words of the last chunk of a segment.
+
+Float16 and uint8 A are loaded as packed words, which halves and quarters the
+memory traffic of A, and unpacked by regfile A unpack to float32 and int32.
+
+VPM rows 4t to 4t+3 are used by thread t for loads and rows 48 to 63 are
+shared by all threads for stores under the mutex.
+"""
+
+import threading
+import weakref
+
+import numpy as np
+
+from videocore.assembler import REGISTERS, qpu, AssembleError
+from videocore.driver import DriverError, Workspace, asarray, view
+from videocore.elementwise import partition
+
+TILE = 16
+CHUNK = 4
+MAX_THREADS = 12
+
+# Number of words of parameters of a tile.
+TILE_PARAMS = 6
+
+# Number of uniforms of a thread.
+THREAD_UNIFORMS = 12
+
+_OUTPUT_Y = 48
+_COMPLETED = 0
+
+# Maximum of DMA strides.
+MAX_STRIDE = (1 << 13) - 1
+
+# Unpack operations of elements in a word of A.
+_UNPACK = {
+    'float32': ['nop'],
+    'float16': ['16a', '16b'],
+    'uint8': ['8a', '8b', '8c', '8d'],
+}
+
+def _acc(j):
+    'Register accumulating column j of a tile.'
+    return ('ra' if j % 2 == 0 else 'rb') + str(16 + j // 2)
+
+def chunks(words):
+    'Number of chunks of a segment of ``words`` and words of the last one.'
+    if words < 1:
+        raise DriverError('Empty segment of A')
+    m = (words + CHUNK - 1) // CHUNK
+    return m, words - CHUNK * (m - 1)
+
+#================================== Kernel ====================================
+
+@qpu
+def gemm_kernel(asm, last_words=CHUNK, dtype='float32'):
+    """GEMM kernel.
+
+    :param last_words: number of words of the last chunk of a segment.
+    :param dtype: type of elements of A.  Words of float16 and uint8 A are
+        unpacked in registers, and B is float32 and uint8 respectively.
+
+    Uniforms of each thread are address of parameters of tiles, number of
+    tiles, thread index, number of threads, VPM read setups and DMA load
+    setups of full and last chunks, DMA load stride setup, number of chunks
+    of a segment minus one, number of chunks of a row minus one and bytes
+    between segments.  Parameters of a tile are address of the first row of
+    A, address of C, number of rows shifted for DMA load setup, DMA store
+    setup, DMA store stride setup and address of packed B.
+
+    Chunks are processed by two bodies, for full chunks and for the last
+    chunks of segments.  Each body issues the load of the next chunk before
+    multiplying the current one.  After the last chunk of a tile, the first
+    one is loaded again and discarded, so that loads do not depend on
+    conditional writes.
+
+    Registers:
+        ra0, ra1, ra2: addresses of A, C and B of the tile
+        ra3: address of parameters of the next tile
+        ra4: number of remaining tiles
+        ra5: address of the next chunk
+        ra6: address of the segment of the next chunk
+        ra7: remaining chunks of the segment after the next chunk
+        ra8..ra11: columns of A
+        ra13, rb13: DMA load setups of full and last chunks of the tile
+        ra14: 1
+        ra15: DMA load setup of last chunks
+        ra24: sums of rows of uint8 A
+        rb0, rb1: VPM read setups of full and last chunks
+        rb2: bytes of a chunk
+        rb3: bytes between segments
+        rb4, rb5: thread index and number of threads
+        rb6: DMA load setup of full chunks
+        rb7, rb8: DMA store setup and stride setup
+        rb9, rb10: chunks of a segment and of a row minus one
+        rb12: remaining chunks of the row after the next chunk
+        ra16..ra23, rb16..rb23: columns of C
+    """
+
+    if not 0 < last_words <= CHUNK:
+        raise AssembleError('Words of the last chunk are out of range')
+    if dtype not in _UNPACK:
+        raise AssembleError('Unsupported type of A: {}'.format(dtype))
+    integer = (dtype == 'uint8')
+    acc = [REGISTERS[_acc(j)] for j in range(TILE)]
+
+    def issue_load():
+        # Flags are zero for the last chunk of a segment and negative after
+        # the last chunk of the row, and are kept until the end of the body.
+        imin(null, ra7, rb12, set_flags=True)
+        mov(r0, ra13, cond='zc')
+        mov(r0, rb13, cond='zs')
+        mov(r0, rb13, cond='ns').mov(r2, ra5)
+        mov(r2, ra0, cond='ns')
+        mov(vpmvcd_rd_setup, r0)
+        mov(vpm_ld_addr, r2)
+        iadd(ra5, ra5, rb2, cond='zc', set_flags=False)
+        isub(ra7, ra7, 1, cond='zc', set_flags=False)
+        iadd(r2, ra6, rb3, set_flags=False)
+        mov(ra6, r2, cond='zs')
+        mov(ra5, r2, cond='zs')
+        mov(ra7, rb9, cond='zs')
+        isub(rb12, rb12, ra14, set_flags=False)
+
+    def multiply(n):
+        'List of functions emitting products of ``n`` columns of A by B.'
+        insns = []
+        for k in range(n):
+            for op in _UNPACK[dtype]:
+                if dtype == 'float32':
+                    insns.append(lambda k=k: mov(r1, ra[8+k]))
+                elif dtype == 'float16':
+                    insns.append(lambda k=k, op=op:
+                                 fmul(r1, ra[8+k].unpack(op), 1.0))
+                else:
+                    insns.append(lambda k=k, op=op:
+                                 mov(r1, ra[8+k].unpack(op)))
+                if integer:
+                    insns.append(lambda: iadd(ra24, ra24, r1, set_flags=False)
+                                 .imul24(r0, r1, uniform))
+                    for j in range(TILE - 1):
+                        insns.append(lambda j=j: iadd(
+                            acc[j], acc[j], r0, set_flags=False)
+                            .imul24(r0, r1, uniform))
+                    insns.append(lambda: iadd(acc[TILE-1], acc[TILE-1], r0,
+                                              set_flags=False))
+                else:
+                    insns.append(lambda: fmul(r0, r1, uniform))
+                    for j in range(TILE - 1):
+                        insns.append(lambda j=j: fadd(
+                            acc[j], acc[j], r0, set_flags=False)
+                            .fmul(r0, r1, uniform))
+                    insns.append(lambda: fadd(acc[TILE-1], acc[TILE-1], r0,
+                                              set_flags=False))
+        return insns
+
+    def load_chunk(n, setup):
+        wait_dma_load()
+        mov(vpmvcd_rd_setup, setup)
+        nop(); nop()
+        for k in range(n):
+            mov(ra[8+k], vpm)
+        issue_load()        # Overlaps with the multiplication.
+
+    def emit(insns):
+        for insn in insns:
+            insn()
+
+    full = multiply(CHUNK)
+    last = multiply(last_words)
+    zero = [lambda j=j: mov(acc[j], 0.0).mov(acc[j+1], 0.0)
+            for j in range(0, TILE, 2)]
+    if integer:
+        zero.append(lambda: mov(ra24, 0))
+
+    mov(ra3, uniform)
+    mov(ra4, uniform)
+    mov(rb4, uniform)
+    mov(rb5, uniform)
+    mov(rb0, uniform)
+    mov(rb1, uniform)
+    mov(rb6, uniform)
+    mov(ra15, uniform)
+    mov(vpmvcd_rd_setup, uniform)   # DMA load stride setup
+    mov(rb9, uniform)
+    mov(rb10, uniform)
+    mov(rb3, uniform)
+    ldi(rb2, 4*CHUNK)
+    mov(ra14, 1)
+    mov(null, ra4, set_flags=True)
+    jzs(L.end)
+    nop(); nop(); nop()
+
+    L.tile
+
+    mov(uniforms_address, ra3)
+    nop(); nop()
+    mov(ra0, uniform)
+    mov(ra1, uniform)
+    mov(r0, uniform)
+    mov(rb7, uniform)
+    mov(rb8, uniform)
+    mov(ra2, uniform)
+    bor(ra13, rb6, r0)
+    bor(rb13, ra15, r0)
+    ldi(r0, 4*TILE_PARAMS)
+    iadd(ra3, ra3, r0)
+    mov(uniforms_address, ra2)
+    mov(ra5, ra0)
+    mov(ra6, ra0)
+    mov(ra7, rb9)
+    mov(rb12, rb10)
+    emit(zero[:-3])
+    issue_load()
+    jzs(L.last)
+    emit(zero[-3:])
+    jmp(L.full)
+    nop(); nop(); nop()
+
+    # Entry from the last chunk of a segment to the next segment.
+    L.next
+    jzs(L.last)
+    emit(last[-3:])
+
+    L.full
+    load_chunk(CHUNK, rb0)
+    emit(full[:-3])
+    jzc(L.full)         # The next chunk is never after the row.
+    emit(full[-3:])
+
+    L.last
+    load_chunk(last_words, rb1)
+    emit(last[:-6])
+    jnc(L.next)
+    emit(last[-6:-3])
+    emit(last[-3:])
+
+    wait_dma_load()     # The first chunk loaded again.
+
+    if integer:
+        # B is offset by 128 to be unsigned.
+        shl(r2, ra24, 7)
+        for j in range(TILE):
+            isub(acc[j], acc[j], r2)
+
+    # Rows of VPM for output are shared by all threads.
+    mutex_acquire()
+    setup_vpm_write(Y=_OUTPUT_Y)
+    for j in range(TILE):
+        mov(vpm, acc[j])
+    mov(vpmvcd_wr_setup, rb8)
+    mov(vpmvcd_wr_setup, rb7)
+    start_dma_store(ra1)
+    wait_dma_store()
+    mutex_release()
+
+    isub(ra4, ra4, 1)
+    jzc(L.tile)
+    nop(); nop(); nop()
+
+    L.end
+
+    sema_up(_COMPLETED)
+    mov(null, rb4, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+
+    # Only thread 0 enters here.
+    mov(r0, rb5)
+    L.sem_down
+    sema_down(_COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    interrupt()
+
+    L.skip_fin
+
+    exit(interrupt=False)
+
+#================================ Host program ================================
+
+def dma_load_rows(nrows):
+    'Number of rows of DMA load setup.'
+    return (np.asarray(nrows) & 0xf) << 16
+
+def dma_load_setup(ncols, y):
+    """DMA load setup of ``ncols`` columns of A to VPM row ``y``, without the
+    number of rows.
+    """
+    y = np.asarray(y)
+    return 0x80000000 | (ncols & 0xf) << 20 | 1 << 12 | 1 << 11 | y << 4
+
+def vpm_read_setup(nrows, y):
+    'VPM read setup of ``nrows`` rows from VPM row ``y``.'
+    y = np.asarray(y)
+    return (nrows & 0xf) << 20 | 1 << 12 | 1 << 11 | 2 << 8 | y
+
+def dma_store_setup(nrows, ncols):
+    """DMA store setup writing ``nrows`` rows of ``ncols`` words from columns
+    of the output rows of VPM.
+    """
+    nrows = np.asarray(nrows)
+    ncols = np.asarray(ncols)
+    return (0x80000000 | (nrows & 0x7f) << 23 | (ncols & 0x7f) << 16 |
+            _OUTPUT_Y << 7)
+
+def dma_store_stride(pitch, ncols):
+    'DMA store stride setup of rows of C.'
+    stride = pitch - 4 * np.asarray(ncols)
+    if np.any(stride > MAX_STRIDE):
+        raise DriverError('Pitch of rows of C is too large')
+    return 3 << 30 | stride
+
+def pack_b(B, out=None):
+    """Pack B of shape ``(..., k, n)`` as ``(..., ceil(n/16), k, 16)``.
+
+    Missing columns are filled with zero.
+    """
+    B = asarray(B)
+    k, n = B.shape[-2:]
+    t = (n + TILE - 1) // TILE
+    padded = np.zeros(B.shape[:-1] + (t * TILE,), dtype=B.dtype)
+    padded[..., :n] = B
+    packed = padded.reshape(B.shape[:-1] + (t, TILE))
+    packed = np.moveaxis(packed, -2, -3)
+    if out is None:
+        return np.ascontiguousarray(packed)
+    out.reshape(packed.shape)[...] = packed
+    return out
+
+class TiledProduct(object):
+    """Launcher of :py:func:`gemm_kernel`.
+
+    Subclasses describe tiles by :py:meth:`run`.
+    """
+
+    def __init__(self, drv, max_threads=None):
+        self.drv = drv
+        self.max_threads = min(max_threads or drv.max_threads, MAX_THREADS)
+        self.workspace = Workspace(drv)
+        self.lock = threading.RLock()
+        self._programs = {}
+
+    # Type of elements of A.
+    a_dtype = 'float32'
+
+    def program(self, last_words):
+        if last_words not in self._programs:
+            self._programs[last_words] = self.drv.program(
+                gemm_kernel, last_words, self.a_dtype)
+        return self._programs[last_words]
+
+    def run(self, words, a_pitch, a_addr, c_addr, b_addr, nrows, ncols,
+            c_pitch, segments=1, segment_stride=0):
+        """Compute tiles.
+
+        :param words: number of words of a segment of a row of A.
+        :param a_pitch: bytes between rows of A in a tile.
+        :param a_addr, c_addr, b_addr: arrays of addresses of the first row of
+            A, C and packed B of tiles.
+        :param nrows, ncols: arrays of numbers of rows and columns of tiles.
+        :param c_pitch: bytes between rows of C.
+        :param segments: number of segments of a row of A.
+        :param segment_stride: bytes between segments of a row of A.
+        """
+
+        if not 0 < a_pitch <= MAX_STRIDE:
+            raise DriverError('Pitch of rows of A is out of range')
+        if segments < 1:
+            raise DriverError('Empty row of A')
+        m, last_words = chunks(words)
+        n_tiles = len(a_addr)
+        if n_tiles == 0:
+            return
+        with self.lock:
+            params = self.workspace.get('params', (n_tiles, TILE_PARAMS),
+                                        'u4')
+            params[:, 0] = a_addr
+            params[:, 1] = c_addr
+            params[:, 2] = dma_load_rows(nrows)
+            params[:, 3] = dma_store_setup(nrows, ncols)
+            params[:, 4] = dma_store_stride(c_pitch, ncols)
+            params[:, 5] = b_addr
+
+            n_threads, start, count = partition(n_tiles, self.max_threads,
+                                                unit=1)
+            threads = np.arange(n_threads)
+            uniforms = np.zeros((n_threads, THREAD_UNIFORMS), dtype='u4')
+            uniforms[:, 0] = params.address + 4 * TILE_PARAMS * start
+            uniforms[:, 1] = count
+            uniforms[:, 2] = threads
+            uniforms[:, 3] = n_threads
+            uniforms[:, 4] = vpm_read_setup(CHUNK, CHUNK * threads)
+            uniforms[:, 5] = vpm_read_setup(last_words, CHUNK * threads)
+            uniforms[:, 6] = dma_load_setup(CHUNK, CHUNK * threads)
+            uniforms[:, 7] = dma_load_setup(last_words, CHUNK * threads)
+            uniforms[:, 8] = 9 << 28 | a_pitch
+            uniforms[:, 9] = m - 1
+            uniforms[:, 10] = m * segments - 1
+            uniforms[:, 11] = segment_stride
+            self.drv.execute(
+                    n_threads=n_threads,
+                    program=self.program(last_words),
+                    uniforms=uniforms
+                    )
+
+class Sgemm(TiledProduct):
+    """Single precision matrix multiplication.
+
+    Operands are ``(m, k)`` and ``(k, n)`` matrices, or stacks of them of
+    shapes ``(N, m, k)`` and ``(N, k, n)``.  All tiles of a stack are computed
+    by one launch.
+    """
+
+    b_dtype = 'float32'
+    c_dtype = 'float32'
+
+    def pack(self, B, out):
+        'Pack B to ``out`` streamed as uniforms.'
+        return pack_b(B, out=out)
+
+    def __call__(self, A, B, C=None):
+        for X, dtype in [(A, self.a_dtype), (B, self.b_dtype)]:
+            if (not hasattr(X, 'address') or X.dtype != dtype or
+                    X.ndim not in [2, 3] or not X.flags.c_contiguous):
+                raise DriverError('Operands must be contiguous {} and {} '
+                                  'device matrices'.format(
+                                      self.a_dtype, self.b_dtype))
+        if (A.ndim != B.ndim or A.shape[:-2] != B.shape[:-2] or
+                A.shape[-1] != B.shape[-2]):
+            raise DriverError('Shape mismatch: {} {}'.format(
+                A.shape, B.shape))
+        batch = A.shape[:-2]
+        N = int(np.prod(batch))
+        m, k = A.shape[-2:]
+        n = B.shape[-1]
+        if C is None:
+            C = self.drv.alloc(batch + (m, n), self.c_dtype)
+        elif (not hasattr(C, 'address') or C.shape != batch + (m, n) or
+                C.dtype != self.c_dtype or not C.flags.c_contiguous):
+            raise DriverError('Invalid output matrix')
+        a_pitch = A.itemsize * k
+        if a_pitch > MAX_STRIDE:
+            raise DriverError('k must be less than {}'.format(
+                MAX_STRIDE // A.itemsize + 1))
+        if a_pitch % 4 != 0:
+            raise DriverError('Rows of A must be multiples of 4 bytes')
+        if N == 0 or m == 0 or n == 0:
+            return C
+        if k == 0:
+            C[...] = 0
+            return C
+
+        with self.lock:
+            t = (n + TILE - 1) // TILE
+            packed = self.workspace.get('b', batch + (t, k, TILE),
+                                        self.c_dtype)
+            self.pack(B, packed)
+
+            b, i, j = [a.ravel() for a in np.meshgrid(
+                np.arange(N), np.arange(0, m, TILE), np.arange(t),
+                indexing='ij')]
+            self.run(
+                words=a_pitch // 4,
+                a_pitch=a_pitch,
+                a_addr=A.address + a_pitch*(m*b + i),
+                c_addr=C.address + 4*(n*(m*b + i) + TILE*j),
+                b_addr=packed.address + 4*k*TILE*(t*b + j),
+                nrows=np.minimum(TILE, m - i),
+                ncols=np.minimum(TILE, n - TILE*j),
+                c_pitch=4*n)
+            return C
+
+class Hgemm(Sgemm):
+    """Matrix multiplication of float16 A and float32 B.
+
+    Products are accumulated in float32.  k must be even.
+    """
+
+    a_dtype = 'float16'
+
+class Qgemm(Sgemm):
+    """Matrix multiplication of uint8 A and int8 B.
+
+    Products are accumulated in int32.  k must be a multiple of 4.
+    """
+
+    a_dtype = 'uint8'
+    b_dtype = 'int8'
+    c_dtype = 'int32'
+
+    def pack(self, B, out):
+        # imul24 is unsigned.  The kernel subtracts 128 times sums of rows of
+        # A from the products.
+        return pack_b(B.astype('int32') + 128, out=out)
+
+_products = weakref.WeakKeyDictionary()
+
+def _product(cls, drv):
+    products = _products.setdefault(drv, {})
+    if cls not in products:
+        products[cls] = cls(drv)
+    return products[cls]
+
+def sgemm(drv, A, B, C=None):
+    'Return A B of float32 device matrices.'
+    return _product(Sgemm, drv)(A, B, C)
+
+def hgemm(drv, A, B, C=None):
+    'Return A B of float16 and float32 device matrices as float32.'
+    return _product(Hgemm, drv)(A, B, C)
+
+def qgemm(drv, A, B, C=None):
+    'Return A B of uint8 and int8 device matrices as int32.'
+    return _product(Qgemm, drv)(A, B, C)
+
+def batched_sgemm(drv, A, B, C=None):
+    """Return products of stacked float32 device matrices.
+
+    :param A: ``(N, m, k)`` device array.
+    :param B: ``(N, k, n)`` device array.
+    """
+    if np.ndim(A) != 3 or np.ndim(B) != 3:
+        raise DriverError('Operands must be stacks of matrices')
+    return _product(Sgemm, drv)(A, B, C)
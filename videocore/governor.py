@@ -0,0 +1,165 @@
+"""Clock and thermal governor of QPU launches.
+
+Under sustained load the firmware throttles clocks when the SoC reaches its
+soft temperature limit, which drops throughput abruptly.  :py:class:`Governor`
+samples temperature and throttle state around launches and steps V3D and core
+clocks to hold a target temperature below the limit instead::
+
+    with Driver(governor=Governor(MailBox(), target=70.0)) as drv:
+        ...
+        drv.governor.telemetry[-1].throughput_per_watt
+
+Power is not measured by the firmware, so it is estimated from clock rates
+and the core voltage by :py:func:`estimate_power`.
+"""
+
+from timeit import default_timer
+from collections import namedtuple
+
+from videocore.mailbox import MailBox
+
+# Bits of get_throttled.
+THROTTLED_UNDER_VOLTAGE = 1 << 0
+THROTTLED_FREQ_CAPPED   = 1 << 1
+THROTTLED_THROTTLED     = 1 << 2
+THROTTLED_SOFT_TEMP     = 1 << 3
+THROTTLED_NOW           = 0xf
+
+# Dynamic power in watts per MHz and square volt of each clock.  Rough figures
+# for BCM2835/6/7 to compare settings rather than absolute power.
+POWER_COEFFICIENTS = {
+    MailBox.CLOCK_V3D:  1.2e-3,
+    MailBox.CLOCK_CORE: 0.8e-3,
+}
+
+Sample = namedtuple('Sample', [
+    'time',         # timeit.default_timer() of the sample
+    'temperature',  # SoC temperature in degree Celsius
+    'throttled',    # flags of get_throttled
+    'rates',        # dict of clock id to rate in Hz
+    'voltage',      # core voltage in volt
+    ])
+
+Telemetry = namedtuple('Telemetry', [
+    'sample',       # Sample at the end of the window
+    'elapsed',      # seconds spent in launches of the window
+    'launches',     # number of launches of the window
+    'work',         # units of work of the window, e.g. flop
+    'throughput',   # work per second
+    'power',        # estimated power in watts
+    'throughput_per_watt',
+    ])
+
+def estimate_power(rates, voltage):
+    'Estimated dynamic power in watts of clocks at ``rates`` in Hz.'
+    return sum(POWER_COEFFICIENTS.get(clock, 0) * rate / 1e6 * voltage**2
+               for clock, rate in rates.items())
+
+class Governor(object):
+    """Governor of clock rates holding a target temperature.
+
+    :param mailbox: :py:class:`videocore.mailbox.MailBox` or an object with
+        the same methods.
+    :param target: target temperature in degree Celsius.
+    :param hysteresis: clocks are lowered above ``target + hysteresis`` or
+        while the firmware throttles, and raised below
+        ``target - hysteresis``.
+    :param clocks: ids of clocks to adjust.
+    :param step: fraction of the range of a clock changed at once.
+    :param interval: minimum seconds between samples.  Launches in between
+        are accumulated to the current window of telemetry.
+    :param history: number of windows of telemetry kept.
+    """
+
+    def __init__(self, mailbox, target=70.0, hysteresis=2.0,
+                 clocks=(MailBox.CLOCK_V3D, MailBox.CLOCK_CORE), step=0.1,
+                 interval=1.0, history=1000, power_model=estimate_power):
+        self.mailbox = mailbox
+        self.target = target
+        self.hysteresis = hysteresis
+        self.clocks = tuple(clocks)
+        self.step = step
+        self.interval = interval
+        self.history = history
+        self.power_model = power_model
+        r = mailbox.batch(*[(method, clock) for clock in self.clocks
+                            for method in ('get_min_clock_rate',
+                                           'get_max_clock_rate')])
+        self.limits = dict((clock, (r[2*i][1], r[2*i+1][1]))
+                           for i, clock in enumerate(self.clocks))
+        self.telemetry = []
+        self.last = self.sample()
+        self._reset_window()
+
+    def _reset_window(self):
+        self.elapsed = 0.0
+        self.launches = 0
+        self.work = 0
+
+    def sample(self):
+        """Read temperature, throttle state, clock rates and core voltage by a
+        single batch of mailbox requests."""
+        r = self.mailbox.batch(
+            ('get_temperature', 0), ('get_throttled',),
+            ('get_voltage', MailBox.VOLTAGE_CORE),
+            *[('get_clock_rate', clock) for clock in self.clocks])
+        return Sample(
+            time=default_timer(),
+            temperature=r[0][1] / 1000.0,
+            throttled=r[1],
+            rates=dict((clock, rate[1])
+                       for clock, rate in zip(self.clocks, r[3:])),
+            voltage=r[2][1] / 1e6)
+
+    def adjust(self, sample):
+        """Step clocks according to ``sample``.
+
+        Return True if any clock is changed.
+        """
+        hot = (sample.temperature > self.target + self.hysteresis or
+               sample.throttled & THROTTLED_NOW)
+        cold = sample.temperature < self.target - self.hysteresis
+        if not (hot or cold):
+            return False
+        changed = False
+        for clock in self.clocks:
+            lo, hi = self.limits[clock]
+            rate = sample.rates[clock]
+            delta = max(1, int((hi - lo) * self.step))
+            new_rate = max(lo, rate - delta) if hot else min(hi, rate + delta)
+            if new_rate != rate:
+                self.mailbox.set_clock_rate(clock, new_rate, 0)
+                changed = True
+        return changed
+
+    def launch(self, run, work=0):
+        """Call ``run()`` recording its time and ``work`` to telemetry.
+
+        At most every ``interval`` seconds the current window is closed by a
+        sample, which also adjusts clocks.
+        """
+        start = default_timer()
+        try:
+            return run()
+        finally:
+            end = default_timer()
+            self.elapsed += end - start
+            self.launches += 1
+            self.work += work
+            if end - self.last.time >= self.interval:
+                self.close_window()
+
+    def close_window(self):
+        'Sample, record telemetry of the current window and adjust clocks.'
+        sample = self.sample()
+        power = self.power_model(sample.rates, sample.voltage)
+        throughput = self.work / self.elapsed if self.elapsed > 0 else 0.0
+        self.telemetry.append(Telemetry(
+            sample=sample, elapsed=self.elapsed, launches=self.launches,
+            work=self.work, throughput=throughput, power=power,
+            throughput_per_watt=throughput / power if power > 0 else 0.0))
+        del self.telemetry[:-self.history]
+        self.last = sample
+        self._reset_window()
+        self.adjust(sample)
+        return self.telemetry[-1]
@@ -0,0 +1,162 @@
+"""Partitioning of problems to QPU threads.
+
+A problem of 1 to 3 dimensions is covered by a grid of tiles, and threads
+process contiguous ranges of tiles in row-major order.
+
+>>> grid = Grid((96, 3072), tile=(16, 64))
+>>> n_threads, uniforms = grid.uniforms(12, A.address, C.address)
+
+Ranges are balanced by the number of elements of tiles, so clipped tiles at
+the end of dimensions count less.  With ``dynamic=True`` threads instead pull
+tiles from a counter in VPM guarded by a semaphore, by :py:func:`init_counter`,
+:py:func:`next_tile` and :py:func:`finish_counter` in kernels::
+
+    mov(ra0, uniform)               # start (unused)
+    mov(ra1, uniform)               # number of tiles
+    mov(ra2, uniform)               # thread index
+    mov(ra3, uniform)               # number of threads
+    init_counter(asm, ra2)
+    L.loop
+    next_tile(asm, r1)
+    isub(null, r1, ra1)
+    jnc(L.done)                     # all tiles are taken
+    ...
+"""
+
+import numpy as np
+
+from videocore.assembler import qpu
+from videocore.driver import DriverError
+from videocore.workqueue import (
+    QUEUE_VPM_ROW, QUEUE_SEMAPHORE, init_queue, take_work, finish_queue)
+
+# VPM row and semaphore of the tile counter, which is the first work queue of
+# videocore.workqueue.  Kernels using the counter must not use them for other
+# purposes.
+COUNTER_VPM_ROW = QUEUE_VPM_ROW
+COUNTER_SEMAPHORE = QUEUE_SEMAPHORE
+
+class Grid(object):
+    """Grid of tiles covering a problem.
+
+    :param shape: shape of the problem.
+    :param tile: shape of tiles.  Tiles at the end of dimensions are clipped.
+    :param unit: number of consecutive tiles always assigned to the same
+        thread, e.g. ``grid.counts[-1]`` for whole rows of tiles.
+    """
+
+    def __init__(self, shape, tile, unit=1):
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        tile = tuple(int(n) for n in np.atleast_1d(tile))
+        if not 1 <= len(shape) <= 3:
+            raise DriverError('Grid must have 1 to 3 dimensions')
+        if len(tile) != len(shape) or min(tile) < 1 or unit < 1:
+            raise DriverError('Invalid tile shape')
+        self.shape = shape
+        self.tile = tile
+        self.unit = unit
+        self.counts = tuple(-(-n // t) for n, t in zip(shape, tile))
+        self.size = int(np.prod(self.counts))
+
+    def tiles(self, start=0, stop=None):
+        """Origins and extents of tiles in ``[start, stop)``.
+
+        Return an array of (number of tiles, 2, dimensions) where ``[:, 0]``
+        are origins and ``[:, 1]`` are extents of tiles.
+        """
+        index = np.arange(start, self.size if stop is None else stop)
+        coords = np.stack(np.unravel_index(index, self.counts), axis=1)
+        origin = coords * self.tile
+        extent = np.minimum(self.tile, np.array(self.shape) - origin)
+        return np.stack([origin, extent], axis=1)
+
+    def partition(self, max_threads, cost=None):
+        """Partition tiles into balanced contiguous ranges.
+
+        :param cost: cost of each tile.  Default is the number of elements.
+
+        Return (number of threads, start tile, tile count) where the last two
+        are arrays of length of the number of threads.
+        """
+        if cost is None:
+            cost = np.prod(self.tiles()[:, 1], axis=1)
+        cost = np.asarray(cost, dtype='float64')
+        units = -(-self.size // self.unit)
+        unit_cost = np.add.reduceat(cost, np.arange(0, self.size, self.unit))
+        n_threads = max(1, min(max_threads, units))
+        cum = np.concatenate([[0], np.cumsum(unit_cost)])
+        edges = [0]
+        for k in range(1, n_threads):
+            # Cut at the unit boundary nearest to the k-th share of the cost
+            # leaving at least a unit to each thread.
+            target = cum[-1] * k / n_threads
+            i = int(np.searchsorted(cum, target))
+            if i > 0 and target - cum[i-1] < cum[min(i, units)] - target:
+                i -= 1
+            edges.append(min(max(i, edges[-1] + 1), units - n_threads + k))
+        edges = np.array(edges + [units]) * self.unit
+        edges = np.minimum(edges, self.size)
+        return n_threads, edges[:-1], np.diff(edges)
+
+    def uniforms(self, max_threads, *columns, **kwargs):
+        """Uniforms of threads processing the grid.
+
+        Uniforms of each thread are the start tile, number of tiles, thread
+        index, number of threads followed by ``columns``, each of which is a
+        scalar or an array of values of threads.
+
+        :param dynamic: if True, threads pull tiles by :py:func:`next_tile`.
+            The start tile is 0 and the number of tiles is that of the grid.
+        :param cost: passed to :py:meth:`partition`.
+
+        Return (number of threads, uniforms).
+        """
+        dynamic = kwargs.pop('dynamic', False)
+        cost = kwargs.pop('cost', None)
+        if kwargs:
+            raise TypeError('Unknown arguments {}'.format(', '.join(kwargs)))
+        if dynamic:
+            n_threads = max(1, min(max_threads, self.size))
+            start, count = 0, self.size
+        else:
+            n_threads, start, count = self.partition(max_threads, cost)
+        uniforms = np.zeros((n_threads, 4 + len(columns)), dtype='u4')
+        uniforms[:, 0] = start
+        uniforms[:, 1] = count
+        uniforms[:, 2] = np.arange(n_threads)
+        uniforms[:, 3] = n_threads
+        for k, column in enumerate(columns):
+            uniforms[:, 4+k] = column
+        return n_threads, uniforms
+
+#================================ Tile counter ================================
+
+@qpu
+def init_counter(asm, thread, start=0, sem=COUNTER_SEMAPHORE,
+                 row=COUNTER_VPM_ROW):
+    """Initialize the tile counter by thread 0.
+
+    :param thread: register of the thread index.
+    :param start: first tile index.
+
+    Other threads wait for the initialization in their first
+    :py:func:`next_tile`.  Uses r0.
+    """
+    init_queue(asm, thread, start, sem, row)
+
+@qpu
+def next_tile(asm, dst, grain=1, sem=COUNTER_SEMAPHORE, row=COUNTER_VPM_ROW):
+    """Take ``grain`` tiles from the counter and set the first one to ``dst``.
+
+    ``dst`` must be an accumulator.  VPM read and write setups are changed.
+    """
+    take_work(asm, dst, grain, sem, row)
+
+@qpu
+def finish_counter(asm, sem=COUNTER_SEMAPHORE):
+    """Restore the semaphore of the counter.
+
+    Call by thread 0 after all threads have finished :py:func:`next_tile`,
+    e.g. after waiting for their completion.
+    """
+    finish_queue(asm, sem)
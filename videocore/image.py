@@ -0,0 +1,510 @@
+"""Image processing.
+
+This module implements colour conversion, downscaling and separable filters of
+8-bit images in device memory, so that frames stay on the device between
+stages of a pipeline.
+
+>>> rgba = image.yuv420_to_rgba(drv, y, u, v)
+>>> small = image.downscale2x(drv, rgba)
+>>> blurred = image.gaussian_blur(drv, small, sigma=1.5)
+
+RGBA images are ``(height, width, 4)`` uint8 device arrays, whose pixels are
+32-bit words.  Lanes of the QPU load words of pixels by TMU, convert bytes to
+float by unpack ``8a``..``8d`` and convert results back by the colour pack of
+the MUL ALU, which saturates them to [0, 1].  Maximum and minimum filters use
+``v8max`` and ``v8min`` on all channels at once.  Results are written to VPM
+and stored by DMA, one iteration of a thread being a 16-pixel segment of a
+row (64 pixels for colour conversion).
+"""
+
+import threading
+import weakref
+
+import numpy as np
+
+from videocore.assembler import qpu, AssembleError
+from videocore.driver import DriverError
+from videocore.elementwise import partition, _dma_store_setup, \
+        _vpm_write_setup
+from videocore.gemm import Workspace
+
+_COMPLETED = 0
+
+# Maximum number of taps of filters.
+MAX_TAPS = 15
+
+_BYTES = ['8a', '8b', '8c', '8d']
+
+# Full range BT.601 coefficients of R - Y, G - Y and B - Y.
+_YUV_TO_RGB = {
+    'ru': 0.0, 'rv': 1.402,
+    'gu': -0.344136, 'gv': -0.714136,
+    'bu': 1.772, 'bv': 0.0,
+}
+
+#================================== Kernels ===================================
+
+def _prologue(asm, *regs):
+    """Read common uniforms and switch uniforms to parameters of iterations.
+
+    Uniforms of each thread are address of parameters of iterations, number
+    of iterations, thread index, number of threads, VPM write setup and VPM
+    row for DMA store setup, followed by uniforms of the kernel read to
+    ``regs``.
+    """
+    mov(tmu_noswap, 1)
+    mov(ra7, uniform)
+    mov(ra6, uniform)
+    mov(rb5, uniform)
+    mov(rb6, uniform)
+    mov(rb7, uniform)
+    mov(rb8, uniform)
+    for reg in regs:
+        mov(reg, uniform)
+    mov(uniforms_address, ra7)
+    shl(ra5, element_number, 2)
+    nop()
+
+def _store(asm, *regs):
+    'Write ``regs`` to VPM and start DMA store of a setup from parameters.'
+    wait_dma_store()
+    mov(vpmvcd_wr_setup, rb7)
+    for reg in regs:
+        mov(vpm, reg)
+    bor(vpmvcd_wr_setup, rb8, uniform)
+    start_dma_store(uniform)
+
+def _epilogue(asm):
+    'Loop over iterations and finish the program.'
+    isub(ra6, ra6, 1)
+    jzc(L.loop)
+    nop(); nop(); nop()
+
+    wait_dma_store()
+
+    sema_up(_COMPLETED)
+    mov(null, rb5, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+
+    # Only thread 0 enters here.
+    mov(r0, rb6)
+    L.sem_down
+    sema_down(_COMPLETED)
+    isub(r0, r0, 1)
+    jzc(L.sem_down)
+    nop(); nop(); nop()
+    interrupt()
+
+    L.skip_fin
+
+    exit(interrupt=False)
+
+@qpu
+def yuv420_kernel(asm):
+    """Convert 64 pixels of a row of I420 planes to RGBA at an iteration.
+
+    Lane l converts pixels 4l to 4l+3, whose chroma is in the lower or upper
+    half of word l/2 of chroma rows.  Parameters of an iteration are the byte
+    offset of the last luma word, that of the last chroma word, addresses of
+    luma, U and V, DMA store setup and output address.  The four pixels of
+    lanes are written to four VPM rows and stored to consecutive words by a
+    vertical DMA store.
+
+    Registers:
+        ra0: shifts of chroma words
+        rb0: byte offsets of chroma words
+        rb1..rb4: coefficients of R - Y, G - Y and B - Y
+        rb9: alpha
+        rb10: chroma of zero
+        ra10, ra11, ra12: words of luma, U and V
+        ra14..ra17: output words
+        ra20..ra25: chroma terms of lower and upper pixels
+    """
+
+    _prologue(asm)
+    band(r0, element_number, 1)
+    shl(ra0, r0, 4)
+    shr(r0, element_number, 1)
+    shl(rb0, r0, 2)
+    ldi(rb1, _YUV_TO_RGB['rv'])
+    ldi(rb2, _YUV_TO_RGB['gu'])
+    ldi(rb3, _YUV_TO_RGB['gv'])
+    ldi(rb4, _YUV_TO_RGB['bu'])
+    ldi(rb9, 0xff000000)
+    ldi(rb10, 128 / 255.0)
+    setup_dma_store_stride(0)
+
+    L.loop
+
+    imin(r0, ra5, uniform)
+    iadd(tmu0_s, r0, uniform)
+    imin(r1, rb0, uniform)
+    iadd(tmu0_s, r1, uniform)
+    iadd(tmu0_s, r1, uniform)
+    nop(sig='load tmu0')
+    mov(ra10, r4, sig='load tmu0')
+    shr(ra11, r4, ra0, sig='load tmu0')
+    shr(ra12, r4, ra0)
+    for b in range(4):
+        mov(ra[14+b], rb9)
+
+    # Chroma terms for pixels 4l, 4l+1 (h = 0) and 4l+2, 4l+3 (h = 1).
+    for h in range(2):
+        fsub(r0, ra11.unpack(_BYTES[h]), rb10)
+        fsub(r1, ra12.unpack(_BYTES[h]), rb10)
+        fmul(ra[20+h], r1, rb1)
+        fmul(r2, r0, rb2)
+        fmul(r3, r1, rb3)
+        fadd(ra[22+h], r2, r3)
+        fmul(ra[24+h], r0, rb4)
+
+    for b in range(4):
+        h = b // 2
+        fmul(r0, ra10.unpack(_BYTES[b]), 1.0)
+        fadd(r1, r0, ra[20+h])
+        fadd(r2, r0, ra[22+h]).fmul(ra[14+b], r1, 1.0, pack='8a')
+        fadd(r3, r0, ra[24+h]).fmul(ra[14+b], r2, 1.0, pack='8b')
+        fmul(ra[14+b], r3, 1.0, pack='8c')
+
+    _store(asm, ra14, ra15, ra16, ra17)
+    _epilogue(asm)
+
+@qpu
+def downscale2x_kernel(asm):
+    """Average 2x2 pixels of RGBA images for 16 output pixels at an iteration.
+
+    The uniform of each thread following those of :py:func:`_prologue` is
+    bytes between rows of the input.  Parameters of an iteration are the byte offset of the last input word,
+    address of the first input pixel, DMA store setup and output address.
+
+    Registers:
+        rb0: pitch
+        ra10..ra13: upper left, upper right, lower left and lower right
+            pixels
+        ra14: output pixels
+    """
+
+    _prologue(asm, rb0)
+    shl(ra0, element_number, 3)
+    nop()
+
+    L.loop
+
+    imin(r0, ra0, uniform)
+    iadd(r0, r0, uniform)
+    mov(tmu0_s, r0)
+    iadd(tmu0_s, r0, 4)
+    iadd(r0, r0, rb0)
+    mov(tmu0_s, r0)
+    iadd(tmu0_s, r0, 4)
+    nop(sig='load tmu0')
+    mov(ra10, r4, sig='load tmu0')
+    mov(ra11, r4, sig='load tmu0')
+    mov(ra12, r4, sig='load tmu0')
+    mov(ra13, r4)
+    for c, op in enumerate(_BYTES):
+        fmul(r0, ra10.unpack(op), 1.0)
+        fadd(r0, r0, ra11.unpack(op))
+        fadd(r0, r0, ra12.unpack(op))
+        fadd(r0, r0, ra13.unpack(op))
+        fmul(ra14, r0, 0.25, pack=op)
+
+    _store(asm, ra14)
+    _epilogue(asm)
+
+@qpu
+def filter_kernel(asm, taps, op, vertical):
+    """One dimensional filter of RGBA images for 16 pixels at an iteration.
+
+    :param taps: number of taps.
+    :param op: 'conv', 'max' or 'min'.
+    :param vertical: True if taps are in a column.
+
+    Taps out of the image are clamped to the edge.  Uniforms of each thread
+    following those of :py:func:`_prologue` are bytes between taps, byte
+    offset of the first tap and weights of taps for ``op == 'conv'``, so that
+    a program serves any weights and width.  Parameters of an iteration are
+    the byte offset of the last pixel, address of the pixel, minimum and
+    maximum addresses of taps of lane 0, DMA store setup and output address.
+
+    Registers:
+        ra9: addresses of pixels
+        rb10, ra10: minimum and maximum addresses of taps
+        rb11: bytes between taps
+        rb12: byte offset of the first tap
+        ra16..ra19: sums of channels
+        rb16..: weights
+        ra20: output pixels
+        r3: address of the next tap
+    """
+
+    if not 0 < taps <= MAX_TAPS:
+        raise AssembleError('Number of taps must be 1 to {}'.format(MAX_TAPS))
+    if op not in ['conv', 'max', 'min']:
+        raise AssembleError('Unknown filter {}'.format(op))
+    acc = [ra16, ra17, ra18, ra19]
+
+    def issue():
+        imax(r2, r3, rb10)
+        imin(tmu0_s, r2, ra10)
+        iadd(r3, r3, rb11)
+
+    weights = [rb[16+t] for t in range(taps)] if op == 'conv' else []
+    _prologue(asm, rb11, rb12, *weights)
+
+    L.loop
+
+    imin(r0, ra5, uniform)
+    iadd(ra9, r0, uniform)
+    mov(r1, uniform)
+    mov(r3, uniform)
+    if vertical:
+        iadd(rb10, r0, r1)
+        iadd(ra10, r0, r3)
+    else:
+        mov(rb10, r1)
+        mov(ra10, r3)
+    iadd(r3, ra9, rb12)
+    for t in range(min(4, taps)):
+        issue()
+
+    for t in range(taps):
+        nop(sig='load tmu0')
+        if op == 'conv':
+            w = weights[t]
+            if t == 0:
+                for c in range(4):
+                    fmul(acc[c], r4.unpack(_BYTES[c]), w)
+            else:
+                fmul(r0, r4.unpack(_BYTES[0]), w)
+                for c in range(3):
+                    fadd(acc[c], acc[c], r0).fmul(
+                        r0, r4.unpack(_BYTES[c+1]), w)
+                fadd(acc[3], acc[3], r0)
+        elif t == 0:
+            mov(r1, r4)
+        elif op == 'max':
+            v8max(r1, r1, r4)
+        else:
+            v8min(r1, r1, r4)
+        if t + 4 < taps:
+            issue()
+
+    if op == 'conv':
+        for c in range(4):
+            fmul(ra20, acc[c], 1.0, pack=_BYTES[c])
+        _store(asm, ra20)
+    else:
+        _store(asm, r1)
+    _epilogue(asm)
+
+#================================ Host program ================================
+
+def _check_image(img, ndim, name='image'):
+    if (not hasattr(img, 'address') or img.dtype != np.uint8 or
+            img.ndim != ndim or not img.flags.c_contiguous):
+        raise DriverError('{} must be a contiguous uint8 device array'
+                          .format(name.capitalize()))
+    if ndim == 3 and img.shape[2] != 4:
+        raise DriverError('Image must be RGBA')
+
+def _check_output(out, shape):
+    if (not hasattr(out, 'address') or out.dtype != np.uint8 or
+            out.shape != shape or not out.flags.c_contiguous):
+        raise DriverError('Invalid output image')
+
+def gaussian_weights(sigma, radius=None):
+    'Normalized weights of Gaussian filter.'
+    if radius is None:
+        radius = min(int(np.ceil(3 * sigma)), MAX_TAPS // 2)
+    x = np.arange(-radius, radius + 1)
+    w = np.exp(-0.5 * (x / float(sigma))**2)
+    return w / w.sum()
+
+class ImageProcessor(object):
+    """Image processing on a driver.
+
+    Programs are made at the first use and buffers of intermediate images are
+    reused.  Images returned without ``out`` are written to buffers which are
+    overwritten by the next call of the same method.
+
+    :param drv: :py:class:`videocore.driver.Driver`.
+    :param max_threads: maximum number of threads.
+    """
+
+    def __init__(self, drv, max_threads=None):
+        self.drv = drv
+        self.max_threads = max_threads or drv.max_threads
+        self.workspace = Workspace(drv)
+        self.lock = threading.RLock()
+        self._programs = {}
+
+    def program(self, kernel, *args):
+        key = (id(kernel),) + args
+        with self.lock:
+            if key not in self._programs:
+                self._programs[key] = self.drv.program(kernel, *args)
+            return self._programs[key]
+
+    def _output(self, name, out, shape, inputs):
+        'Check ``out``, or return a buffer of results not overlapping inputs.'
+        if out is None:
+            return self.workspace.output(name, shape, 'uint8', inputs)
+        _check_output(out, shape)
+        return out
+
+    def _run(self, program, params, vpm_rows=1, extra=()):
+        n_threads, start, count = partition(len(params), self.max_threads,
+                                            unit=1)
+        with self.lock:
+            table = self.workspace.get('params', params.shape, 'u4')
+            table[:] = params
+            threads = np.arange(n_threads)
+            uniforms = np.zeros((n_threads, 6 + len(extra)), dtype='u4')
+            uniforms[:, 6:] = extra
+            uniforms[:, 0] = table.address + 4 * params.shape[1] * start
+            uniforms[:, 1] = count
+            uniforms[:, 2] = threads
+            uniforms[:, 3] = n_threads
+            uniforms[:, 4] = _vpm_write_setup(vpm_rows * threads)
+            uniforms[:, 5] = (vpm_rows * threads) << 7
+            self.drv.execute(
+                    n_threads=n_threads,
+                    program=program,
+                    uniforms=uniforms
+                    )
+
+    def yuv420_to_rgba(self, y, u, v, out=None):
+        """Convert I420 planes to an RGBA image.
+
+        :param y: ``(height, width)`` luma plane.
+        :param u, v: ``(height/2, width/2)`` chroma planes.
+
+        Width must be a multiple of 8 and height must be even.
+        """
+
+        _check_image(y, 2, 'luma')
+        _check_image(u, 2, 'chroma')
+        _check_image(v, 2, 'chroma')
+        h, w = y.shape
+        if w % 8 or h % 2 or u.shape != (h//2, w//2) or u.shape != v.shape:
+            raise DriverError('Invalid shapes of planes')
+        row, x = [a.ravel() for a in np.meshgrid(
+            np.arange(h), np.arange(0, w, 64), indexing='ij')]
+        units = np.minimum(16, (w - x) // 4)
+        chroma = (row // 2) * (w // 2) + x // 2
+        with self.lock:
+            out = self._output('yuv420', out, (h, w, 4), [y, u, v])
+            params = np.stack([
+                4 * (units - 1),
+                y.address + row * w + x,
+                4 * ((units - 1) // 2),
+                u.address + chroma,
+                v.address + chroma,
+                0x80000000 | units << 23 | 4 << 16,
+                out.address + 4 * (row * w + x)], axis=1)
+            self._run(self.program(yuv420_kernel), params, vpm_rows=4)
+            return out
+
+    def downscale2x(self, img, out=None):
+        'Average 2x2 pixels of an RGBA image of even width and height.'
+
+        _check_image(img, 3)
+        h, w = img.shape[:2]
+        if w % 2 or h % 2:
+            raise DriverError('Width and height must be even')
+        row, x = [a.ravel() for a in np.meshgrid(
+            np.arange(h // 2), np.arange(0, w // 2, 16), indexing='ij')]
+        units = np.minimum(16, w // 2 - x)
+        with self.lock:
+            out = self._output('downscale2x', out, (h//2, w//2, 4), [img])
+            params = np.stack([
+                8 * (units - 1),
+                img.address + 4 * (2 * row * w + 2 * x),
+                _dma_store_setup(units, 0),
+                out.address + 4 * (row * (w // 2) + x)], axis=1)
+            self._run(self.program(downscale2x_kernel), params,
+                      extra=[4 * w])
+            return out
+
+    def filter1d(self, img, weights, op='conv', vertical=False, out=None):
+        """Filter rows or columns of an RGBA image.
+
+        :param weights: weights of taps centered at the pixel.  Only its
+            length is used for 'max' and 'min'.
+        :param op: 'conv' for convolution, 'max' or 'min'.
+        :param vertical: filter columns if True.
+        """
+
+        _check_image(img, 3)
+        h, w = img.shape[:2]
+        taps = len(weights)
+        if taps % 2 == 0:
+            raise DriverError('Number of taps must be odd')
+        step = 4 * w if vertical else 4
+        extra = [step, -step * (taps // 2) & 0xffffffff]
+        if op == 'conv':
+            extra += list(np.array(weights, 'float32').view('u4'))
+
+        row, x = [a.ravel() for a in np.meshgrid(
+            np.arange(h), np.arange(0, w, 16), indexing='ij')]
+        units = np.minimum(16, w - x)
+        if vertical:
+            lo = img.address + 4 * x
+            hi = lo + 4 * w * (h - 1)
+        else:
+            lo = img.address + 4 * row * w
+            hi = lo + 4 * (w - 1)
+        with self.lock:
+            out = self._output('filter1d', out, img.shape, [img])
+            params = np.stack([
+                4 * (units - 1),
+                img.address + 4 * (row * w + x),
+                lo, hi,
+                _dma_store_setup(units, 0),
+                out.address + 4 * (row * w + x)], axis=1)
+            self._run(self.program(filter_kernel, taps, op, vertical),
+                      params, extra=extra)
+            return out
+
+    def separable_filter(self, img, weights, op='conv', out=None):
+        'Filter an RGBA image by ``weights`` horizontally then vertically.'
+        with self.lock:
+            tmp = self.workspace.get('separable', img.shape, 'uint8')
+            out = self._output('filter1d', out, img.shape, [img, tmp])
+            self.filter1d(img, weights, op, vertical=False, out=tmp)
+            return self.filter1d(tmp, weights, op, vertical=True, out=out)
+
+_processors = weakref.WeakKeyDictionary()
+
+def _processor(drv):
+    if drv not in _processors:
+        _processors[drv] = ImageProcessor(drv)
+    return _processors[drv]
+
+def yuv420_to_rgba(drv, y, u, v, out=None):
+    'Convert I420 device planes to an RGBA device image.'
+    return _processor(drv).yuv420_to_rgba(y, u, v, out)
+
+def downscale2x(drv, img, out=None):
+    'Halve width and height of an RGBA device image.'
+    return _processor(drv).downscale2x(img, out)
+
+def separable_filter(drv, img, weights, out=None):
+    'Convolve an RGBA device image by ``weights`` in both directions.'
+    return _processor(drv).separable_filter(img, weights, 'conv', out)
+
+def gaussian_blur(drv, img, sigma, radius=None, out=None):
+    'Blur an RGBA device image by Gaussian filter.'
+    return separable_filter(drv, img, gaussian_weights(sigma, radius), out)
+
+def dilate(drv, img, radius=1, out=None):
+    'Maximum of channels over (2 radius + 1)^2 pixels.'
+    return _processor(drv).separable_filter(
+        img, [0] * (2 * radius + 1), 'max', out)
+
+def erode(drv, img, radius=1, out=None):
+    'Minimum of channels over (2 radius + 1)^2 pixels.'
+    return _processor(drv).separable_filter(
+        img, [0] * (2 * radius + 1), 'min', out)
@@ -1,6 +1,7 @@
 """Wrapper of mailBox property interface."""
 
 import os
+import threading
 from array import array
 from struct import calcsize, pack_into, unpack_from
 from fcntl import ioctl
@@ -19,6 +20,14 @@ PARSE_ERROR     = 0x80000001
 class MailBoxException(Exception):
     'Exception related to mailbox property interface.'
 
+def _unwrap(r):
+    'Value of a response of a simple method.'
+    n = len(r)
+    if n == 1:
+        return r[0]
+    elif n > 1:
+        return r
+
 class MailBox(object):
     """MailBox Property Interface.
 
@@ -65,8 +74,18 @@ class MailBox(object):
     MEM_FLAG_NO_INIT          = 1 << 5
     MEM_FLAG_HINT_PERMALOCK   = 1 << 6
 
+    # Tags and formats of constant length methods by name.
+    _methods = {}
+
     def __init__(self):
         self.fd = os.open('/dev/vcio', os.O_RDONLY)
+        self._init_buffer()
+
+    def _init_buffer(self):
+        # Message buffer reused by all requests, so that periodic polling
+        # does not allocate.  The lock serializes requests sharing it.
+        self._buf = array('B', [0]*IOCTL_BUFSIZE)
+        self._lock = threading.Lock()
 
     def close(self):
         if self.fd:
@@ -80,78 +99,150 @@ class MailBox(object):
         self.close()
         return exc_value is None
 
-    def _simple_call(self, name, tag, req_fmt, res_fmt, args):
-        'Call a method which has constant length response.'
+    def _request(self, names, tags):
+        """Send a request of ``tags`` in the message buffer.
 
+        ``tags`` is a list of (tag, size of value buffer, request format,
+        arguments).  Return a list of (offset of value, response length) of
+        the tags.  Call with the lock held.
+        """
         # Since the mailbox property interface overwrites the request tag buffer for returning
         # values to the host, size of the buffer must have enough space for both request
         # arguments and returned values. It must also be 32-bit aligned.
-        tag_size = (max(calcsize(req_fmt), calcsize(res_fmt)) + 3) // 4 * 4
-
-        buf = array('B', [0]*IOCTL_BUFSIZE)
-        pack_into('=5L' + req_fmt + 'L', buf, 0,
-                *([24 + tag_size, PROCESS_REQUEST, tag, tag_size, tag_size] + args + [0]))
+        buf = self._buf
+        offsets = []
+        pos = 8
+        for name, (tag, size, req_fmt, args) in zip(names, tags):
+            size = (size + 3) // 4 * 4
+            if pos + 12 + size + 4 > IOCTL_BUFSIZE:
+                raise MailBoxException('Too many requests', name)
+            pack_into('=3L' + req_fmt, buf, pos,
+                      *([tag, size, size] + list(args)))
+            offsets.append(pos + 12)
+            pos += 12 + size
+        pack_into('=2L', buf, 0, pos + 4, PROCESS_REQUEST)
+        pack_into('=L', buf, pos, 0)
 
         ioctl(self.fd, IOCTL_MAILBOX, buf, True)
 
-        r = unpack_from('=5L' + res_fmt, buf, 0)
-        if r[1] != REQUEST_SUCCESS:
-            raise MailBoxException('Request failed', name, *args)
+        if unpack_from('=L', buf, 4)[0] != REQUEST_SUCCESS:
+            raise MailBoxException('Request failed', *names)
+        responses = []
+        for name, pos in zip(names, offsets):
+            code, = unpack_from('=L', buf, pos - 4)
+            if not code & 0x80000000:
+                raise MailBoxException('Request failed', name)
+            responses.append((pos, code & ~0x80000000))
+        return responses
 
-        assert(r[4] == 0x80000000 | calcsize(res_fmt))
-        return r
+    def _simple_call(self, name, tag, req_fmt, res_fmt, args):
+        'Call a method which has constant length response.'
+        return self._batch_call([(name, tag, req_fmt, res_fmt, args)])[0]
+
+    def _batch_call(self, calls):
+        """Call methods which have constant length responses in one request.
+
+        ``calls`` is a list of (name, tag, request format, response format,
+        arguments).  Return a list of the responses of the tags.
+        """
+        names = [call[0] for call in calls]
+        tags = [(tag, max(calcsize('=' + req_fmt), calcsize('=' + res_fmt)),
+                 req_fmt, args)
+                for name, tag, req_fmt, res_fmt, args in calls]
+        with self._lock:
+            responses = self._request(names, tags)
+            results = []
+            for (name, tag, req_fmt, res_fmt, args), (pos, length) in \
+                    zip(calls, responses):
+                if length != calcsize('=' + res_fmt):
+                    raise MailBoxException('Request failed', name, *args)
+                results.append(unpack_from('=' + res_fmt, self._buf, pos))
+        return results
+
+    def _variable_call(self, name, tag, req_fmt='', args=(), item_fmt='B',
+                       size=None):
+        """Call a method which has variable length response.
+
+        :param item_fmt: format of items of the response.
+        :param size: size of the value buffer.  Default is the largest one
+            which fits the message buffer.
+
+        Return a tuple of items in the response.  If the response is longer
+        than the value buffer, it is truncated to the buffer.
+        """
+        if size is None:
+            size = IOCTL_BUFSIZE - 24
+        size = max(size, calcsize('=' + req_fmt))
+        item_size = calcsize('=' + item_fmt)
+        with self._lock:
+            (pos, length), = self._request([name],
+                                           [(tag, size, req_fmt, args)])
+            n = min(length, size) // item_size
+            return unpack_from('={}{}'.format(n, item_fmt), self._buf, pos)
 
     @classmethod
     def _add_simple_method(cls, name, tag, req_fmt, res_fmt):
         def f(self, *args):
-            r = self._simple_call(name, tag, req_fmt, res_fmt, list(args))[5:]
-            n = len(r)
-            if n == 1:
-                return r[0]
-            elif n > 1:
-                return r
+            return _unwrap(self._simple_call(name, tag, req_fmt, res_fmt,
+                                             list(args)))
+        cls._methods[name] = (tag, req_fmt, res_fmt)
         setattr(cls, name, f)
 
-    def get_clocks(self):
-        buf = array('B', [0]*IOCTL_BUFSIZE)
-        pack_into('=5L', buf, 0,
-            *[IOCTL_BUFSIZE, PROCESS_REQUEST, 0x00010007, IOCTL_BUFSIZE-24, IOCTL_BUFSIZE-24]
-            )
+    def batch(self, *requests):
+        """Call several methods by a single ioctl.
 
-        ioctl(self.fd, IOCTL_MAILBOX, buf, True)
+        Each of ``requests`` is a tuple of the name of a method and its
+        arguments, e.g. ``mb.batch(('get_temperature', 0), ('get_throttled',))``.
+        Return a list of the values which the methods would return.
+        """
+        calls = []
+        for request in requests:
+            name = request[0]
+            if name not in self._methods:
+                raise MailBoxException('Not a constant length method', name)
+            calls.append((name,) + self._methods[name] + (list(request[1:]),))
+        return [_unwrap(r) for r in self._batch_call(calls)]
 
-        r = unpack_from('=5L' + res_fmt, buf, 0)
-        if r[1] != REQUEST_SUCCESS:
-            raise MailBoxException('Request failed', 'get_clocks')
-        assert(r[4] & 0x80000000)
-        size = (r[4] & ~0x80000000)/4
-        return unpack_from('=%dL'%size, buf, 20)
+    def get_status(self):
+        """Temperature, throttle state, clock rates and memory split by a
+        single ioctl.
 
-    def get_command_line(self):
-        buf = array('B', [0]*IOCTL_BUFSIZE)
-        pack_into('=5L', buf, 0,
-            *[IOCTL_BUFSIZE, PROCESS_REQUEST, 0x00050001, IOCTL_BUFSIZE-24, IOCTL_BUFSIZE-24]
-            )
+        Return a dict of temperature in degree Celsius, flags of
+        get_throttled, rates of ARM, core, V3D and SDRAM clocks in Hz, and
+        (base address, size) of ARM and VideoCore memory.
+        """
+        clocks = [('arm', self.CLOCK_ARM), ('core', self.CLOCK_CORE),
+                  ('v3d', self.CLOCK_V3D), ('sdram', self.CLOCK_SDRAM)]
+        r = self.batch(('get_temperature', 0), ('get_throttled',),
+                       ('get_arm_memory',), ('get_vc_memory',),
+                       *[('get_clock_rate', clock) for _, clock in clocks])
+        status = {
+            'temperature': r[0][1] / 1000.0,
+            'throttled': r[1],
+            'arm_memory': r[2],
+            'vc_memory': r[3],
+        }
+        for (name, _), rate in zip(clocks, r[4:]):
+            status[name + '_clock'] = rate[1]
+        return status
 
-        ioctl(self.fd, IOCTL_MAILBOX, buf, True)
+    def get_clocks(self):
+        'List of (parent clock id, clock id) of all clocks.'
+        r = self._variable_call('get_clocks', 0x00010007, item_fmt='L')
+        return list(zip(r[0::2], r[1::2]))
 
-        r = unpack_from('=5L' + res_fmt, buf, 0)
-        if r[1] != REQUEST_SUCCESS:
-            raise MailBoxException('Request failed', 'get_command_line')
-        assert(r[4] & 0x80000000)
-        size = (r[4] & ~0x80000000)
-        return unpack_from('=%ds'%size, buf, 20)[0]
+    def get_command_line(self):
+        'Kernel command line as bytes.'
+        r = self._variable_call('get_command_line', 0x00050001, item_fmt='s')
+        return b''.join(r).rstrip(b'\0')
 
     def _palette_method(self, name, tag, offset, length, values):
-        buf = array('L',
-                [IOCTL_BUFSIZE, PROCESS_REQUEST, tag, (length+2)*4, offset, length] +
-                values)
-        ioctl(self.fd, IOCTL_MAILBOX, buf, True)
-        r = unpack_from('=6L' + res_fmt, buf, 0)
-        if r[1] != REQUEST_SUCCESS:
-            raise MailBoxException('Request failed', name)
-        assert(r[4] == 0x80000004)
-        return r[5]
+        if len(values) != length:
+            raise MailBoxException('Length of values must be length', name)
+        r = self._variable_call(name, tag, '{}L'.format(length + 2),
+                                [offset, length] + list(values),
+                                item_fmt='L', size=4)
+        return r[0]
 
     def test_palette(self, offset, length, values):
         return self._palette_method('test_palette', 0x0004400b, offset, length, values)
@@ -0,0 +1,167 @@
+"""Persistent threads running any number of logical work items.
+
+A kernel body processing one work item is wrapped in a loop over logical ids
+by :py:func:`persistent_kernel`, so that at most ``max_threads`` QPU threads
+run all work items in a single launch.  Before each iteration the uniforms
+address is set to the uniforms of the work item, so the body reads them by
+``uniform`` as a kernel of one thread would::
+
+    @qpu
+    def body(asm):
+        setup_dma_load(nrows=1)
+        start_dma_load(uniform)
+        ...
+
+    launcher = PersistentLauncher(drv, body)
+    launcher(uniforms)          # uniforms of shape (work items, uniforms)
+
+The body must not call ``exit`` or ``interrupt``, must not use semaphore 0
+and must preserve ra29 to ra31 and rb29 to rb31.  ra31 holds the logical id
+of the work item.  With ``dynamic=True`` threads take work items from a
+queue of :py:mod:`videocore.workqueue` instead of contiguous ranges, and the
+body must not use its VPM row and semaphore either.
+"""
+
+import threading
+
+import numpy as np
+
+from videocore.assembler import qpu
+from videocore.driver import DriverError
+from videocore.grid import Grid
+from videocore.workqueue import init_queue, take_work, finish_queue
+
+@qpu
+def persistent_kernel(asm, body, args=(), kwargs={}, dynamic=False):
+    """Run ``body(asm, *args, **kwargs)`` for each logical work item.
+
+    Uniforms of each thread are those of :py:func:`persistent_uniforms`.
+    """
+    COMPLETED = 0
+    with namespace('persistent'):
+        mov(ra31, uniform)          # start id
+        mov(r1, uniform)            # number of ids
+        if dynamic:
+            mov(rb31, r1)
+        else:
+            iadd(rb31, ra31, r1)    # stop id
+        mov(ra29, uniform)          # thread index
+        mov(rb29, uniform)          # number of threads
+        mov(ra30, uniform)          # address of uniforms of work items
+        mov(rb30, uniform)          # bytes of uniforms of a work item
+        if dynamic:
+            init_queue(asm, ra29)
+
+        L.next
+        if dynamic:
+            take_work(asm, r1)
+            isub(null, r1, rb31)
+            jnc(L.done)
+            imul24(r0, r1, rb30)    # delay slot
+            iadd(uniforms_address, r0, ra30)    # delay slot
+            mov(ra31, r1)           # delay slot
+        else:
+            isub(null, ra31, rb31)
+            jnc(L.done)
+            imul24(r0, ra31, rb30)  # delay slot
+            iadd(uniforms_address, r0, ra30)    # delay slot
+            nop()                   # delay slot
+        # Uniforms can not be read just after the address is changed.
+        nop(); nop()
+
+    body(asm, *args, **kwargs)
+
+    with namespace('persistent'):
+        if not dynamic:
+            iadd(ra31, ra31, 1)
+        jmp(L.next)
+        nop(); nop(); nop()
+
+        L.done
+        sema_up(COMPLETED)
+        mov(null, ra29, set_flags=True)
+        jzc(L.skip_fin)
+        nop(); nop(); nop()
+        mov(r0, rb29)
+        L.sem_down
+        sema_down(COMPLETED)
+        isub(r0, r0, 1)
+        jzc(L.sem_down)
+        nop(); nop(); nop()
+        if dynamic:
+            finish_queue(asm)
+        interrupt()
+        L.skip_fin
+        exit(interrupt=False)
+
+def persistent_uniforms(n_items, max_threads, address, stride, dynamic=False,
+                        cost=None):
+    """Uniforms of threads of :py:func:`persistent_kernel`.
+
+    :param n_items: number of work items.
+    :param address: address of uniforms of work items.
+    :param stride: bytes of uniforms of a work item.
+    :param cost: cost of each work item to balance static ranges.
+
+    Return (number of threads, uniforms).
+    """
+    return Grid(n_items, 1).uniforms(max_threads, address, stride,
+                                     dynamic=dynamic, cost=cost)
+
+class PersistentLauncher(object):
+    """Launcher of a kernel body for any number of logical work items.
+
+    :param body: QPU function processing a work item.  ``args`` and
+        ``kwargs`` other than the keyword arguments below are passed to it.
+    :param dynamic: if True, threads take work items from a queue.
+    :param max_threads: maximum number of threads.  Default is that of the
+        driver.
+    :param max_items: maximum number of work items of a launch.
+    :param max_uniforms: maximum number of uniforms of a work item.
+
+    The table of uniforms of work items is allocated once for ``max_items``
+    and ``max_uniforms``, because device memory is never freed.
+    """
+
+    def __init__(self, drv, body, *args, **kwargs):
+        self.drv = drv
+        self.dynamic = kwargs.pop('dynamic', False)
+        self.max_threads = kwargs.pop('max_threads', drv.max_threads)
+        self.max_items = kwargs.pop('max_items', 4096)
+        self.max_uniforms = kwargs.pop('max_uniforms', 1)
+        self.program = drv.program(persistent_kernel, body, args, kwargs,
+                                   self.dynamic)
+        self.table = drv.alloc(self.max_items * self.max_uniforms, 'u4')
+        self.lock = threading.Lock()
+
+    def _stage(self, uniforms):
+        'Copy uniforms of work items to the table reused between launches.'
+        self.table[:uniforms.size] = uniforms.ravel()
+        return self.table.address
+
+    def __call__(self, uniforms, cost=None, timeout=10000):
+        """Run the body for each row of ``uniforms``.
+
+        :param uniforms: uniforms of work items, an array of (number of work
+            items, number of uniforms).  A 1-D array is a uniform of each.
+        :param cost: cost of each work item to balance static ranges.
+        """
+        uniforms = np.asarray(uniforms, dtype='u4')
+        if uniforms.ndim == 1:
+            uniforms = uniforms.reshape(-1, 1)
+        if uniforms.ndim != 2 or not uniforms.shape[0]:
+            raise DriverError('No work items')
+        n_items, n_uniforms = uniforms.shape
+        if n_items > self.max_items or n_uniforms > self.max_uniforms:
+            raise DriverError(
+                    '{} work items of {} uniforms exceed max_items {} or '
+                    'max_uniforms {} of the launcher'.format(
+                        n_items, n_uniforms, self.max_items,
+                        self.max_uniforms))
+        with self.lock:
+            address = self._stage(uniforms)
+            n_threads, thread_uniforms = persistent_uniforms(
+                n_items, self.max_threads, address, 4 * n_uniforms,
+                self.dynamic, cost)
+            self.drv.execute(n_threads, self.program, thread_uniforms,
+                             timeout)
@@ -0,0 +1,327 @@
+"""Parallel reductions.
+
+This module implements ``sum``, ``max``, ``argmax`` and ``dot`` of float32 and
+int32 device arrays of any length using all QPUs.
+
+>>> s = reduce.sum(drv, X)
+>>> i = reduce.argmax(drv, X)
+
+Each thread reduces a contiguous range of 16-element vectors into a vector
+register, then reduces its 16 lanes by rotating the vector by 8, 4, 2 and 1
+lanes.  Results of threads are written to VPM and thread 0 combines them after
+the other threads notify completion by ``sema_up``.
+
+Sums of int32 wrap around like ``np.sum(x, dtype='int32')`` and ``dot`` of
+int32 uses signed 24-bit multiplication, i.e. elements must be in
+[-2**23, 2**23).  Order of additions of float32 differs from
+NumPy.  ``argmax`` returns the first index of the maximum like NumPy.
+"""
+
+import threading
+import weakref
+
+import numpy as np
+
+from videocore.assembler import qpu, AssembleError
+from videocore.driver import DriverError
+from videocore.elementwise import partition, _vpm_write_setup
+
+OPERATIONS = ['sum', 'max', 'argmax', 'dot']
+
+# Semaphore used to notify completion of threads.
+_COMPLETED = 0
+
+_ADD = {'float32': 'fadd', 'int32': 'iadd'}
+_MAX = {'float32': 'fmax', 'int32': 'imax'}
+_LOWEST = {'float32': float('-inf'), 'int32': -0x80000000}
+
+#================================== Kernel ====================================
+
+@qpu
+def reduce_kernel(asm, op, dtype, n_threads):
+    """Reduction kernel.
+
+    Uniforms of each thread are number of vectors, byte offset of the last
+    element, index of the first element, VPM write setup, thread index,
+    output address and addresses of the first element of inputs.
+
+    The result is stored to the first element of the output, and the index
+    of ``argmax`` to the 17th element.
+
+    Registers:
+        ra0: byte offsets of elements of the current vector
+        ra9: number of remaining vectors
+        ra12: partial sums or maxima of lanes
+        rb13: indices of maxima of lanes
+        rb0: byte offset of the last element of the thread
+        rb1: index of the first element of the thread
+        rb2: VPM write setup
+        rb3: thread index
+        rb4: output address
+    """
+
+    if op not in OPERATIONS:
+        raise AssembleError('Unknown reduction {}'.format(op))
+    add = getattr(asm, _ADD[dtype])
+    vmax = getattr(asm, _MAX[dtype])
+    inputs = [ra1, ra2] if op == 'dot' else [ra1]
+
+    def issue_loads(offset):
+        imin(r0, offset, rb0)
+        for reg in inputs:
+            iadd(tmu0_s, reg, r0)
+
+    mov(tmu_noswap, 1)
+    mov(ra9, uniform)
+    mov(rb0, uniform)
+    mov(rb1, uniform)
+    mov(rb2, uniform)
+    mov(rb3, uniform)
+    mov(rb4, uniform)
+    for reg in inputs:
+        mov(reg, uniform)
+    if op in ['sum', 'dot']:
+        mov(ra12, 0)
+    else:
+        ldi(ra12, _LOWEST[dtype])
+        mov(rb13, 0)
+    shl(ra0, element_number, 2)
+    nop()
+    issue_loads(ra0)
+
+    #==== Reduce vectors of the thread ====
+    L.loop
+
+    nop(sig='load tmu0')
+    if op == 'sum':
+        isub(null, rb0, ra0)        # N is set for lanes out of the range.
+        add(ra12, ra12, r4, cond='nc', set_flags=False)
+    elif op == 'dot' and dtype == 'float32':
+        mov(r1, r4)
+        nop(sig='load tmu0')
+        fmul(r1, r1, r4)
+        isub(null, rb0, ra0)
+        fadd(ra12, ra12, r1, cond='nc', set_flags=False)
+    elif op == 'dot':
+        # imul24 is unsigned, so multiply absolute values and fix the sign.
+        mov(r1, r4)
+        nop(sig='load tmu0')
+        bxor(r3, r1, r4)
+        isub(r2, 0, r1)
+        imax(r1, r1, r2)
+        isub(r2, 0, r4)
+        imax(r2, r4, r2)
+        imul24(r1, r1, r2)
+        isub(r2, 0, r1)
+        mov(null, r3, set_flags=True)
+        mov(r1, r2, cond='ns')
+        isub(null, rb0, ra0)
+        iadd(ra12, ra12, r1, cond='nc', set_flags=False)
+    elif op == 'max':
+        vmax(ra12, ra12, r4)
+    else:
+        # Last elements loaded repeatedly have the same index because the
+        # offsets are clamped.
+        imin(r2, ra0, rb0)
+        shr(r2, r2, 2)
+        iadd(r2, r2, rb1)
+        vmax(r1, ra12, r4)
+        isub(null, r1, ra12)        # Z is clear where the maximum is updated.
+        mov(ra12, r1, cond='zc')
+        mov(rb13, r2, cond='zc')
+
+    ldi(r3, 64)
+    iadd(r2, ra0, r3)
+    issue_loads(r2)
+    isub(ra9, ra9, 1)
+    jzc(L.loop)
+    mov(ra0, r2)    # delay slot
+    nop()           # delay slot
+    nop()           # delay slot
+
+    # Discard prefetched vectors.
+    for reg in inputs:
+        nop(sig='load tmu0')
+
+    #==== Reduce lanes ====
+    mov(r0, ra12)
+    if op == 'argmax':
+        mov(r2, rb13)
+    nop()
+    for shift in [8, 4, 2, 1]:
+        rotate(r1, r0, shift)
+        if op in ['sum', 'dot']:
+            add(r0, r0, r1)
+            nop()
+            continue
+        if op == 'max':
+            vmax(r0, r0, r1)
+            nop()
+            continue
+        rotate(r3, r2, shift)
+        isub(null, r0, r1)                  # Z is set for equal values.
+        imin(r2, r2, r3, cond='zs', set_flags=False)
+        vmax(r1, r0, r1, set_flags=False)
+        isub(null, r1, r0)                  # Z is clear for greater values.
+        mov(r2, r3, cond='zc')
+        mov(r0, r1)
+        nop()
+
+    #==== Reduce threads ====
+    mov(vpmvcd_wr_setup, rb2)
+    mov(vpm, r0)
+    if op == 'argmax':
+        mov(vpm, r2)
+
+    sema_up(_COMPLETED)
+    mov(null, rb3, set_flags=True)
+    jzc(L.skip_fin)
+    nop(); nop(); nop()
+
+    # Only thread 0 enters here.
+    for i in range(n_threads):
+        sema_down(_COMPLETED)
+
+    setup_vpm_read(nrows=n_threads, Y=0)
+    nop(); nop()
+    mov(r0, vpm)
+    for i in range(1, n_threads):
+        mov(ra[16+i], vpm)
+    if op == 'argmax':
+        setup_vpm_read(nrows=n_threads, Y=16)
+        nop(); nop()
+        mov(r2, vpm)
+        for i in range(1, n_threads):
+            mov(rb[16+i], vpm)
+    nop()
+
+    for i in range(1, n_threads):
+        if op in ['sum', 'dot']:
+            add(r0, r0, ra[16+i])
+        elif op == 'max':
+            vmax(r0, r0, ra[16+i])
+        else:
+            # Earlier threads win ties because they have smaller indices.
+            vmax(r1, r0, ra[16+i])
+            isub(null, r1, r0)
+            mov(r2, rb[16+i], cond='zc')
+            mov(r0, r1)
+
+    setup_vpm_write(Y=0)
+    mov(vpm, r0)
+    mov(vpm, r2)
+    setup_dma_store(nrows=2)
+    start_dma_store(rb4)
+    wait_dma_store()
+    interrupt()
+
+    L.skip_fin
+
+    exit(interrupt=False)
+
+#================================ Host program ================================
+
+class Reducer(object):
+    """Reductions on a driver.
+
+    Programs and the output buffer are allocated at the first use and reused.
+
+    :param drv: :py:class:`videocore.driver.Driver`.
+    :param max_threads: maximum number of threads.  Default is that of the
+        driver.
+    """
+
+    def __init__(self, drv, max_threads=None):
+        self.drv = drv
+        self.max_threads = max_threads or drv.max_threads
+        self._programs = {}
+        self._out = None
+        self.lock = threading.Lock()
+
+    def program(self, op, dtype, n_threads):
+        key = (op, dtype, n_threads)
+        if key not in self._programs:
+            self._programs[key] = self.drv.program(
+                reduce_kernel, op, dtype, n_threads,
+                input_uniforms=range(6, 8 if op == 'dot' else 7),
+                output_uniforms=[5])
+        return self._programs[key]
+
+    def _run(self, op, *arrays):
+        x = arrays[0]
+        for arr in arrays:
+            if not hasattr(arr, 'address'):
+                raise DriverError('Operand is not a device array')
+            if (arr.dtype.name not in _ADD or arr.dtype != x.dtype or
+                    not arr.flags.c_contiguous):
+                raise DriverError(
+                    'Operands must be contiguous float32 or int32 arrays')
+            if arr.size != x.size:
+                raise DriverError('Size mismatch of operands')
+        if x.size == 0:
+            if op in ['max', 'argmax']:
+                raise DriverError('Reduction of zero-size array')
+            return x.dtype.type(0)
+
+        with self.lock:
+            if self._out is None:
+                self._out = self.drv.alloc((2, 16), 'uint32')
+            n_threads, start, count = partition(x.size, self.max_threads)
+            threads = np.arange(n_threads)
+            uniforms = np.zeros((n_threads, 6 + len(arrays)), dtype='u4')
+            uniforms[:, 0] = (count + 15) // 16
+            uniforms[:, 1] = 4 * (count - 1)
+            uniforms[:, 2] = start
+            uniforms[:, 3] = _vpm_write_setup(threads, stride=16)
+            uniforms[:, 4] = threads
+            uniforms[:, 5] = self._out.address
+            for k, arr in enumerate(arrays):
+                uniforms[:, 6+k] = arr.address + 4 * start
+
+            self.drv.execute(
+                    n_threads=n_threads,
+                    program=self.program(op, x.dtype.name, n_threads),
+                    uniforms=uniforms
+                    )
+            if op == 'argmax':
+                return int(self._out[1, 0])
+            return self._out[0, :1].view(x.dtype)[0]
+
+    def sum(self, x):
+        'Sum of elements of ``x``.'
+        return self._run('sum', x)
+
+    def max(self, x):
+        'Maximum of elements of ``x``.'
+        return self._run('max', x)
+
+    def argmax(self, x):
+        'Index of the first maximum element of flattened ``x``.'
+        return self._run('argmax', x)
+
+    def dot(self, x, y):
+        'Inner product of flattened ``x`` and ``y``.'
+        return self._run('dot', x, y)
+
+_reducers = weakref.WeakKeyDictionary()
+
+def _reducer(drv):
+    if drv not in _reducers:
+        _reducers[drv] = Reducer(drv)
+    return _reducers[drv]
+
+def sum(drv, x):
+    'Sum of elements of device array ``x``.'
+    return _reducer(drv).sum(x)
+
+def max(drv, x):
+    'Maximum of elements of device array ``x``.'
+    return _reducer(drv).max(x)
+
+def argmax(drv, x):
+    'Index of the first maximum element of device array ``x``.'
+    return _reducer(drv).argmax(x)
+
+def dot(drv, x, y):
+    'Inner product of device arrays ``x`` and ``y``.'
+    return _reducer(drv).dot(x, y)
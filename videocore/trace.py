@@ -0,0 +1,97 @@
+"""Tracing of driver operations.
+
+Set a :py:class:`Tracer` to a driver to record spans of its operations, e.g.
+assembling and uploading programs, staging uniforms, cleaning caches and the
+ioctl launching QPUs, and save them in Chrome trace event format, which can
+be opened by chrome://tracing or Perfetto::
+
+    drv.tracer = Tracer()
+    ...
+    drv.tracer.save('trace.json')
+
+The driver checks only whether its tracer is None when tracing is disabled.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+class Tracer(object):
+    """Recorder of spans of operations.
+
+    :param max_events: maximum number of events kept.  Older events are
+        dropped.
+    """
+
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.origin = default_timer()
+
+    now = staticmethod(default_timer)
+
+    def record(self, name, start, **args):
+        """Record a span of ``name`` from ``start`` to now with ``args``.
+
+        ``start`` is a value of :py:meth:`now`.  Return now, so that spans of
+        consecutive phases can be recorded by chaining the result.
+        """
+        end = default_timer()
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': get_ident(),
+            'args': args,
+            }
+        with self.lock:
+            self.events.append(event)
+        return end
+
+    @contextmanager
+    def span(self, name, **args):
+        'Record a span of the block.'
+        start = default_timer()
+        try:
+            yield args
+        finally:
+            self.record(name, start, **args)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def totals(self):
+        'Dict of name of spans to (count, total seconds).'
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            count, seconds = totals.get(event['name'], (0, 0.0))
+            totals[event['name']] = (count + 1, seconds + event['dur'] / 1e6)
+        return totals
+
+    def to_chrome(self):
+        'Trace in Chrome trace event format.'
+        with self.lock:
+            events = list(self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, file):
+        'Save the trace in Chrome trace event format to a path or a file.'
+        if not hasattr(file, 'write'):
+            with open(file, 'w') as f:
+                return self.save(f)
+        json.dump(self.to_chrome(), file)
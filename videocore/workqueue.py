@@ -0,0 +1,175 @@
+"""Dynamic work queues of QPU threads.
+
+A work queue is a counter in a VPM row guarded by a semaphore.  Threads
+atomically take chunks of ``grain`` consecutive work items from the counter
+until it passes the number of items, so threads finishing cheap items early
+take more of them and load balancing happens on the QPUs in a single launch::
+
+    mov(ra0, uniform)               # thread index
+    mov(ra1, uniform)               # number of items
+    mov(rb1, uniform)               # grain
+    init_queue(asm, ra0)
+    L.loop
+    pop_work(asm, r1, r2, ra1, rb1)
+    jnc(L.done)                     # the queue is empty
+    nop(); nop(); nop()
+    ...                             # process items [r1, r1 + r2)
+    jmp(L.loop)
+    nop(); nop(); nop()
+    L.done
+    ...                             # wait for completion of all threads
+    finish_queue(asm)               # by thread 0
+
+:py:class:`WorkQueue` chooses the grain and the VPM row and semaphore of each
+queue on the host.  Up to :py:data:`MAX_QUEUES` queues can be used at a time,
+which take the last VPM rows and semaphores.
+"""
+
+import numbers
+
+import numpy as np
+
+from videocore.assembler import qpu, AssembleError
+from videocore.driver import DriverError
+
+# VPM row and semaphore of the first queue.  Queue ``i`` uses the row and the
+# semaphore ``i`` below them, so kernels using queues must not use them for
+# other purposes.
+QUEUE_VPM_ROW = 63
+QUEUE_SEMAPHORE = 15
+MAX_QUEUES = 4
+
+# Chunks taken by each thread on average.  More chunks balance uneven costs
+# better at the price of more semaphore round trips.
+DEFAULT_CHUNKS_PER_THREAD = 4
+
+def chunk_size(size, n_threads, chunks_per_thread=DEFAULT_CHUNKS_PER_THREAD,
+               min_grain=1):
+    """Grain of a queue of ``size`` items taken by ``n_threads`` threads.
+
+    The grain is a multiple of ``min_grain`` such that each thread takes about
+    ``chunks_per_thread`` chunks.
+    """
+    if size < 0 or n_threads < 1 or chunks_per_thread < 1 or min_grain < 1:
+        raise DriverError('Invalid queue size')
+    grain = -(-size // (n_threads * chunks_per_thread))
+    return max(1, -(-grain // min_grain)) * min_grain
+
+class WorkQueue(object):
+    """Work queue of ``size`` items taken by ``n_threads`` threads.
+
+    :param grain: number of items of a chunk.  Default is chosen by
+        :py:func:`chunk_size`.
+    :param index: index of the queue in ``[0, MAX_QUEUES)``.  Queues used in
+        the same kernel must have different indices.
+
+    Pass ``sem`` and ``row`` to the macros of the queue, e.g.
+    ``pop_work(asm, r1, r2, ra1, rb1, **queue.macro_args)``.
+    """
+
+    def __init__(self, size, n_threads, grain=None, index=0,
+                 chunks_per_thread=DEFAULT_CHUNKS_PER_THREAD):
+        if not 0 <= index < MAX_QUEUES:
+            raise DriverError('Queue index must be in range (0..{})'
+                              .format(MAX_QUEUES - 1))
+        if grain is None:
+            grain = chunk_size(size, n_threads, chunks_per_thread)
+        if grain < 1:
+            raise DriverError('Grain must be positive')
+        self.size = size
+        self.n_threads = n_threads
+        self.grain = grain
+        self.index = index
+        self.sem = QUEUE_SEMAPHORE - index
+        self.row = QUEUE_VPM_ROW - index
+
+    @property
+    def n_chunks(self):
+        'Number of chunks of the queue.'
+        return -(-self.size // self.grain)
+
+    @property
+    def macro_args(self):
+        'Keyword arguments of queue macros.'
+        return {'sem': self.sem, 'row': self.row}
+
+    def uniforms(self):
+        'Uniforms of the number of items and the grain.'
+        return np.array([self.size, self.grain], dtype='u4')
+
+def _is_accumulator(reg):
+    return reg.name.startswith('r') and reg.name[1:].isdigit()
+
+@qpu
+def init_queue(asm, thread, start=0, sem=QUEUE_SEMAPHORE, row=QUEUE_VPM_ROW):
+    """Initialize the queue by thread 0.
+
+    :param thread: register of the thread index.
+    :param start: first item index, an integer or a register.
+
+    Other threads wait for the initialization in their first
+    :py:func:`pop_work`.  Uses r0.
+    """
+    with namespace('init_queue{}'.format(sem)):
+        mov(null, thread, set_flags=True)
+        jzc(L.skip)
+        nop(); nop(); nop()
+        setup_vpm_write(Y=row)
+        if isinstance(start, numbers.Integral):
+            ldi(r0, int(start))
+            mov(vpm, r0)
+        else:
+            mov(vpm, start)
+        sema_up(sem)
+        L.skip
+
+@qpu
+def take_work(asm, dst, grain=1, sem=QUEUE_SEMAPHORE, row=QUEUE_VPM_ROW):
+    """Take ``grain`` items from the queue and set the first one to ``dst``.
+
+    Unlike :py:func:`pop_work` the end of the queue is not checked.  ``dst``
+    must be an accumulator.  VPM read and write setups are changed.
+    """
+    if not _is_accumulator(dst):
+        raise AssembleError('Destination of take_work must be an accumulator')
+    if isinstance(grain, numbers.Integral):
+        if not 1 <= grain <= 15:
+            raise AssembleError('Grain {} must be a register'.format(grain))
+        grain = int(grain)
+    sema_down(sem)
+    setup_vpm_read(nrows=1, Y=row)
+    setup_vpm_write(Y=row)
+    nop()
+    mov(dst, vpm)
+    iadd(vpm, dst, grain)
+    sema_up(sem)
+
+@qpu
+def pop_work(asm, start, count, size, grain=1, sem=QUEUE_SEMAPHORE,
+             row=QUEUE_VPM_ROW):
+    """Take a chunk of ``grain`` items from the queue of ``size`` items.
+
+    Set the first item index to ``start`` and the number of items of the
+    chunk to ``count``, which is less than ``grain`` at the end of the queue.
+    Flags are set so that ``jnc`` jumps when the queue is empty.
+
+    ``start`` and ``count`` must be accumulators.  ``grain`` is a small
+    immediate or a register.  VPM read and write setups are changed.
+    """
+    if not _is_accumulator(count):
+        raise AssembleError('Destinations of pop_work must be accumulators')
+    if isinstance(grain, numbers.Integral):
+        grain = int(grain)
+    take_work(asm, start, grain, sem, row)
+    isub(count, size, start)
+    imin(count, count, grain, set_flags=False)
+    isub(null, start, size)
+
+@qpu
+def finish_queue(asm, sem=QUEUE_SEMAPHORE):
+    """Restore the semaphore of the queue.
+
+    Call by thread 0 after all threads have finished :py:func:`pop_work`,
+    e.g. after waiting for their completion.
+    """
+    sema_down(sem)